@@ -0,0 +1,239 @@
+# Пакетний розрахунок норм добрив для багатьох полів одночасно (CSV/XLSX).
+# Кожен рядок файлу - одне поле. Усі рядки обчислюються одним векторизованим
+# проходом NumPy з тими самими коефіцієнтами, що й у fertilizer_engine.
+import io
+
+import numpy as np
+import pandas as pd
+
+from fertilizer_engine import (base_requirements, prev_crop_factors, moisture_factors, soil_factors,
+                               region_to_zone, lookup_table, TABLE_SHAPE, default_n_form, n_forms, p_forms, k_forms,
+                               DEFAULT_P_FORM, DEFAULT_K_FORM)
+
+# Очікувані колонки вхідного файлу (форми добрив і площа - необов'язкові)
+REQUIRED_COLUMNS = ['crop', 'prev_crop', 'region', 'yield_goal', 'soil_type', 'ph']
+OPTIONAL_COLUMNS = ['area', 'n_form', 'p_form', 'k_form']
+MAX_ROWS = 200_000
+# PDF звіт по полях: полів в одному файлі звіту і максимум полів (для більших файлів - лише таблиця)
+REPORT_PART_ROWS = 500
+MAX_REPORT_ROWS = 5000
+
+_crops = list(base_requirements)
+_prev_crops = list(prev_crop_factors)
+_zones = list(moisture_factors)
+_soils = list(soil_factors)
+# Нормалізоване значення -> індекс у таблиці норм
+_crop_codes = {c: i for i, c in enumerate(_crops)}
+_prev_crop_codes = {p.lower(): i for i, p in enumerate(_prev_crops)}
+_soil_codes = {s: i for i, s in enumerate(_soils)}
+_zone_codes = {z: i for i, z in enumerate(_zones)}
+
+# Таблиця норм рушія без копіювання: масив [культура, попередник, зона, ґрунт, елемент]
+_rate_array = np.frombuffer(lookup_table, dtype=np.float64).reshape(TABLE_SHAPE)[..., :3]
+
+
+# Словник синонімів форми добрива: повна назва, назва без дужок, варіант з кнопки
+def _form_aliases(forms):
+    aliases = {}
+    for name in forms:
+        aliases[name.lower()] = name
+        aliases[name.split(' (')[0].lower()] = name
+        aliases[name.replace('KCl, ', '').replace('DAP, ', '').lower()] = name
+    return aliases
+
+
+_n_aliases = _form_aliases(n_forms)
+_p_aliases = _form_aliases(p_forms)
+_k_aliases = _form_aliases(k_forms)
+
+
+class BatchError(ValueError):
+    pass
+
+
+# Відображення текстової колонки через словник. Нормалізуються лише унікальні
+# значення (їх одиниці), а не кожен рядок; невідомі дають missing, порожні - na.
+def _lookup(column, mapping, normalize=str.lower, missing=-1, na=None):
+    codes, uniques = pd.factorize(column)
+    targets = [mapping.get(normalize(str(u).strip()), missing) for u in uniques]
+    targets.append(missing if na is None else na)
+    return np.array(targets, dtype=object if isinstance(missing, str) else None)[codes]
+
+
+# Числова колонка; допускається десяткова кома (розбираються лише унікальні значення)
+def _number(column):
+    if pd.api.types.is_numeric_dtype(column):
+        return column.to_numpy(dtype=float)
+    codes, uniques = pd.factorize(column)
+    values = pd.to_numeric(pd.Series(uniques, dtype=str).str.replace(',', '.', regex=False), errors='coerce')
+    return np.append(values.to_numpy(dtype=float), np.nan)[codes]
+
+
+# Вибір форми добрива для кожного рядка: задана у файлі або за замовчуванням
+def _forms(df, column, forms, aliases, names):
+    bad = np.zeros(len(df), dtype=bool)
+    if column in df:
+        # '' - форму не задано, '?' - задано невідому форму
+        chosen = _lookup(df[column], {**aliases, '': ''}, missing='?', na='')
+        bad = chosen == '?'
+        names = np.where((chosen == '') | bad, names, chosen)
+    return names, pd.Series(names).map(dict(forms)).to_numpy(dtype=float), bad
+
+
+# Векторизований розрахунок для таблиці полів; повертає таблицю з результатами.
+# optimize - додати найдешевший набір добрив для кожного поля (колонки opt_*)
+def compute_frame(df, optimize=False):
+    df = df.rename(columns=lambda c: str(c).strip().lower())
+    missing = [c for c in REQUIRED_COLUMNS if c not in df]
+    if missing:
+        raise BatchError('Відсутні колонки: ' + ', '.join(missing))
+    if len(df) > MAX_ROWS:
+        raise BatchError(f'Забагато рядків (максимум {MAX_ROWS}).')
+    n = len(df)
+    crop_idx = _lookup(df['crop'], _crop_codes)
+    prev_idx = _lookup(df['prev_crop'], _prev_crop_codes)
+    soil_idx = _lookup(df['soil_type'], _soil_codes)
+    # Регіони, не вказані у словнику, вважаються середньозволоженими
+    zone = _lookup(df['region'], dict(region_to_zone), normalize=str, missing='Середня')
+    zone_idx = _lookup(pd.Series(zone), _zone_codes, normalize=str)
+    yield_goal = _number(df['yield_goal'])
+    ph = _number(df['ph'])
+    area = _number(df['area']) if 'area' in df else np.full(n, np.nan)
+
+    # Перевірка рядків: невідомі значення довідників або некоректні числа
+    errors = np.full(n, '', dtype=object)
+    errors[crop_idx < 0] = 'невідома культура'
+    errors[(prev_idx < 0) & (errors == '')] = 'невідомий попередник'
+    errors[(soil_idx < 0) & (errors == '')] = 'невідомий тип ґрунту'
+    errors[~(yield_goal > 0) & (errors == '')] = 'некоректна врожайність'
+    errors[np.isnan(ph) & (errors == '')] = 'некоректний pH'
+    errors[(area <= 0) & (errors == '')] = 'некоректна площа'
+
+    default_n = _lookup(pd.Series(zone), dict(default_n_form), normalize=str, missing='')
+    n_names, n_content, n_bad = _forms(df, 'n_form', n_forms, _n_aliases, default_n)
+    p_names, p_content, p_bad = _forms(df, 'p_form', p_forms, _p_aliases, np.full(n, DEFAULT_P_FORM, dtype=object))
+    k_names, k_content, k_bad = _forms(df, 'k_form', k_forms, _k_aliases, np.full(n, DEFAULT_K_FORM, dtype=object))
+    errors[n_bad & (errors == '')] = 'невідома форма азотного добрива'
+    errors[p_bad & (errors == '')] = 'невідома форма фосфорного добрива'
+    errors[k_bad & (errors == '')] = 'невідома форма калійного добрива'
+
+    valid = errors == ''
+    # Один прохід індексації по масиву норм і множення на врожайність
+    rates = _rate_array[np.where(valid, crop_idx, 0), np.where(valid, prev_idx, 0),
+                        np.where(valid, zone_idx, 0), np.where(valid, soil_idx, 0)]
+    per_ha = rates * yield_goal[:, None]
+    per_ha[~valid] = np.nan
+    lime = np.select([ph < 5.0, ph < 5.5], [2.0, 1.0], 0.0)
+    fert_per_ha = per_ha / np.column_stack((n_content, p_content, k_content))
+
+    out = df.copy()
+    out['moisture'] = zone
+    out['N_per_ha'] = per_ha[:, 0]
+    out['P_per_ha'] = per_ha[:, 1]
+    out['K_per_ha'] = per_ha[:, 2]
+    out['lime_t_per_ha'] = np.where(valid, lime, np.nan)
+    out['N_form'] = n_names
+    out['P_form'] = p_names
+    out['K_form'] = k_names
+    out['N_fert_per_ha'] = fert_per_ha[:, 0]
+    out['P_fert_per_ha'] = fert_per_ha[:, 1]
+    out['K_fert_per_ha'] = fert_per_ha[:, 2]
+    out['N_fert_total'] = fert_per_ha[:, 0] * area
+    out['P_fert_total'] = fert_per_ha[:, 1] * area
+    out['K_fert_total'] = fert_per_ha[:, 2] * area
+    if optimize:
+        # Імпорт лише при першому запиті оптимізації (базиси рахуються один раз на процес)
+        from optimizer import default_optimizer, product_codes, PriceError
+        try:
+            optimizer = default_optimizer()
+        except PriceError as e:
+            raise BatchError(str(e)) from None
+        amounts, cost = optimizer.solve(per_ha)
+        for i, name in enumerate(optimizer.products):
+            out[f'opt_{product_codes[name]}_per_ha'] = amounts[:, i]
+        out['opt_cost_per_ha'] = cost
+        out['opt_cost_total'] = cost * area
+    out['error'] = errors
+    return out
+
+
+# Читання завантаженого файлу у таблицю
+def read_table(data: bytes, filename: str):
+    name = filename.lower()
+    if name.endswith('.xlsx'):
+        return pd.read_excel(io.BytesIO(data))
+    if name.endswith('.csv'):
+        # Роздільник (кома чи крапка з комою) визначаємо за рядком заголовка
+        header = data.split(b'\n', 1)[0]
+        if header.count(b';') > header.count(b','):
+            # Експорт з Excel з українською локаллю: ';' і десяткова кома
+            return pd.read_csv(io.BytesIO(data), sep=';', decimal=',', encoding='utf-8-sig')
+        return pd.read_csv(io.BytesIO(data), encoding='utf-8-sig')
+    if name.endswith('.xls'):
+        # Старий формат Excel читається лише через xlrd, якого немає в залежностях
+        raise BatchError('Формат XLS не підтримується - збережіть файл як XLSX або CSV.')
+    raise BatchError('Підтримуються лише файли CSV або XLSX.')
+
+
+# Значення клітинки для звіту так, як його вказано у файлі (6 замість 6.0, порожня - '')
+def _cell(value):
+    if pd.isna(value):
+        return ''
+    return f'{value:g}' if isinstance(value, float) else str(value).strip()
+
+
+# Частина PDF звіту по полях (index - номер частини від 0, по REPORT_PART_ROWS полів):
+# (заголовок, рядки). Рядки - список, бо рендеринг виконується в пулі процесів
+def report_part(result, index):
+    start = index * REPORT_PART_ROWS
+    part = result.iloc[start:start + REPORT_PART_ROWS]
+    stop = start + len(part)
+    title = f'Пакетний розрахунок: поля {start + 1}-{stop} з {len(result)}'
+    area = part['area'] if 'area' in part else pd.Series('', index=part.index)
+    cost = part['opt_cost_per_ha'] if 'opt_cost_per_ha' in part else pd.Series(np.nan, index=part.index)
+    columns = [part[c] for c in ('crop', 'region', 'yield_goal', 'error', 'N_per_ha', 'P_per_ha', 'K_per_ha',
+                                 'lime_t_per_ha', 'N_form', 'P_form', 'K_form', 'N_fert_per_ha', 'P_fert_per_ha',
+                                 'K_fert_per_ha', 'N_fert_total', 'P_fert_total', 'K_fert_total')]
+    lines = []
+    for number, row in enumerate(zip(*columns, area, cost), start + 1):
+        (crop, region, yield_goal, error, n, p, k, lime, n_form, p_form, k_form,
+         n_fert, p_fert, k_fert, n_total, p_total, k_total, field_area, opt_cost) = row
+        if error:
+            name = _cell(crop)
+            lines.append(f'Поле {number}: ' + (f'{name} - ' if name else '') + f'помилка: {error}')
+            lines.append('')
+            continue
+        head = f'Поле {number}: {_cell(crop).capitalize()}, {_cell(region)}, {_cell(yield_goal)} т/га'
+        has_area = not np.isnan(n_total)
+        lines.append(head + (f', {_cell(field_area)} га' if has_area else ''))
+        lines.append(f'   N {n:.1f} кг/га, P {p:.1f} кг/га, K {k:.1f} кг/га'
+                     + (f'; вапнування ~{lime:.0f} т/га' if lime else ''))
+        lines.append(f'   Добрива на 1 га: {n_form} {n_fert:.1f} кг, {p_form} {p_fert:.1f} кг, {k_form} {k_fert:.1f} кг')
+        if has_area:
+            lines.append(f'   Загальна потреба: {n_form} {n_total:.1f} кг, {p_form} {p_total:.1f} кг, '
+                         f'{k_form} {k_total:.1f} кг')
+        if not np.isnan(opt_cost):
+            lines.append(f'   Найдешевший набір добрив: ~{opt_cost:.0f} грн/га')
+        lines.append('')
+    return title, lines
+
+
+# Кількість частин PDF звіту для таблиці результатів
+def report_parts(result):
+    return -(-len(result) // REPORT_PART_ROWS)
+
+
+# Повна обробка файлу: читання, розрахунок і запис результату в тому ж форматі.
+# Повертає також таблицю результатів (для PDF звіту)
+def process_file(data: bytes, filename: str, optimize=False):
+    result = compute_frame(read_table(data, filename), optimize)
+    base = filename.rsplit('.', 1)[0]
+    buffer = io.BytesIO()
+    if filename.lower().endswith('.csv'):
+        result.to_csv(buffer, index=False, float_format='%.1f', encoding='utf-8-sig')
+        out_name = f'{base}_result.csv'
+    else:
+        result.round(1).to_excel(buffer, index=False)
+        out_name = f'{base}_result.xlsx'
+    errors = int((result['error'] != '').sum())
+    return buffer.getvalue(), out_name, len(result), errors, result
@@ -0,0 +1,358 @@
+# Офлайн-бенчмарк бота однією командою: запускає заглушку Bot API (fake_telegram),
+# бота окремим процесом з тимчасовим сховищем, проводить тисячі користувачів через
+# повний сценарій (включно з оплатами) і порівнює результати з базовими показниками.
+# Навантаження відкрите: користувачі приходять із заданою частотою (--rate), тож
+# затримка - це час обробки при цьому навантаженні, а не очікування в черзі, що
+# залежить від пропускної здатності машини. Пропускна здатність вимірюється окремо
+# закритим навантаженням (--rate 0 --concurrency N).
+# Код виходу 1 - є помилки, відмови через перевантаження або регресія відносно
+# benchmark_baseline.json.
+#
+#   python benchmark.py                     # прогін і перевірка регресій
+#   python benchmark.py --rate 0            # насичення: пропускна здатність (затримки не порівнюються)
+#   python benchmark.py --save-baseline     # записати поточні результати як базові
+#   python benchmark.py --mode webhook --users 5000
+#   python benchmark.py --shards 4          # супервізор з 4 шардами (порівнювати з --shards 1)
+#   python benchmark.py --pdf-isolation 300 # 300 одночасних запитів PDF, кожен - зі своїм звітом
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from fake_telegram import (FLOW, FakeBotAPI, make_value, percentile, polling_sender, print_report, run_load,
+                           run_user, webhook_sender)
+from pdf_reports import render_pdf
+from results import stored_pdf_text
+from storage import create_storage
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(BASE_DIR, 'benchmark_baseline.json')
+BOT_SCRIPT = os.path.join(BASE_DIR, 'telegram_fertilizer_bot.py')
+WEBHOOK_SECRET = 'benchmark'
+
+# Абсолютний запас поверх відносного допуску: шум планувальника і GC на малих значеннях
+LATENCY_SLACK_MS = 10.0
+MEMORY_SLACK_MB = 5.0
+# Частота появи користувачів за замовчуванням - приблизно третина пропускної здатності
+# одного процесу на еталонній машині (1 ядро), тож черга не накопичується
+RATE = 5.0
+
+
+# Резидентна пам'ять процесу, МБ (Linux); None, якщо недоступно
+def rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+# Сумарна пам'ять процесу і всіх його нащадків (шарди супервізора, пул PDF)
+def tree_rss_mb(pid):
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    # Поле після "(ім'я)" - стан, далі - pid батька
+                    parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+    tree = {pid}
+    changed = True
+    while changed:
+        children = {child for child, parent in parents.items() if parent in tree} - tree
+        tree |= children
+        changed = bool(children)
+    if rss_mb(pid) is None:
+        return None
+    return sum(rss_mb(member) or 0 for member in tree)
+
+
+def storage_url(tmp_dir):
+    return f'sqlite:///{os.path.join(tmp_dir, "bench.db")}'
+
+
+def start_bot(args, tmp_dir, extra_env=None):
+    env = dict(os.environ)
+    env.update({
+        'TOKEN': '123456:benchmark',
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{args.api_port}',
+        'BOT_MODE': args.mode,
+        'STORAGE_URL': storage_url(tmp_dir),
+        'FSM_STORAGE_URL': f'sqlite:///{os.path.join(tmp_dir, "bench_fsm.db")}',
+        'WEBHOOK_URL': '',
+        'WEBHOOK_PORT': str(args.webhook_port),
+        'WEBHOOK_SECRET': WEBHOOK_SECRET,
+        'WEBHOOK_WORKERS': '1',
+        'SHARD_WORKERS': str(args.shards),
+        # Без емуляції лімітів Telegram вимірюємо сам бот, тому черга відправки вимкнена
+        'SEND_RATE': os.environ.get('SEND_RATE', '30') if args.telegram_limits else '0',
+        # Віртуальні користувачі проходять кроки без пауз; обмеження лишається ввімкненим,
+        # але з лімітом, якого сценарій не досягає
+        'THROTTLE_LIMIT': '1000',
+    })
+    env.update(extra_env or {})
+    log = open(os.path.join(tmp_dir, 'bot.log'), 'wb')
+    return subprocess.Popen([sys.executable, BOT_SCRIPT], env=env, stdout=log, stderr=subprocess.STDOUT), log
+
+
+async def wait_ready(args, api, session, process, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('бот завершився під час запуску')
+        if args.mode == 'polling':
+            if api.calls.get('getupdates'):
+                return
+        else:
+            try:
+                async with session.get(f'http://127.0.0.1:{args.webhook_port}/health') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError('бот не запустився вчасно')
+
+
+def stop_bot(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+async def benchmark(args):
+    api = FakeBotAPI(flood_limits=(30, 1, 3) if args.telegram_limits else None)
+    await api.start('127.0.0.1', args.api_port)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        process, log = start_bot(args, tmp_dir)
+        try:
+            async with aiohttp.ClientSession() as session:
+                await wait_ready(args, api, session, process)
+                if args.mode == 'polling':
+                    send = polling_sender(api)
+                else:
+                    send = webhook_sender(session, f'http://127.0.0.1:{args.webhook_port}/webhook', WEBHOOK_SECRET)
+                # Прогрів: пул PDF, з'єднання, кеші - не входять у вимірювання
+                await run_load(api, send, args.warmup, args.concurrency, 1, args.timeout, 0.0, args.paid_every,
+                               args.rate)
+                api.rejected = api.flood_errors = 0
+                rss_before = tree_rss_mb(process.pid)
+                failed, updates, elapsed, latencies = await run_load(
+                    api, send, args.users, args.concurrency, 1_000_000, args.timeout, 0.0, args.paid_every,
+                    args.rate)
+                rss_after = tree_rss_mb(process.pid)
+        finally:
+            stop_bot(process)
+            log.close()
+            await api.stop()
+        if failed:
+            with open(os.path.join(tmp_dir, 'bot.log'), 'rb') as f:
+                print(f.read()[-3000:].decode('utf-8', 'replace'))
+    print_report(args.users, failed, updates, elapsed, latencies)
+    print(f'Відмов через перевантаження (сповіщення замість відповіді): {api.rejected}')
+    if args.telegram_limits:
+        print(f'Відповідей 429 від заглушки: {api.flood_errors}')
+    memory = None
+    if rss_before is not None and rss_after is not None:
+        memory = (rss_after - rss_before) / args.users * 10000
+        print(f'Пам\'ять: {rss_before:.1f} -> {rss_after:.1f} МБ, приріст {memory:.1f} МБ на 10 тис. користувачів')
+    return {
+        'mode': args.mode,
+        'shards': args.shards,
+        'users': args.users,
+        'rate': args.rate,
+        'concurrency': args.concurrency,
+        'paid_every': args.paid_every,
+        'failed': failed,
+        'updates': updates,
+        'rejected': api.rejected,
+        'flood_errors': api.flood_errors,
+        'updates_per_sec': round(updates / elapsed, 1),
+        'memory_mb_per_10k_users': round(memory, 1) if memory is not None else None,
+        'handlers': {
+            handler: {f'p{q}': round(percentile(values, q) * 1000, 2) for q in (50, 95, 99)}
+            for handler, values in latencies.items()
+        },
+    }
+
+
+# Звірка надісланих PDF з планами користувачів у сховищі бота (після зупинки бота).
+# Рендеринг детермінований (rl_config.invariant), тож документ, надісланий користувачу,
+# має побайтово збігатися зі звітом за його власним планом. Повертає перелік розбіжностей
+async def check_pdfs(documents, user_ids, url):
+    from reportlab import rl_config
+    rl_config.invariant = 1
+    store = create_storage(url)
+    await store.start()
+    problems = []
+    try:
+        for user_id in user_ids:
+            text = stored_pdf_text(await store.get_recommendation(user_id)) or ''
+            area = float(make_value('calculate_total_need', user_id))
+            received = documents.get(user_id, [])
+            if f'(на {area:.1f} га)' not in text:
+                problems.append(f'{user_id}: у збереженому плані немає площі {area:.1f} га')
+            elif len(received) != 1:
+                problems.append(f'{user_id}: отримано документів: {len(received)}')
+            elif received[0] != render_pdf(text):
+                problems.append(f'{user_id}: PDF не збігається зі звітом за планом користувача')
+    finally:
+        await store.close()
+    return problems
+
+
+# Ізоляція звітів PDF: users користувачів проходять розрахунок (кожен зі своєю врожайністю
+# і площею), потім усі одночасно натискають "Отримати PDF". Код виходу 1 - хоч один
+# користувач не отримав рівно один власний звіт
+async def pdf_isolation(args):
+    users = args.pdf_isolation
+    user_ids = range(1, users + 1)
+    api = FakeBotAPI(keep_documents=True)
+    await api.start('127.0.0.1', args.api_port)
+    latencies = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Рендеринг без дати і випадкового ID; черга PDF вміщує всі одночасні запити
+        process, log = start_bot(args, tmp_dir, {'RL_invariant': '1', 'PDF_QUEUE_SIZE': str(users)})
+        try:
+            async with aiohttp.ClientSession() as session:
+                await wait_ready(args, api, session, process)
+                if args.mode == 'polling':
+                    send = polling_sender(api)
+                else:
+                    send = webhook_sender(session, f'http://127.0.0.1:{args.webhook_port}/webhook', WEBHOOK_SECRET)
+                semaphore = asyncio.Semaphore(args.concurrency)
+                # Сценарій до запиту PDF і сам запит (кроки після нього тут не потрібні)
+                pdf_step = [handler for handler, *_ in FLOW].index('send_pdf')
+
+                async def calculate(user_id):
+                    async with semaphore:
+                        await run_user(api, send, user_id, FLOW[:pdf_step], latencies, args.timeout)
+
+                outcomes = await asyncio.gather(*(calculate(user_id) for user_id in user_ids), return_exceptions=True)
+                outcomes += await asyncio.gather(
+                    *(run_user(api, send, user_id, FLOW[pdf_step:pdf_step + 1], latencies, args.timeout) for user_id in user_ids),
+                    return_exceptions=True)
+        finally:
+            stop_bot(process)
+            log.close()
+            await api.stop()
+        problems = await check_pdfs(api.documents, user_ids, storage_url(tmp_dir))
+    failed = sum(isinstance(outcome, Exception) for outcome in outcomes)
+    for problem in problems[:20]:
+        print(f'❗ {problem}')
+    print(f'Одночасних запитів PDF: {users}, помилок: {failed}, відмов: {api.rejected}, '
+          f'розбіжностей: {len(problems)}, send_pdf p95 {percentile(latencies.get("send_pdf", []), 95) * 1000:.0f} мс')
+    if failed or api.rejected or problems:
+        return 1
+    print('✅ Кожен користувач отримав власний звіт')
+    return 0
+
+
+# Перелік регресій відносно базових показників (допуски - частки).
+# Пропускна здатність порівнюється лише під закритим навантаженням (під відкритим вона
+# дорівнює заданій частоті), затримки - лише під відкритим (під закритим це час у черзі)
+def compare(results, baseline, tolerance, latency_tolerance):
+    regressions = []
+    open_loop = bool(results.get('rate') and baseline.get('rate'))
+    closed_loop = not results.get('rate') and not baseline.get('rate')
+    if closed_loop and results['updates_per_sec'] < baseline['updates_per_sec'] * (1 - tolerance):
+        regressions.append(f'пропускна здатність {results["updates_per_sec"]} < '
+                           f'{baseline["updates_per_sec"]} оновлень/с')
+    if open_loop:
+        for handler, base in baseline['handlers'].items():
+            current = results['handlers'].get(handler)
+            if current is None:
+                continue
+            limit = base['p95'] * (1 + latency_tolerance) + LATENCY_SLACK_MS
+            if current['p95'] > limit:
+                regressions.append(f'{handler}: p95 {current["p95"]} мс > {limit:.1f} мс')
+    base_memory = baseline.get('memory_mb_per_10k_users')
+    memory = results['memory_mb_per_10k_users']
+    if base_memory is not None and memory is not None:
+        limit = max(base_memory, 0) * (1 + tolerance) + MEMORY_SLACK_MB
+        if memory > limit:
+            regressions.append(f'пам\'ять {memory} МБ на 10 тис. користувачів > {limit:.1f} МБ')
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк бота із заглушкою Bot API')
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling')
+    parser.add_argument('--users', type=int, default=1000, help='кількість користувачів у вимірюванні')
+    parser.add_argument('--warmup', type=int, default=100, help='користувачів для прогріву')
+    parser.add_argument('--rate', type=float, default=RATE,
+                        help='нових користувачів за секунду (відкрите навантаження); 0 - закрите, --concurrency')
+    parser.add_argument('--concurrency', type=int, default=200,
+                        help='одночасно активних користувачів при --rate 0')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='процесів-шардів бота під супервізором (SHARD_WORKERS)')
+    parser.add_argument('--paid-every', type=int, default=5, help='кожен N-й користувач оплачує другий розрахунок')
+    parser.add_argument('--timeout', type=float, default=60.0, help='тайм-аут очікування відповіді, с')
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--webhook-port', type=int, default=8080)
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help='емулювати ліміти Telegram (30/с, 1/с на чат) і ввімкнути чергу відправки')
+    parser.add_argument('--pdf-isolation', type=int, default=0, metavar='N',
+                        help='замість бенчмарку: N одночасних запитів PDF і звірка кожного звіту з планом користувача')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='допустиме погіршення пропускної здатності і пам\'яті (частка)')
+    parser.add_argument('--latency-tolerance', type=float, default=0.5,
+                        help='допустиме зростання p95 затримки (частка, плюс LATENCY_SLACK_MS)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='файл базових показників')
+    parser.add_argument('--save-baseline', action='store_true', help='записати результати як базові')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.pdf_isolation:
+        return asyncio.run(pdf_isolation(args))
+    results = asyncio.run(benchmark(args))
+    # Відмова через перевантаження - це користувач без звіту, тобто така сама помилка
+    if results['failed'] or results['rejected']:
+        print(f'❗ Користувачів з помилками: {results["failed"]}, відмов через перевантаження: {results["rejected"]}')
+        return 1
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f'Базові показники записано у {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print('Базових показників немає, порівняння пропущено (див. --save-baseline)')
+        return 0
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if bool(baseline.get('rate')) != bool(args.rate):
+        # Відкрите і закрите навантаження непорівнянні (різна кількість одночасних сесій)
+        print('Базові показники записано з іншим типом навантаження (--rate), порівняння пропущено')
+        return 0
+    if ((baseline['mode'], baseline['users'], baseline.get('rate', 0), baseline.get('shards', 1))
+            != (args.mode, args.users, args.rate, args.shards)
+            or not args.rate and baseline['concurrency'] != args.concurrency):
+        print('Увага: параметри прогону відрізняються від базових, порівняння орієнтовне')
+    regressions = compare(results, baseline, args.tolerance, args.latency_tolerance)
+    for regression in regressions:
+        print(f'❗ Регресія: {regression}')
+    if not regressions:
+        print('✅ Регресій відносно базових показників немає')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,107 @@
+# Обмежений кеш у пам'яті: LRU + час життя записів (TTL) + стеля пам'яті.
+#   - запис, до якого не зверталися ttl секунд, вважається застарілим (час рахується
+#     від останнього звернення, тож порядок LRU збігається з порядком старіння);
+#   - при перевищенні max_entries або max_bytes витісняються найдавніші записи;
+#   - розмір записів оцінюється наближено (size_of), витіснення рахуються за причиною.
+# Значення 0 для ttl і max_bytes вимикає відповідне обмеження.
+import os
+import sys
+import time
+from collections import OrderedDict
+
+
+# Наближений розмір значення в пам'яті, байт (рядки, числа і вкладені контейнери)
+def size_of(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list, set, frozenset)):
+        size += sum(size_of(item) for item in value)
+    elif isinstance(value, dict):
+        size += sum(size_of(key) + size_of(item) for key, item in value.items())
+    return size
+
+
+class BoundedCache:
+    def __init__(self, max_entries=10000, ttl=0.0, max_bytes=0, sizeof=size_of):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._entries = OrderedDict()  # ключ -> [значення, розмір, час останнього звернення]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = {'lru': 0, 'memory': 0, 'ttl': 0}
+
+    # Налаштування з оточення: {prefix}_SIZE, {prefix}_TTL, {prefix}_MAX_BYTES
+    @classmethod
+    def from_env(cls, prefix, max_entries=10000, ttl=0, max_bytes=0, **kwargs):
+        return cls(
+            max_entries=int(os.getenv(f'{prefix}_SIZE', max_entries)),
+            ttl=float(os.getenv(f'{prefix}_TTL', ttl)),
+            max_bytes=int(os.getenv(f'{prefix}_MAX_BYTES', max_bytes)),
+            **kwargs,
+        )
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        now = time.monotonic()
+        if self.ttl and now - entry[2] > self.ttl:
+            self._remove(key)
+            self.evictions['ttl'] += 1
+            self.misses += 1
+            return default
+        entry[2] = now
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        self._remove(key)
+        size = self.sizeof(key) + self.sizeof(value)
+        self._entries[key] = [value, size, time.monotonic()]
+        self.size += size
+        self._evict()
+
+    def pop(self, key, default=None):
+        entry = self._remove(key)
+        return default if entry is None else entry[0]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+        return entry
+
+    def _evict(self):
+        # Застарілі записи - на початку порядку LRU, тож перевірка зупиняється на першому свіжому
+        if self.ttl:
+            deadline = time.monotonic() - self.ttl
+            while self._entries:
+                key, entry = next(iter(self._entries.items()))
+                if entry[2] >= deadline:
+                    break
+                self._remove(key)
+                self.evictions['ttl'] += 1
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions['lru'] += 1
+        while self.max_bytes and self.size > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions['memory'] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': dict(self.evictions),
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,82 @@
+# Довідник культур (кнопка "🌱 Довідник культур").
+# Усі сторінки будуються один раз при імпорті з довідників рушія: потреба в елементах,
+# урожайність, розподіл по фазах і поправки до норм. Кожна сторінка зберігається разом
+# із готовою інлайн-клавіатурою (зареєстрованою в keyboards), тож перехід між сторінками -
+# одне звернення до словника за callback_data без жодних обчислень.
+from fertilizer_engine import (base_requirements, phase_distribution, national_yield_2024, zone_yield_factors,
+                               prev_crop_factors, soil_factors)
+from keyboards import inline_keyboard
+
+# callback_data кнопки головного меню та сторінок довідника (guide:<культура>:<сторінка>)
+START = 'crop_guide'
+PREFIX = 'guide:'
+INDEX = 'guide:index'
+NOOP = 'guide:noop'  # лічильник сторінок - кнопка без дії
+
+_ELEMENTS = ('Азот (N)', 'Фосфор (P2O5)', 'Калій (K2O)')
+_NUTRIENTS = ('Азот', 'Фосфор', 'Калій')
+_ZONES = {'Низька': 'низька', 'Середня': 'середня', 'Достатня': 'достатня'}
+
+_INDEX_TEXT = '🌱 Довідник культур\nОберіть культуру, щоб переглянути потребу в елементах, розподіл добрив і поправки до норм.'
+_title = '🌱 {} - {}\n\n'.format
+_element_line = '   - {}: {} кг\n'.format
+_factor_line = '   - {}: N {:.1f}, P {:.1f}, K {:.1f} кг\n'.format
+
+
+# Сторінка 1: потреба на 1 т урожаю і середня врожайність
+def _needs_page(crop):
+    base = base_requirements[crop]
+    text = 'На 1 т урожаю:\n' + ''.join(_element_line(name, amount) for name, amount in zip(_ELEMENTS, base))
+    avg_yield = national_yield_2024.get(crop)
+    if avg_yield:
+        text += f'\nСередня врожайність в Україні (2024): {avg_yield:.2f} т/га\n'
+        text += 'За зонами зволоження: ' + ', '.join(
+            f'{label} ~{avg_yield * zone_yield_factors[zone]:.1f}' for zone, label in _ZONES.items()) + ' т/га\n'
+        text += ('Потреба при середній врожайності: '
+                 + ', '.join(f'{name} {amount * avg_yield:.0f}' for name, amount in zip('NPK', base)) + ' кг/га')
+    return text
+
+
+# Сторінка 2: розподіл норми кожного елемента по фазах росту
+def _phases_page(crop):
+    lines = ['📈 Розподіл добрив по фазах росту:']
+    for name, phases in zip(_NUTRIENTS, phase_distribution[crop]):
+        lines.append(f'   - {name}: ' + '; '.join(f'{phase} {fraction * 100:.0f}%' for phase, fraction in phases))
+    return '\n'.join(lines)
+
+
+# Сторінка 3: норми на 1 т з поправками на попередник і тип ґрунту
+def _factors_page(crop):
+    base = base_requirements[crop]
+    text = '♻️ Норми на 1 т урожаю залежно від попередника:\n'
+    text += ''.join(_factor_line(name, *(b * f for b, f in zip(base, factors)))
+                    for name, factors in prev_crop_factors.items())
+    text += '\n🟤 Залежно від типу ґрунту:\n'
+    text += ''.join(_factor_line(name.capitalize(), *(b * f for b, f in zip(base, factors)))
+                    for name, factors in soil_factors.items())
+    return text.rstrip('\n')
+
+
+_pages = (('потреба в елементах', _needs_page), ('розподіл по фазах', _phases_page), ('поправки до норм', _factors_page))
+
+
+# Сторінки довідника: callback_data -> (текст, клавіатура)
+def _build():
+    crops = list(base_requirements)
+    rows = [[(crop.capitalize(), f'{PREFIX}{i}:0') for i, crop in enumerate(crops[start:start + 2], start)]
+            for start in range(0, len(crops), 2)]
+    pages = {INDEX: (_INDEX_TEXT, inline_keyboard(rows))}
+    back = [('📚 До списку культур', INDEX)]
+    for i, crop in enumerate(crops):
+        for number, (title, render) in enumerate(_pages):
+            navigation = [(f'{number + 1}/{len(_pages)}', NOOP)]
+            if number > 0:
+                navigation.insert(0, ('◀️', f'{PREFIX}{i}:{number - 1}'))
+            if number < len(_pages) - 1:
+                navigation.append(('▶️', f'{PREFIX}{i}:{number + 1}'))
+            pages[f'{PREFIX}{i}:{number}'] = (_title(crop.capitalize(), title) + render(crop),
+                                              inline_keyboard([navigation, back]))
+    return pages
+
+
+pages = _build()
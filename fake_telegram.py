@@ -0,0 +1,339 @@
+# Локальний тестовий стенд Telegram для офлайн-навантажувального тестування.
+# FakeBotAPI - заглушка Bot API (бот підключається до неї через TELEGRAM_API_URL),
+# а драйвер надсилає оновлення від імені багатьох користувачів (на webhook бота
+# або у чергу getUpdates для режиму polling) і вимірює час до відповіді бота.
+# Повний прогін з порівнянням з базовими показниками - benchmark.py.
+#
+# Приклад:
+#   BOT_MODE=webhook TELEGRAM_API_URL=http://127.0.0.1:8081 WEBHOOK_SECRET=s \
+#       python telegram_fertilizer_bot.py
+#   python fake_telegram.py --webhook http://127.0.0.1:8080/webhook --secret s --users 200
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+import aiohttp
+from aiohttp import web
+
+from send_queue import TokenBucket
+
+# Сценарій одного розрахунку: (хендлер, тип оновлення, текст або callback_data,
+# скільки відповідей бот надсилає). Значення None підставляє make_value для користувача.
+FLOW = [
+    ('cmd_start', 'message', '/start', 1),
+    ('start_calculation', 'callback', 'calc_fertilizer', 1),
+    ('select_crop', 'message', 'Пшениця', 1),
+    ('select_prev_crop', 'message', 'Бобові', 1),
+    ('select_region', 'message', 'Київська', 1),
+    ('input_yield', 'message', None, 1),
+    ('select_soil', 'message', 'Чорнозем', 1),
+    ('compute_recommendations', 'message', '6.2', 1),
+    ('change_or_continue', 'message', 'Змінити азот', 1),
+    ('choose_n_form', 'message', 'КАС (32% N)', 1),
+    ('change_or_continue', 'message', 'Продовжити', 1),
+    ('calculate_total_need', 'message', None, 1),
+    ('send_pdf', 'callback', 'get_pdf', 1),
+    ('start_reminders', 'callback', 'remind', 1),
+    ('schedule_reminders', 'message', 'Сьогодні', 1),
+]
+
+# Повторний розрахунок після вичерпання безкоштовного: рахунок, передперевірка,
+# успішна оплата (бот відповідає підтвердженням з клавіатурою культур), далі - як у FLOW
+PAID_FLOW = [
+    ('send_payment_invoice', 'callback', 'calc_fertilizer', 1),
+    ('process_pre_checkout', 'pre_checkout', 'calc_payment', 1),
+    ('payment_successful', 'payment', 'calc_payment', 1),
+] + FLOW[2:]
+
+# Методи, що надсилають повідомлення у чат (їх вважаємо відповіддю бота)
+CHAT_METHODS = {'sendmessage', 'senddocument', 'sendinvoice'}
+
+
+# Значення, що відрізняються між користувачами (інакше всі звіти PDF однакові)
+def make_value(handler, user_id):
+    if handler == 'input_yield':
+        return f'{3 + user_id % 60 / 10:.1f}'
+    return str(10 + user_id % 500)
+
+
+# Заглушка Bot API: приймає /bot<токен>/<метод>, повертає правдоподібні результати.
+# flood_limits=(загальна швидкість, швидкість на чат, запас на чат) емулює обмеження
+# Telegram: повідомлення понад ліміт отримують 429 з retry_after. keep_documents -
+# зберігати вміст надісланих документів (documents: chat_id -> [байти, ...]).
+class FakeBotAPI:
+    def __init__(self, flood_limits=None, keep_documents=False):
+        self.calls = {}            # метод -> кількість викликів
+        self._replies = {}         # chat_id -> asyncio.Queue з часом відповіді
+        self._ids = itertools.count(1)
+        self._updates = []         # черга для getUpdates (режим polling)
+        self._updates_ready = asyncio.Event()
+        self.pre_checkout = {}     # pre_checkout_query_id -> chat_id платника
+        self.callbacks = {}        # callback_query_id -> chat_id
+        self.rejected = 0          # відмов через перевантаження (сповіщення замість відповіді)
+        self.flood_limits = flood_limits
+        self.flood_errors = 0      # відповідей 429
+        self._flood_global = None
+        self._flood_chats = {}
+        self.documents = {} if keep_documents else None
+        self._files = {}           # file_id -> байти документа (лише з keep_documents)
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_route('*', '/bot{token}/{method}', self.handle)
+
+    def replies(self, chat_id):
+        return self._replies.setdefault(chat_id, asyncio.Queue())
+
+    # Оновлення для бота в режимі polling
+    def push_update(self, update):
+        self._updates.append(update)
+        self._updates_ready.set()
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        if offset:
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+        if not self._updates:
+            self._updates_ready.clear()
+            try:
+                await asyncio.wait_for(self._updates_ready.wait(), float(params.get('timeout', 0)))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(params.get('limit', 100))]
+
+    # Чи перевищує повідомлення ліміти (невеликий запас на неточність таймерів)
+    def _flooded(self, chat_id):
+        rate, chat_rate, chat_burst = self.flood_limits
+        now = time.monotonic()
+        if self._flood_global is None:
+            self._flood_global = TokenBucket(rate, rate + 1, now)
+        chat = self._flood_chats.get(chat_id)
+        if chat is None:
+            chat = self._flood_chats[chat_id] = TokenBucket(chat_rate, chat_burst + 1, now)
+        if self._flood_global.delay(now) or chat.delay(now):
+            return True
+        self._flood_global.take()
+        chat.take()
+        return False
+
+    # Вміст документа: завантажений файл (aiogram передає його окремою частиною
+    # запиту, посилаючись на неї через attach://) або раніше виданий file_id
+    def _keep_document(self, chat_id, params, file_id):
+        document = params.get('document')
+        if document.startswith('attach://'):
+            content = params[document[len('attach://'):]].file.read()
+        else:
+            content = self._files.get(document)
+        self._files[file_id] = content
+        self.documents.setdefault(chat_id, []).append(content)
+
+    def _message(self, chat_id, **extra):
+        return dict(message_id=next(self._ids), date=int(time.time()),
+                    chat={'id': chat_id, 'type': 'private'}, **extra)
+
+    async def handle(self, request):
+        method = request.match_info['method'].lower()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post()) if request.can_read_body else {}
+        chat_id = int(params['chat_id']) if 'chat_id' in params else None
+        if self.flood_limits and method in CHAT_METHODS and self._flooded(chat_id):
+            self.flood_errors += 1
+            return web.json_response({'ok': False, 'error_code': 429, 'parameters': {'retry_after': 1},
+                                      'description': 'Too Many Requests: retry after 1'})
+        if method == 'getupdates':
+            result = await self._get_updates(params)
+        elif method == 'getme':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        elif method == 'sendmessage':
+            result = self._message(chat_id, text=params.get('text', ''))
+        elif method == 'senddocument':
+            file_id = f'file{next(self._ids)}'
+            if self.documents is not None:
+                self._keep_document(chat_id, params, file_id)
+            result = self._message(chat_id, document={'file_id': file_id, 'file_unique_id': file_id})
+        elif method == 'sendinvoice':
+            result = self._message(chat_id, invoice={'title': params.get('title', ''), 'description': '',
+                                                     'start_parameter': '', 'currency': 'USD', 'total_amount': 0})
+        elif method == 'answercallbackquery':
+            # Сповіщення show_alert без подальшої відповіді - відмова (наприклад, черга PDF повна)
+            chat_id = self.callbacks.pop(params.get('callback_query_id'), None)
+            if chat_id is not None and params.get('show_alert') == 'true':
+                self.rejected += 1
+                self.replies(chat_id).put_nowait(time.perf_counter())
+            result = True
+        elif method == 'answerprecheckoutquery':
+            # Відповідь на передперевірку зараховуємо як відповідь у чат платника
+            chat_id = self.pre_checkout.pop(params.get('pre_checkout_query_id'), None)
+            if chat_id is not None:
+                self.replies(chat_id).put_nowait(time.perf_counter())
+            result = True
+        else:
+            result = True
+        if method in CHAT_METHODS and chat_id is not None:
+            self.replies(chat_id).put_nowait(time.perf_counter())
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self, host='127.0.0.1', port=8081):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+_update_ids = itertools.count(1)
+
+
+# Оновлення Telegram у вигляді словника (як його надсилає сервер Telegram)
+def make_update(kind, user_id, value):
+    update_id = next(_update_ids)
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+    chat = {'id': user_id, 'type': 'private'}
+    if kind == 'callback':
+        # Кожна кнопка - на окремому повідомленні, як у справжньому діалозі (інакше
+        # повторний розрахунок за секунду виглядав би як подвійне натискання)
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'from': user, 'chat_instance': str(user_id), 'data': value,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'text': '-'}}}
+    if kind == 'pre_checkout':
+        return {'update_id': update_id, 'pre_checkout_query': {
+            'id': str(update_id), 'from': user, 'currency': 'USD', 'total_amount': 1000,
+            'invoice_payload': value}}
+    message = {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': user}
+    if kind == 'payment':
+        message['successful_payment'] = {
+            'currency': 'USD', 'total_amount': 1000, 'invoice_payload': value,
+            'telegram_payment_charge_id': f'tg{update_id}', 'provider_payment_charge_id': f'pr{update_id}'}
+    else:
+        message['text'] = value
+    return {'update_id': update_id, 'message': message}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+# Доставка оновлень боту: POST на webhook або черга getUpdates заглушки
+def webhook_sender(session, url, secret):
+    headers = {'Content-Type': 'application/json'}
+    if secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+
+    async def send(update):
+        async with session.post(url, data=json.dumps(update), headers=headers) as response:
+            response.raise_for_status()
+    return send
+
+
+def polling_sender(api):
+    async def send(update):
+        api.push_update(update)
+    return send
+
+
+# Один користувач проходить сценарій: кожен наступний крок - після відповіді бота.
+# latencies: хендлер -> список затримок, с
+async def run_user(api, send, user_id, flow, latencies, timeout, think_time=0.0):
+    replies = api.replies(user_id)
+    for step, (handler, kind, value, expected) in enumerate(flow):
+        if step and think_time:
+            # Пауза користувача між кроками
+            await asyncio.sleep(think_time)
+        update = make_update(kind, user_id, value if value is not None else make_value(handler, user_id))
+        if kind == 'pre_checkout':
+            api.pre_checkout[update['pre_checkout_query']['id']] = user_id
+        elif kind == 'callback':
+            api.callbacks[update['callback_query']['id']] = user_id
+        started = time.perf_counter()
+        await send(update)
+        finished = started
+        for _ in range(expected):
+            finished = await asyncio.wait_for(replies.get(), timeout)
+        latencies.setdefault(handler, []).append(finished - started)
+
+
+# Прогін користувачів user_offset .. user_offset + users - 1; кожен paid_every-й
+# після безкоштовного розрахунку оплачує і проходить ще один.
+# Закрите навантаження (rate=0): одночасно не більше concurrency користувачів, наступний
+# починає, щойно закінчив попередній - бот завжди насичений, затримка включає чергу.
+# Відкрите (rate > 0): користувачі приходять рівномірно, rate за секунду, незалежно від
+# швидкості бота - затримка відповідає часу обробки при заданому навантаженні.
+# Повертає (кількість помилок, кількість оновлень, тривалість, затримки за хендлерами)
+async def run_load(api, send, users, concurrency, user_offset, timeout, think_time=0.0, paid_every=0, rate=0.0):
+    latencies = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+
+    async def scenario(user_id):
+        await run_user(api, send, user_id, FLOW, latencies, timeout, think_time)
+        if paid_every and user_id % paid_every == 0:
+            await run_user(api, send, user_id, PAID_FLOW, latencies, timeout, think_time)
+
+    async def limited(index):
+        if rate:
+            await asyncio.sleep(max(0.0, started_at + index / rate - loop.time()))
+            await scenario(user_offset + index)
+            return
+        async with semaphore:
+            await scenario(user_offset + index)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(limited(i) for i in range(users)), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    failed = sum(isinstance(r, Exception) for r in results)
+    updates = sum(len(v) for v in latencies.values())
+    return failed, updates, elapsed, latencies
+
+
+def print_report(users, failed, updates, elapsed, latencies):
+    print(f'Користувачів: {users}, помилок: {failed}, оновлень: {updates}, '
+          f'{updates / elapsed:.0f} оновлень/с за {elapsed:.1f} с')
+    for handler, values in latencies.items():
+        print(f'{handler:24} n {len(values):6}  p50 {percentile(values, 50) * 1000:7.1f} мс  '
+              f'p95 {percentile(values, 95) * 1000:7.1f} мс  p99 {percentile(values, 99) * 1000:7.1f} мс')
+
+
+async def run_webhook_load(url, secret, users, concurrency, api_host, api_port, user_offset, timeout,
+                           think_time=0.0, paid_every=0, rate=0.0):
+    api = FakeBotAPI()
+    await api.start(api_host, api_port)
+    try:
+        async with aiohttp.ClientSession() as session:
+            failed, updates, elapsed, latencies = await run_load(
+                api, webhook_sender(session, url, secret), users, concurrency, user_offset, timeout,
+                think_time, paid_every, rate)
+    finally:
+        await api.stop()
+    print_report(users, failed, updates, elapsed, latencies)
+    return failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Офлайн-навантаження webhook бота через заглушку Bot API')
+    parser.add_argument('--webhook', default='http://127.0.0.1:8080/webhook', help='адреса webhook бота')
+    parser.add_argument('--secret', default='', help='WEBHOOK_SECRET бота')
+    parser.add_argument('--users', type=int, default=100, help='кількість користувачів')
+    parser.add_argument('--concurrency', type=int, default=100, help='одночасно активних користувачів')
+    parser.add_argument('--api-host', default='127.0.0.1')
+    parser.add_argument('--api-port', type=int, default=8081, help='порт заглушки Bot API (TELEGRAM_API_URL бота)')
+    parser.add_argument('--user-offset', type=int, default=int(time.time()) % 1_000_000 * 1000,
+                        help='перший ID користувача (нові ID - новий безкоштовний розрахунок)')
+    parser.add_argument('--timeout', type=float, default=30.0, help='тайм-аут очікування відповіді, с')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='нових користувачів за секунду (відкрите навантаження; 0 - за --concurrency)')
+    parser.add_argument('--think-time', type=float, default=0.0, help='пауза користувача між кроками, с')
+    parser.add_argument('--paid-every', type=int, default=0,
+                        help='кожен N-й користувач оплачує другий розрахунок (0 - без оплат)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    raise SystemExit(1 if asyncio.run(run_webhook_load(
+        args.webhook, args.secret, args.users, args.concurrency, args.api_host, args.api_port,
+        args.user_offset, args.timeout, args.think_time, args.paid_every, args.rate)) else 0)
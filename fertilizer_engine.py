@@ -0,0 +1,268 @@
+# Рушій розрахунку норм мінерального живлення (NPK).
+# Модуль не залежить від aiogram: усі коефіцієнти зібрані в незмінні таблиці
+# один раз під час імпорту, тож розрахунок для одного поля - це кілька
+# звернень до словників і множень, без побудови структур на кожне повідомлення.
+import mmap
+import os
+from array import array
+from types import MappingProxyType
+from typing import NamedTuple, Optional, Tuple
+
+# Базові вимоги до елементів (кг елемента на 1 т урожаю): (N, P2O5, K2O)
+base_requirements = MappingProxyType({
+    'пшениця': (30, 10, 20),
+    'кукурудза': (25, 12, 25),
+    'соняшник': (42, 18, 85),
+    'соя': (15, 20, 30),
+    'ріпак': (50, 15, 40),
+    'ячмінь': (25, 10, 20),
+})
+
+# Поправки (N, P, K) залежно від попередника
+prev_crop_factors = MappingProxyType({
+    'Зернові': (1.0, 1.0, 1.0),
+    'Бобові': (0.8, 1.0, 1.0),       # після бобових залишається більше азоту в ґрунті
+    'Технічні': (1.1, 1.1, 1.1),     # після технічних культур можливе виснаження ґрунту
+    'Овочі': (1.1, 1.1, 1.1),        # так само після овочевих
+    'Чистий пар': (0.9, 1.0, 1.0),   # після пару потрібне трохи менше азоту
+})
+
+# Поправки залежно від зони зволоження
+moisture_factors = MappingProxyType({
+    'Низька': (0.9, 0.9, 0.9),       # у посушливих умовах зменшуємо норми (~ -10%)
+    'Середня': (1.0, 1.0, 1.0),
+    'Достатня': (1.1, 1.1, 1.1),     # у вологих умовах збільшуємо норми (~ +10%)
+})
+
+# Поправки залежно від типу ґрунту (ключі у нижньому регістрі)
+soil_factors = MappingProxyType({
+    'піщаний': (1.1, 1.1, 1.1),      # легкі ґрунти гірше утримують елементи
+    'супіщаний': (1.1, 1.1, 1.1),
+    'чорнозем': (0.9, 0.9, 0.9),     # частина потреби забезпечиться родючим ґрунтом
+    'глинистий': (0.95, 0.95, 0.95),
+    'сірозем': (0.95, 0.95, 0.95),
+})
+
+# Класифікація регіонів за зонами зволоження (на основі історичних даних опадів)
+region_to_zone = MappingProxyType({
+    # Низька зволоженість (південь, частково схід)
+    'Одеська': 'Низька', 'Миколаївська': 'Низька', 'Херсонська': 'Низька',
+    'Запорізька': 'Низька', 'Донецька': 'Низька', 'Луганська': 'Низька',
+    'Дніпропетровська': 'Низька', 'Кіровоградська': 'Низька',
+    # Середня зволоженість (центр, частково схід/захід)
+    'Харківська': 'Середня', 'Полтавська': 'Середня', 'Черкаська': 'Середня',
+    'Київська': 'Середня', 'Тернопільська': 'Середня', 'Хмельницька': 'Середня',
+    'Вінницька': 'Середня',
+    # Достатня зволоженість (захід, північ)
+    'Львівська': 'Достатня', 'Івано-Франківська': 'Достатня', 'Закарпатська': 'Достатня',
+    'Чернівецька': 'Достатня', 'Волинська': 'Достатня', 'Рівненська': 'Достатня',
+    'Житомирська': 'Достатня', 'Чернігівська': 'Достатня', 'Сумська': 'Достатня'
+})
+# Примітка: Регіони, не вказані у словнику, за замовчуванням вважаються середньозволоженими.
+
+# Середня врожайність по Україні (Мінагрополітики, 2024), т/га
+national_yield_2024 = MappingProxyType({
+    'пшениця': 4.47,    # 44.7 ц/га
+    'кукурудза': 6.40,  # 64.0 ц/га
+    'соняшник': 2.30,   # ~23 ц/га
+    'ріпак': 2.74,      # 27.4 ц/га
+    'ячмінь': 3.81,     # 38.1 ц/га
+    'соя': 2.28         # 22.8 ц/га
+})
+
+# Відхилення регіональної врожайності від середньої по країні за зоною зволоження
+zone_yield_factors = MappingProxyType({
+    'Низька': 0.7,      # посушливий регіон ~30% нижче середнього
+    'Середня': 1.0,
+    'Достатня': 1.3,    # вологий регіон ~30% вище середнього
+})
+
+# Розподіл добрив по фазах росту: для N, P, K - кортеж пар (фаза, частка норми)
+_PRESOWING = (('перед сівбою', 1.0),)
+phase_distribution = MappingProxyType({
+    'пшениця': ((('перед сівбою', 0.5), ('у фазі кущіння', 0.5)), _PRESOWING, _PRESOWING),
+    'кукурудза': ((('перед сівбою', 0.5), ('у фазі 6-8 листків', 0.5)), _PRESOWING, _PRESOWING),
+    'соняшник': ((('перед сівбою', 0.7), ('на початку бутонізації', 0.3)), _PRESOWING, _PRESOWING),
+    'соя': ((('перед сівбою', 0.5), ('на початку цвітіння', 0.5)), _PRESOWING, _PRESOWING),
+    'ріпак': ((('перед сівбою', 0.5), ('на початку весняної вегетації', 0.5)), _PRESOWING, _PRESOWING),
+    'ячмінь': ((('перед сівбою', 0.5), ('у фазі кущіння', 0.5)), _PRESOWING, _PRESOWING),
+})
+
+# Орієнтовний початок фази, днів від сівби (для нагадувань про внесення)
+phase_days = MappingProxyType({
+    'перед сівбою': -3,
+    'у фазі кущіння': 25,
+    'у фазі 6-8 листків': 35,
+    'на початку бутонізації': 40,
+    'на початку цвітіння': 45,
+    'на початку весняної вегетації': 200,   # озимий ріпак: від серпневої сівби до березня
+})
+
+# Форми добрив і вміст діючої речовини
+n_forms = MappingProxyType({
+    'Амміачна селітра (34% N)': 0.34,
+    'Карбамід (46% N)': 0.46,
+    'КАС (32% N)': 0.32,
+})
+p_forms = MappingProxyType({
+    'Діамофосфат (DAP, 46% P2O5)': 0.46,
+    'Суперфосфат (46% P2O5)': 0.46,
+})
+k_forms = MappingProxyType({
+    'Калій хлористий (KCl, 60% K2O)': 0.60,
+    'Калій сульфат (50% K2O)': 0.50,
+})
+
+# Повний вміст елементів у формах добрив (N, P2O5, K2O) - для підбору найдешевшого
+# набору добрив; діамофосфат (18-46-0) дає ще й азот
+product_nutrients = MappingProxyType({
+    'Амміачна селітра (34% N)': (0.34, 0.0, 0.0),
+    'Карбамід (46% N)': (0.46, 0.0, 0.0),
+    'КАС (32% N)': (0.32, 0.0, 0.0),
+    'Діамофосфат (DAP, 46% P2O5)': (0.18, 0.46, 0.0),
+    'Суперфосфат (46% P2O5)': (0.0, 0.46, 0.0),
+    'Калій хлористий (KCl, 60% K2O)': (0.0, 0.0, 0.60),
+    'Калій сульфат (50% K2O)': (0.0, 0.0, 0.50),
+})
+
+# Форми добрив за замовчуванням: азотна залежить від зони зволоження
+DEFAULT_P_FORM = 'Діамофосфат (DAP, 46% P2O5)'
+DEFAULT_K_FORM = 'Калій хлористий (KCl, 60% K2O)'
+default_n_form = MappingProxyType({
+    'Низька': 'Амміачна селітра (34% N)',
+    'Середня': 'Карбамід (46% N)',
+    'Достатня': 'Карбамід (46% N)',
+})
+
+_NEUTRAL = (1.0, 1.0, 1.0)
+
+
+# Норми елементів на 1 т урожаю для однієї комбінації умов
+def _rates(crop, prev_crop, moisture, soil_type):
+    base = base_requirements[crop]
+    prev = prev_crop_factors.get(prev_crop, _NEUTRAL)
+    zone = moisture_factors.get(moisture, _NEUTRAL)
+    soil = soil_factors.get(soil_type, _NEUTRAL)
+    # Порядок множення той самий, що й у початковому ланцюжку умов
+    return tuple(base[i] * (1.0 * prev[i] * zone[i] * soil[i]) for i in range(3))
+
+
+# Індекси значень по осях таблиці рекомендацій (культура, попередник, зона, ґрунт)
+crop_index = MappingProxyType({crop: i for i, crop in enumerate(base_requirements)})
+prev_crop_index = MappingProxyType({prev_crop: i for i, prev_crop in enumerate(prev_crop_factors)})
+zone_index = MappingProxyType({zone: i for i, zone in enumerate(moisture_factors)})
+soil_index = MappingProxyType({soil: i for i, soil in enumerate(soil_factors)})
+n_form_names = tuple(n_forms)
+
+# Поля одного запису таблиці: N, P, K на 1 т урожаю, середня врожайність у зоні,
+# індекс азотної форми за замовчуванням (у n_form_names)
+TABLE_FIELDS = ('N_rate', 'P_rate', 'K_rate', 'avg_yield', 'n_form')
+TABLE_SHAPE = (len(crop_index), len(prev_crop_index), len(zone_index), len(soil_index), len(TABLE_FIELDS))
+
+
+# Попередньо обчислена таблиця для всіх дискретних комбінацій умов у одному
+# суцільному масиві double (450 записів, ~18 КБ). Масив не змінюється після
+# імпорту, тож воркери, створені через fork, використовують ті самі сторінки пам'яті.
+def _build_table():
+    table = array('d')
+    for crop in base_requirements:
+        for prev_crop in prev_crop_factors:
+            for moisture in moisture_factors:
+                avg_yield = national_yield_2024[crop] * zone_yield_factors[moisture]
+                n_form = n_form_names.index(default_n_form[moisture])
+                for soil_type in soil_factors:
+                    table.extend(_rates(crop, prev_crop, moisture, soil_type))
+                    table.extend((avg_yield, n_form))
+    return table
+
+
+# Таблиця, записана супервізором у файл (FERT_TABLE_PATH), відображається в пам'ять
+# лише для читання: процеси-воркери супервізора ділять одну копію сторінок
+def _map_table(path):
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    table = memoryview(mapped).cast('d')
+    if len(table) != TABLE_SHAPE[0] * TABLE_SHAPE[1] * TABLE_SHAPE[2] * TABLE_SHAPE[3] * TABLE_SHAPE[4]:
+        raise ValueError(f'Розмір таблиці у {path} не відповідає TABLE_SHAPE')
+    return table
+
+
+lookup_table = _map_table(os.environ['FERT_TABLE_PATH']) if os.getenv('FERT_TABLE_PATH') else _build_table()
+
+
+# Зміщення запису кожної комбінації в lookup_table: одне звернення до словника
+# замість обчислення індексу з чотирьох осей
+_offsets = {
+    key: i * TABLE_SHAPE[4]
+    for i, key in enumerate((crop, prev_crop, moisture, soil_type)
+                            for crop in base_requirements
+                            for prev_crop in prev_crop_factors
+                            for moisture in moisture_factors
+                            for soil_type in soil_factors)
+}
+
+
+# Зміщення запису комбінації в lookup_table; None, якщо значення немає в таблиці
+def table_offset(crop, prev_crop, moisture, soil_type):
+    return _offsets.get((crop, prev_crop, moisture, soil_type))
+
+
+# Результат розрахунку для одного поля
+class Recommendation(NamedTuple):
+    crop: str
+    yield_goal: float
+    ph: float
+    N_per_ha: float
+    P_per_ha: float
+    K_per_ha: float
+    avg_yield: Optional[float]     # орієнтовна середня врожайність у зоні, т/га
+    lime_t_per_ha: float           # рекомендована норма вапна, т/га (0 - не потрібно)
+    phases: Tuple[tuple, tuple, tuple]
+    forms: Tuple[tuple, tuple, tuple]  # форми добрив за замовчуванням, як у default_forms
+
+
+# Рекомендована норма вапна за pH ґрунту
+def lime_rate(ph):
+    if ph < 5.0:
+        return 2.0
+    if ph < 5.5:
+        return 1.0
+    return 0.0
+
+
+# Форми добрив за замовчуванням: ((N_form, N_content), (P_form, P_content), (K_form, K_content))
+def default_forms(moisture):
+    n_form = default_n_form.get(moisture, default_n_form['Середня'])
+    return ((n_form, n_forms[n_form]),
+            (DEFAULT_P_FORM, p_forms[DEFAULT_P_FORM]),
+            (DEFAULT_K_FORM, k_forms[DEFAULT_K_FORM]))
+
+
+# Форми добрив за замовчуванням за індексом азотної форми з таблиці
+_forms_by_n = tuple(
+    ((name, n_forms[name]), (DEFAULT_P_FORM, p_forms[DEFAULT_P_FORM]), (DEFAULT_K_FORM, k_forms[DEFAULT_K_FORM]))
+    for name in n_form_names
+)
+
+
+# Розрахунок потреби в елементах на 1 га; None для невідомої культури.
+# Для відомих комбінацій - одне звернення до таблиці і множення на врожайність.
+def compute(crop, prev_crop, moisture, soil_type, yield_goal, ph):
+    offset = table_offset(crop, prev_crop, moisture, soil_type)
+    if offset is not None:
+        N_rate, P_rate, K_rate, avg_yield, n_form = lookup_table[offset:offset + TABLE_SHAPE[4]]
+        forms = _forms_by_n[int(n_form)]
+    elif crop not in base_requirements:
+        return None
+    else:
+        # Значення поза довідниками - нейтральні поправки, як і раніше
+        N_rate, P_rate, K_rate = _rates(crop, prev_crop, moisture, soil_type)
+        avg_yield = None
+        if crop in national_yield_2024:
+            avg_yield = national_yield_2024[crop] * zone_yield_factors.get(moisture, 1.0)
+        forms = default_forms(moisture)
+    return Recommendation(
+        crop, yield_goal, ph,
+        N_rate * yield_goal, P_rate * yield_goal, K_rate * yield_goal,
+        avg_yield, lime_rate(ph), phase_distribution[crop], forms,
+    )
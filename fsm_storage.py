@@ -0,0 +1,236 @@
+# Постійне сховище станів FSM (SQLite або Redis) для aiogram.
+# Стан і дані користувача зберігаються одним компактним записом
+# (JSON-масив [стан, дані]), тож їх читання - це один запит до сховища.
+# FSMSessionIsolation відкриває на час обробки оновлення сесію: перше звернення
+# завантажує запис, усі get_state/get_data/set_state/update_data у хендлерах
+# працюють з ним у пам'яті, а змінений запис записується один раз наприкінці.
+# Покинуті діалоги не зберігаються вічно: запис, що не змінювався ttl секунд,
+# вважається відсутнім і видаляється (SQLite - періодичним очищенням, Redis - EXPIRE).
+import asyncio
+import json
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DEFAULT_DESTINY
+
+# Завантажені записи поточного оновлення: ключ -> _Record
+_session = ContextVar('fsm_session', default=None)
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'dirty')
+
+    def __init__(self, state=None, data=None):
+        self.state = state
+        self.data = data or {}
+        self.dirty = False
+
+
+def _key(key):
+    parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+    if key.thread_id is not None or key.business_connection_id is not None or key.destiny != DEFAULT_DESTINY:
+        parts += [str(key.thread_id or ''), key.business_connection_id or '', key.destiny]
+    return ':'.join(parts)
+
+
+def _dumps(state, data):
+    return json.dumps([state, data], ensure_ascii=False, separators=(',', ':'))
+
+
+def _loads(value):
+    if value is None:
+        return None, {}
+    state, data = json.loads(value)
+    return state, data
+
+
+class RecordStorage(BaseStorage):
+    # Бекенд реалізує три операції над записом за рядковим ключем
+    async def _load(self, key):
+        raise NotImplementedError
+
+    async def _save(self, key, value):
+        raise NotImplementedError
+
+    async def _delete(self, key):
+        raise NotImplementedError
+
+    async def _record(self, key):
+        session = _session.get()
+        str_key = _key(key)
+        if session is not None and str_key in session:
+            return str_key, session[str_key]
+        record = _Record(*_loads(await self._load(str_key)))
+        if session is not None:
+            session[str_key] = record
+        return str_key, record
+
+    async def _write(self, str_key, record):
+        if record.state is None and not record.data:
+            await self._delete(str_key)
+        else:
+            await self._save(str_key, _dumps(record.state, record.data))
+        record.dirty = False
+
+    # У межах сесії запис лише позначається зміненим; без сесії - записується одразу
+    async def _changed(self, str_key, record):
+        if _session.get() is not None:
+            record.dirty = True
+        else:
+            await self._write(str_key, record)
+
+    async def set_state(self, key, state=None):
+        str_key, record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        await self._changed(str_key, record)
+
+    async def get_state(self, key):
+        _, record = await self._record(key)
+        return record.state
+
+    async def set_data(self, key, data):
+        str_key, record = await self._record(key)
+        record.data = dict(data)
+        await self._changed(str_key, record)
+
+    async def get_data(self, key):
+        _, record = await self._record(key)
+        return dict(record.data)
+
+    # Запис змінених за сесію записів
+    async def commit(self, session):
+        for str_key, record in session.items():
+            if record.dirty:
+                await self._write(str_key, record)
+
+
+class SQLiteFSMStorage(RecordStorage):
+    def __init__(self, path, ttl=0, sweep_interval=60.0):
+        self.path = path
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fsm-sqlite')
+        self._conn = None
+        self._swept = time.monotonic()
+        self.expired = 0  # видалено застарілих записів
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                               'updated_at REAL NOT NULL DEFAULT 0)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS fsm_updated ON fsm (updated_at)')
+        return self._conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _load_sync(self, key):
+        oldest = time.time() - self.ttl if self.ttl else 0
+        row = self._connection().execute(
+            'SELECT value FROM fsm WHERE key = ? AND updated_at >= ?', (key, oldest)).fetchone()
+        return row[0] if row else None
+
+    def _save_sync(self, key, value):
+        with self._connection() as conn:
+            conn.execute('INSERT INTO fsm (key, value, updated_at) VALUES (?, ?, ?) '
+                         'ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at',
+                         (key, value, time.time()))
+        if self.ttl and time.monotonic() - self._swept > self.sweep_interval:
+            self._sweep_sync()
+
+    # Видалення записів покинутих діалогів (разом із записом, не частіше sweep_interval)
+    def _sweep_sync(self):
+        self._swept = time.monotonic()
+        with self._connection() as conn:
+            self.expired += conn.execute('DELETE FROM fsm WHERE updated_at < ?', (time.time() - self.ttl,)).rowcount
+
+    def _delete_sync(self, key):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM fsm WHERE key = ?', (key,))
+
+    async def _load(self, key):
+        return await self._run(self._load_sync, key)
+
+    async def _save(self, key, value):
+        await self._run(self._save_sync, key, value)
+
+    async def _delete(self, key):
+        await self._run(self._delete_sync, key)
+
+    def _close_sync(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        await self._run(self._close_sync)
+
+
+class RedisFSMStorage(RecordStorage):
+    def __init__(self, url=None, client=None, prefix='fsm', ttl=0):
+        if client is None:
+            import redis.asyncio as redis  # необов'язкова залежність
+            client = redis.from_url(url)
+        self._redis = client
+        self._prefix = prefix
+        self.ttl = ttl
+        self.expired = 0  # Redis видаляє застарілі записи сам, без підрахунку
+
+    async def _load(self, key):
+        value = await self._redis.get(f'{self._prefix}:{key}')
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    async def _save(self, key, value):
+        await self._redis.set(f'{self._prefix}:{key}', value, ex=int(self.ttl) or None)
+
+    async def _delete(self, key):
+        await self._redis.delete(f'{self._prefix}:{key}')
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+# Ізоляція подій: оновлення одного користувача обробляються послідовно, а кожне
+# оновлення працює з власною сесією записів, які зберігаються один раз наприкінці
+class FSMSessionIsolation(BaseEventIsolation):
+    def __init__(self, storage):
+        self.storage = storage
+        self._locks = {}  # ключ -> [asyncio.Lock, кількість очікувачів]
+
+    @asynccontextmanager
+    async def lock(self, key):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                session = {}
+                token = _session.set(session)
+                try:
+                    yield
+                finally:
+                    _session.reset(token)
+                    await self.storage.commit(session)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def close(self):
+        self._locks.clear()
+
+
+# Вибір бекенду за адресою (так само, як для storage.create_storage);
+# ttl - час життя незавершеного діалогу, с (0 - без обмеження)
+def create_fsm_storage(url, ttl=0):
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisFSMStorage(url, ttl=ttl)
+    if url.startswith('sqlite:///'):
+        url = url[len('sqlite:///'):]
+    return SQLiteFSMStorage(url, ttl=ttl)
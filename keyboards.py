@@ -0,0 +1,58 @@
+# Реєстр готових клавіатур.
+# Усі клавіатури бота незмінні, тому кожна створюється один раз під час
+# імпорту разом із готовим JSON. KeyboardSession підставляє цей JSON у запит
+# замість повторної серіалізації розмітки при кожному повідомленні.
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from aiohttp import FormData
+
+BACK = '⬅️ Назад'
+SKIP = 'Пропустити'
+
+# id(клавіатури) -> серіалізована розмітка; клавіатури живуть до кінця процесу
+_serialized = {}
+
+
+def register(markup):
+    _serialized[id(markup)] = markup.model_dump_json(exclude_none=True)
+    return markup
+
+
+def serialized(markup):
+    return _serialized.get(id(markup))
+
+
+# Клавіатура відповіді з опціональними кнопками "Назад" та "Пропустити"
+def reply_keyboard(options, add_back=False, add_skip=False):
+    keyboard = [[KeyboardButton(text=option)] for option in options]
+    if add_back:
+        keyboard.append([KeyboardButton(text=BACK)])
+    if add_skip:
+        keyboard.append([KeyboardButton(text=SKIP)])
+    return register(ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True))
+
+
+# Інлайн-клавіатура з рядків пар (текст, callback_data)
+def inline_keyboard(rows):
+    return register(InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=text, callback_data=data) for text, data in row] for row in rows
+    ]))
+
+
+# Сесія Bot API, що бере розмітку зареєстрованих клавіатур з реєстру
+class KeyboardSession(AiohttpSession):
+    def build_form_data(self, bot, method):
+        markup = serialized(getattr(method, 'reply_markup', None))
+        if markup is None:
+            return super().build_form_data(bot, method)
+        form = FormData(quote_fields=False)
+        files = {}
+        for key, value in method.model_dump(warnings=False, exclude={'reply_markup'}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if not value:
+                continue
+            form.add_field(key, value)
+        form.add_field('reply_markup', markup)
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
@@ -0,0 +1,127 @@
+# Розпізнавання введеного тексту на кроках вибору (культура, регіон, форма добрива...).
+# Для кожного кроку один раз будується індекс нормалізованих варіантів:
+#   - нормалізація: регістр, апострофи (’ ʼ ` -> '), емодзі і зайві пробіли, латинські
+#     літери-двійники в кириличному тексті (a, c, e, i, o, p, x...);
+#   - кожен варіант додається також латинською транслітерацією (pshenytsia);
+#   - точний збіг - один пошук у словнику; якщо його немає, варіанти на відстані
+#     редагування 1 (заміна, вставка, пропуск, перестановка сусідніх літер) шукаються
+#     за попередньо обчисленими "видаленнями" одного символу;
+#   - останній крок - ті самі перевірки для окремих слів ("змінити азот, будь ласка").
+# Неоднозначний збіг (кілька різних значень) вважається відсутнім.
+import re
+import unicodedata
+
+# Менші за цю довжину значення (соя, кас) шукаються лише точно
+FUZZY_MIN_LENGTH = 4
+# Скільки слів повідомлення перевіряти окремо
+MAX_WORDS = 8
+
+_apostrophes = re.compile("[’ʼ`‘′]").sub
+# Латинські літери, що виглядають як кириличні (після casefold)
+_LOOKALIKES = {'a': 'а', 'b': 'в', 'c': 'с', 'e': 'е', 'h': 'н', 'i': 'і', 'k': 'к', 'm': 'м',
+               'o': 'о', 'p': 'р', 't': 'т', 'x': 'х', 'y': 'у'}
+_lookalikes = re.compile('[' + ''.join(_LOOKALIKES) + ']').sub
+# Транслітерація за таблицею КМУ 2010 (без особливих правил для початку слова)
+_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'h', 'ґ': 'g', 'д': 'd', 'е': 'e', 'є': 'ie', 'ж': 'zh', 'з': 'z',
+    'и': 'y', 'і': 'i', 'ї': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p',
+    'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh',
+    'щ': 'shch', 'ь': '', 'ю': 'iu', 'я': 'ia', "'": '',
+})
+
+# Символи, після яких потрібна посимвольна перевірка категорій (емодзі, знаки тощо)
+_unusual = re.compile(r"[^\w\s'%(),.\-/]").search
+_cyrillic = re.compile('[\u0400-\u04ff]').search
+
+
+def _cyrillic_lookalike(match):
+    return _LOOKALIKES[match.group()]
+
+
+def normalize(text):
+    text = _apostrophes("'", unicodedata.normalize('NFC', text).casefold())
+    # Емодзі, варіаційні селектори та інші символи не несуть змісту
+    if _unusual(text):
+        text = ''.join(char for char in text if unicodedata.category(char)[0] not in 'SC'
+                       and unicodedata.category(char) != 'Mn')
+    text = ' '.join(text.split())
+    if _cyrillic(text):
+        text = _lookalikes(_cyrillic_lookalike, text)
+    return text
+
+
+def transliterate(normalized):
+    return normalized.translate(_TRANSLIT)
+
+
+def _deletions(word):
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+# Відстань Дамерау-Левенштейна не більше 1 (рядки вже відібрані за спільним видаленням)
+def _within_one(a, b):
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) < len(b):
+        return a[i:] == b[i + 1:]
+    return a[i + 1:] == b[i + 1:] or (i + 1 < len(a) and a[i] == b[i + 1] and a[i + 1] == b[i]
+                                      and a[i + 2:] == b[i + 2:])
+
+
+class ChoiceIndex:
+    # choices - варіанти (значенням є сам текст) або словник {текст або синонім: значення}
+    def __init__(self, choices):
+        if not isinstance(choices, dict):
+            choices = {choice: choice for choice in choices}
+        self._exact = {}       # нормалізований ключ -> значення
+        self._fuzzy = {}       # ключ без одного символу -> {повний ключ}
+        ambiguous = set()
+        for text, value in choices.items():
+            key = normalize(text)
+            for variant in {key, transliterate(key)}:
+                if self._exact.setdefault(variant, value) != value:
+                    ambiguous.add(variant)
+        for variant in ambiguous:
+            del self._exact[variant]
+        for key in self._exact:
+            if len(key) >= FUZZY_MIN_LENGTH:
+                for deletion in _deletions(key) | {key}:
+                    self._fuzzy.setdefault(deletion, set()).add(key)
+
+    # Точний (fuzzy=False) або також наближений збіг усього тексту
+    def lookup(self, text, fuzzy=True):
+        return self.get(normalize(text), fuzzy)
+
+    # Те саме для вже нормалізованого ключа
+    def get(self, key, fuzzy=True):
+        value = self._exact.get(key)
+        if value is not None or not fuzzy or len(key) < FUZZY_MIN_LENGTH:
+            return value
+        return self._fuzzy_lookup(key)
+
+    def _fuzzy_lookup(self, key):
+        candidates = set()
+        for deletion in _deletions(key) | {key}:
+            candidates |= self._fuzzy.get(deletion, set())
+        values = {self._exact[candidate] for candidate in candidates if _within_one(key, candidate)}
+        return values.pop() if len(values) == 1 else None
+
+    # Значення для повідомлення користувача; None, якщо збігу немає або він неоднозначний
+    def match(self, text):
+        if not text:
+            return None
+        value = self.lookup(text)
+        if value is not None:
+            return value
+        words = normalize(text).split()
+        if len(words) < 2:
+            return None
+        values = {self.get(word) for word in words[:MAX_WORDS]} - {None}
+        return values.pop() if len(values) == 1 else None
@@ -0,0 +1,204 @@
+# Метрики бота в пам'яті з віддачею у текстовому форматі Prometheus (/metrics).
+# Гістограми мають фіксовані межі кошиків і оновлюються без блокувань: усі
+# спостереження робляться з циклу подій, а одне спостереження - це пошук
+# кошика і два додавання, без створення об'єктів на кожне оновлення.
+import os
+import time
+from bisect import bisect_left
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+# Межі кошиків, секунди: від 1 мс до 30 с
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # останній кошик - понад найбільшу межу
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Сімейство гістограм за значенням однієї мітки (хендлер, метод API, операція)
+class HistogramFamily:
+    def __init__(self, name, help_text, label, bounds=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.bounds = bounds
+        self.children = {}
+
+    def labels(self, value):
+        histogram = self.children.get(value)
+        if histogram is None:
+            histogram = self.children[value] = Histogram(self.bounds)
+        return histogram
+
+    def observe(self, value, seconds):
+        self.labels(value).observe(seconds)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for value, histogram in sorted(self.children.items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds, histogram.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{self.label}="{value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{self.label}="{value}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{self.name}_sum{{{self.label}="{value}"}} {histogram.sum:.6f}')
+            lines.append(f'{self.name}_count{{{self.label}="{value}"}} {histogram.count}')
+        return lines
+
+
+# Лічильник з необов'язковою міткою
+class Counter:
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values = {}
+
+    def inc(self, value=None, amount=1):
+        self.values[value] = self.values.get(value, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        if not self.values:
+            lines.append(f'{self.name} 0' if self.label is None else f'{self.name}{{{self.label}="none"}} 0')
+        for value, count in sorted(self.values.items(), key=lambda item: str(item[0])):
+            if self.label is None:
+                lines.append(f'{self.name} {count}')
+            else:
+                lines.append(f'{self.name}{{{self.label}="{value}"}} {count}')
+        return lines
+
+
+update_seconds = HistogramFamily('bot_update_seconds', 'Update processing time by event type', 'event')
+handler_seconds = HistogramFamily('bot_handler_seconds', 'Handler execution time', 'handler')
+api_seconds = HistogramFamily('bot_api_request_seconds', 'Outgoing Bot API request time', 'method')
+storage_seconds = HistogramFamily('bot_storage_seconds', 'Storage operation time', 'operation')
+pdf_render_seconds = HistogramFamily('bot_pdf_render_seconds', 'PDF rendering time', 'result')
+updates_total = Counter('bot_updates_total', 'Updates received by FSM state', 'state')
+api_errors_total = Counter('bot_api_errors_total', 'Failed Bot API requests by method', 'method')
+handler_errors_total = Counter('bot_handler_errors_total', 'Handler exceptions', 'handler')
+payments_total = Counter('bot_payments_total', 'Successful payments')
+duplicate_payments_total = Counter('bot_duplicate_payments_total', 'Repeated payment updates not credited again')
+rejected_checkouts_total = Counter('bot_rejected_checkouts_total', 'Pre-checkout queries rejected', 'reason')
+
+_families = [update_seconds, handler_seconds, api_seconds, storage_seconds, pdf_render_seconds]
+_counters = [updates_total, api_errors_total, handler_errors_total, payments_total, duplicate_payments_total,
+             rejected_checkouts_total]
+# Значення, що обчислюються під час запиту /metrics: ім'я -> (опис, тип, функція)
+_gauges = {}
+_started = time.time()
+
+
+def register_gauge(name, help_text, func, kind='gauge'):
+    _gauges[name] = (help_text, kind, func)
+
+
+def render():
+    lines = []
+    for family in _families:
+        lines.extend(family.render())
+    for counter in _counters:
+        lines.extend(counter.render())
+    lines += ['# HELP bot_uptime_seconds Process uptime', '# TYPE bot_uptime_seconds gauge',
+              f'bot_uptime_seconds {time.time() - _started:.0f}']
+    for name, (help_text, kind, func) in _gauges.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {func()}']
+    return '\n'.join(lines) + '\n'
+
+
+# Зовнішній middleware оновлень: час обробки і кількість оновлень за станом FSM
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        updates_total.inc(data.get('raw_state') or 'none')
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            update_seconds.observe(event.event_type, time.perf_counter() - started)
+
+
+# Внутрішній middleware подій: час виконання конкретного хендлера
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        name = data['handler'].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors_total.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(name, time.perf_counter() - started)
+
+
+# Middleware сесії: час кожного запиту до Bot API за методом
+class RequestMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            api_errors_total.inc(name)
+            raise
+        finally:
+            api_seconds.observe(name, time.perf_counter() - started)
+
+
+def _timed(family, label, func):
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            family.observe(label, time.perf_counter() - started)
+    return wrapper
+
+
+# Вимірювання часу асинхронних методів об'єкта (підміна атрибутів екземпляра)
+def instrument(obj, family, methods, prefix=''):
+    for name in methods:
+        setattr(obj, name, _timed(family, prefix + name.lstrip('_'), getattr(obj, name)))
+
+
+# Підключення метрик до диспетчера
+def setup(dp):
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    for observer in (dp.message, dp.callback_query, dp.pre_checkout_query, dp.inline_query):
+        observer.middleware(HandlerMetricsMiddleware())
+
+
+# Підключення метрик до сесії бота (запити до Bot API)
+def setup_session(session):
+    session.middleware(RequestMetricsMiddleware())
+
+
+async def metrics_handler(request):
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+
+# Окремий локальний HTTP-сервер /metrics (polling, webhook і воркери шардів); None, якщо METRICS_PORT не задано
+async def start_server():
+    port = os.getenv('METRICS_PORT')
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, os.getenv('METRICS_HOST', '127.0.0.1'), int(port)).start()
+    return runner
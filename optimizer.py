@@ -0,0 +1,127 @@
+# Підбір найдешевшого набору добрив, що покриває потребу в N, P2O5 і K2O.
+# Задача - мала лінійна програма: мінімізувати вартість c·x за умови A·x >= b, x >= 0,
+# де x - кг кожного добрива на 1 га, A - вміст елементів (fertilizer_engine.product_nutrients).
+# Ціни не змінюються між розрахунками, тож при створенні MixOptimizer один раз
+# перебираються всі базиси (3 змінні з добрив і надлишків елементів) і залишаються
+# лише двоїсто допустимі - ті, що можуть бути оптимальними за цих цін. Для кожного поля
+# оптимальний той із них, чий розв'язок B⁻¹·b невід'ємний, тож розрахунок для тисяч
+# полів - кілька множень матриць 3x3 без ітерацій симплекс-методу.
+import itertools
+import os
+
+import numpy as np
+
+from fertilizer_engine import product_nutrients
+from matching import ChoiceIndex
+
+# Ціни за замовчуванням, грн за тонну (орієнтовно, 2024 р.); змінюються через FERTILIZER_PRICES
+default_prices = {
+    'Амміачна селітра (34% N)': 18000,
+    'Карбамід (46% N)': 22000,
+    'КАС (32% N)': 16000,
+    'Діамофосфат (DAP, 46% P2O5)': 33000,
+    'Суперфосфат (46% P2O5)': 27000,
+    'Калій хлористий (KCl, 60% K2O)': 17000,
+    'Калій сульфат (50% K2O)': 30000,
+}
+# Короткі позначення добрив для колонок пакетного розрахунку
+product_codes = {
+    'Амміачна селітра (34% N)': 'AN',
+    'Карбамід (46% N)': 'UREA',
+    'КАС (32% N)': 'UAN',
+    'Діамофосфат (DAP, 46% P2O5)': 'DAP',
+    'Суперфосфат (46% P2O5)': 'TSP',
+    'Калій хлористий (KCl, 60% K2O)': 'KCL',
+    'Калій сульфат (50% K2O)': 'SOP',
+}
+
+# Назви добрив у FERTILIZER_PRICES: повна, без дужок або коротке позначення
+_aliases = {}
+for _name, _code in product_codes.items():
+    _aliases.update({_name: _name, _name.split(' (')[0]: _name, _code: _name})
+_product_index = ChoiceIndex(_aliases)
+
+
+class PriceError(ValueError):
+    pass
+
+
+# Ціни з рядка "Карбамід=21000; KCL=16500" поверх цін за замовчуванням
+# (0 - добриво недоступне і не пропонується)
+def parse_prices(text, base=default_prices):
+    prices = dict(base)
+    for item in filter(None, (part.strip() for part in text.split(';'))):
+        name, _, value = item.rpartition('=')
+        product = _product_index.lookup(name)
+        if product is None:
+            raise PriceError(f'Невідоме добриво у цінах: {name}')
+        try:
+            prices[product] = float(value.replace(',', '.'))
+        except ValueError:
+            raise PriceError(f'Некоректна ціна для {name}: {value}') from None
+    return prices
+
+
+class MixOptimizer:
+    # prices - грн за тонну; добрива без ціни (або з ціною 0) не використовуються
+    def __init__(self, prices=default_prices, nutrients=product_nutrients):
+        self.products = [name for name in nutrients if prices.get(name, 0) > 0]
+        content = np.array([nutrients[name] for name in self.products], dtype=float).T
+        missing = [element for element, row in zip(('N', 'P2O5', 'K2O'), content) if not row.any()]
+        if missing:
+            raise PriceError('Немає доступних добрив для: ' + ', '.join(missing))
+        self.prices = np.array([prices[name] for name in self.products], dtype=float) / 1000  # грн/кг
+        # Стовпці задачі: добрива, потім надлишок кожного елемента (A·x - s = b)
+        columns = np.hstack((content, -np.eye(3)))
+        costs = np.concatenate((self.prices, np.zeros(3)))
+        bases = []
+        inverses = []
+        for basis in itertools.combinations(range(columns.shape[1]), 3):
+            matrix = columns[:, basis]
+            if abs(np.linalg.det(matrix)) < 1e-12:
+                continue
+            inverse = np.linalg.inv(matrix)
+            duals = costs[list(basis)] @ inverse
+            # Двоїста допустимість: жоден стовпець не зменшує вартість (для надлишків це duals >= 0)
+            if (costs - duals @ columns >= -1e-9).all():
+                bases.append(basis)
+                inverses.append(inverse)
+        self.bases = np.array(bases)
+        self.inverses = np.array(inverses)
+        # Для кожного базису - які з добрив входять у розв'язок
+        self._is_product = self.bases < len(self.products)
+
+    # Оптимальні набори для масиву потреб (n, 3), кг елемента на 1 га.
+    # Повертає (кг кожного добрива на 1 га - масив (n, кількість добрив), вартість грн/га);
+    # рядки з некоректною потребою (NaN, від'ємна) - NaN
+    def solve(self, targets):
+        targets = np.asarray(targets, dtype=float).reshape(-1, 3)
+        n = len(targets)
+        values = np.einsum('kij,nj->nki', self.inverses, targets)
+        tolerance = 1e-9 * (1.0 + np.abs(targets).max(axis=1, initial=0.0))
+        feasible = (values >= -tolerance[:, None, None]).all(axis=2)
+        best = feasible.argmax(axis=1)
+        rows = np.arange(n)
+        chosen = np.maximum(values[rows, best], 0.0)
+        chosen[~self._is_product[best]] = 0.0
+        amounts = np.zeros((n, len(self.products) + 3))
+        amounts[rows[:, None], self.bases[best]] = chosen
+        amounts = amounts[:, :len(self.products)]
+        amounts[~feasible.any(axis=1)] = np.nan
+        return amounts, amounts @ self.prices
+
+    # Набір для одного поля: ([(добриво, кг/га), ...], вартість грн/га)
+    def solve_one(self, per_ha):
+        amounts, cost = self.solve([per_ha])
+        return [(name, float(amount)) for name, amount in zip(self.products, amounts[0]) if amount > 0], float(cost[0])
+
+
+_default = None
+
+
+# Оптимізатор за цінами з оточення (FERTILIZER_PRICES); базиси рахуються один раз на процес
+def default_optimizer():
+    global _default
+    if _default is None:
+        _default = MixOptimizer(parse_prices(os.getenv('FERTILIZER_PRICES', '')))
+    return _default
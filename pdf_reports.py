@@ -0,0 +1,258 @@
+# Формування PDF звітів поза циклом подій.
+# Рендеринг reportlab - синхронна робота, тому вона виконується в пулі
+# процесів (або потоків) з обмеженою чергою і тайм-аутом на кожне завдання.
+# Документ формується у пам'яті, файлова система не використовується.
+# Текст набирається вбудованим шрифтом DejaVu Sans (fonts/, є кирилиця), що
+# реєструється один раз на процес; довгі рядки переносяться за шириною сторінки,
+# а нова сторінка починається, щойно заповнено попередню.
+# Обмеження: reportlab тримає завершені (стиснуті) сторінки до save() і не вміє
+# записувати їх раніше, тож пам'ять одного документа зростає з кількістю сторінок
+# (~12 КБ на сторінку; 500 полів пакетного розрахунку - ~90 сторінок, пік ~2 МБ).
+# Тому великі звіти не рендеряться одним документом: звіт по полях ділиться на
+# частини (batch.report_part), і кожна рендериться й надсилається до наступної.
+import asyncio
+import hashlib
+import io
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'DejaVuSans.ttf')
+FONT_NAME = 'DejaVuSans'
+FONT_SIZE = 11
+TITLE_SIZE = 14
+LEADING = 15        # відстань між рядками, пт
+MARGIN = 50         # поля сторінки, пт
+REPORT_TITLE = 'Рекомендації по живленню'
+
+_font = None
+
+
+class PdfQueueFull(Exception):
+    pass
+
+
+# Реєстрація шрифту з кирилицею (один раз на процес). Без файлу шрифту - Helvetica
+def _register_font():
+    global _font
+    if _font is None:
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        try:
+            pdfmetrics.registerFont(TTFont(FONT_NAME, FONT_PATH))
+            _font = FONT_NAME
+        except Exception:
+            logging.warning('Шрифт %s недоступний, PDF буде без кирилиці', FONT_PATH)
+            _font = 'Helvetica'
+    return _font
+
+
+# Синхронний рендеринг звіту з ітератора рядків у байти PDF.
+# Робота пропорційна кількості рядків: кожен рядок переноситься і виводиться один раз,
+# сторінка - один текстовий об'єкт. Пам'ять - лінійна за кількістю сторінок (див. вище).
+# reportlab імпортується при першому рендерингу
+def render_pdf_lines(lines, title=REPORT_TITLE) -> bytes:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import simpleSplit
+    from reportlab.pdfgen import canvas
+
+    font = _register_font()
+    width, height = A4
+    text_width = width - 2 * MARGIN
+    top = height - MARGIN - TITLE_SIZE - LEADING
+    per_page = int((top - MARGIN - LEADING) // LEADING) + 1
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=A4, pageCompression=1, initialFontName=font, initialFontSize=FONT_SIZE)
+    c.setTitle(title)
+    page = 0
+    text = None
+    used = per_page
+    for line in lines:
+        # Порожній рядок лишається порожнім рядком звіту
+        for part in simpleSplit(line, font, FONT_SIZE, text_width) or ['']:
+            if used == per_page:
+                if text is not None:
+                    _finish_page(c, text, page, font, width)
+                page += 1
+                text = _start_page(c, title, font, height, top)
+                used = 0
+            text.textLine(part)
+            used += 1
+    if text is None:
+        page = 1
+        text = _start_page(c, title, font, height, top)
+    _finish_page(c, text, page, font, width)
+    c.save()
+    return buffer.getvalue()
+
+
+def _start_page(c, title, font, height, top):
+    c.setFont(font, TITLE_SIZE)
+    c.drawString(MARGIN, height - MARGIN - TITLE_SIZE, title)
+    text = c.beginText(MARGIN, top)
+    text.setFont(font, FONT_SIZE, LEADING)
+    return text
+
+
+# Виведення тексту сторінки, номер сторінки внизу і перехід до наступної
+def _finish_page(c, text, page, font, width):
+    c.drawText(text)
+    c.setFont(font, FONT_SIZE - 2)
+    c.drawRightString(width - MARGIN, MARGIN / 2, str(page))
+    c.showPage()
+
+
+# Звіт з тексту рекомендацій (виконується у воркері пулу)
+def render_pdf(recommendation_text: str) -> bytes:
+    return render_pdf_lines(recommendation_text.split('\n'))
+
+
+# Пул рендерингу з обмеженою чергою: workers завдань виконуються одночасно,
+# ще queue_size чекають; понад це нові запити відхиляються (PdfQueueFull)
+class PdfRenderPool:
+    def __init__(self, workers=2, queue_size=32, timeout=30.0, use_processes=True):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.timeout = timeout
+        self.use_processes = use_processes
+        self.pending = 0
+        self._executor = None
+
+    # Пул з налаштувань оточення (PDF_WORKERS, PDF_QUEUE_SIZE, PDF_TIMEOUT, PDF_EXECUTOR)
+    @classmethod
+    def from_env(cls):
+        return cls(
+            workers=int(os.getenv('PDF_WORKERS', min(4, os.cpu_count() or 1))),
+            queue_size=int(os.getenv('PDF_QUEUE_SIZE', 32)),
+            timeout=float(os.getenv('PDF_TIMEOUT', 30)),
+            use_processes=os.getenv('PDF_EXECUTOR', 'process') == 'process',
+        )
+
+    # Чи доведеться новому завданню чекати у черзі
+    @property
+    def saturated(self):
+        return self.pending >= self.workers
+
+    # Чи заповнена черга повністю
+    @property
+    def full(self):
+        return self.pending >= self.capacity
+
+    def _get_executor(self):
+        if self._executor is None:
+            executor_cls = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+            self._executor = executor_cls(max_workers=self.workers)
+        return self._executor
+
+    def _release(self, _future):
+        self.pending -= 1
+
+    # Рендеринг у воркері; місце у черзі звільняється лише після
+    # фактичного завершення завдання, навіть якщо очікування перервано тайм-аутом
+    async def _submit(self, func, *args):
+        if self.full:
+            raise PdfQueueFull()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._get_executor(), func, *args)
+        self.pending += 1
+        future.add_done_callback(self._release)
+        return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+
+    # Звіт з тексту рекомендацій
+    async def render(self, recommendation_text):
+        return await self._submit(render_pdf, recommendation_text)
+
+    # Звіт зі списку рядків (для пулу процесів - список, а не ітератор) із заголовком
+    async def render_lines(self, lines, title=REPORT_TITLE):
+        return await self._submit(render_pdf_lines, lines, title)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# Кеш звітів за хешем тексту рекомендацій. Для кожного звіту зберігаються
+# відрендерені байти та file_id Telegram після першого надсилання; коли file_id
+# відомий, байти більше не потрібні і звільняються. Витіснення - LRU за
+# сумарним розміром байтів і кількістю записів.
+class PdfCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entries=10000):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # ключ -> [pdf_bytes або None, file_id або None]
+        self.size = 0
+        self.file_id_hits = 0
+        self.bytes_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_bytes=int(os.getenv('PDF_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+            max_entries=int(os.getenv('PDF_CACHE_MAX_ENTRIES', 10000)),
+        )
+
+    @staticmethod
+    def key(recommendation_text):
+        return hashlib.sha256(recommendation_text.encode('utf-8')).hexdigest()
+
+    # Повертає (pdf_bytes, file_id); відсутні значення - None
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None, None
+        self._entries.move_to_end(key)
+        if entry[1] is not None:
+            self.file_id_hits += 1
+        elif entry[0] is not None:
+            self.bytes_hits += 1
+        else:
+            self.misses += 1
+        return entry[0], entry[1]
+
+    def put_bytes(self, key, pdf_bytes):
+        entry = self._entries.setdefault(key, [None, None])
+        if entry[0] is not None:
+            self.size -= len(entry[0])
+        entry[0] = pdf_bytes
+        self.size += len(pdf_bytes)
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def put_file_id(self, key, file_id):
+        entry = self._entries.setdefault(key, [None, None])
+        entry[1] = file_id
+        if entry[0] is not None:
+            self.size -= len(entry[0])
+            entry[0] = None
+        self._entries.move_to_end(key)
+        self._evict()
+
+    # file_id став недійсним (наприклад, інший бот-токен) - звіт треба відрендерити знову
+    def invalidate(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[0] is not None:
+            self.size -= len(entry[0])
+
+    def _evict(self):
+        while self._entries and (self.size > self.max_bytes or len(self._entries) > self.max_entries):
+            _, (pdf_bytes, _file_id) = self._entries.popitem(last=False)
+            if pdf_bytes is not None:
+                self.size -= len(pdf_bytes)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.file_id_hits + self.bytes_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'file_id_hits': self.file_id_hits,
+            'bytes_hits': self.bytes_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.file_id_hits + self.bytes_hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,96 @@
+# Розрахунок одним повідомленням без покрокового діалогу (/calc та inline-режим).
+# Параметри задаються одним рядком:
+#   /calc пшениця бобові Київська 6 чорнозем 6.2 100
+# Текстові значення впізнаються за довідниками рушія в довільному порядку (так само,
+# як кнопки діалогу: без урахування регістру, латиницею, з однією помилкою); числа йдуть по черзі: врожайність (т/га), pH, площа (га,
+# необов'язкова).
+import math
+from typing import NamedTuple, Optional
+
+from fertilizer_engine import base_requirements, prev_crop_factors, soil_factors, region_to_zone
+from matching import ChoiceIndex, normalize
+
+USAGE = ('Формат: /calc культура попередник регіон врожайність ґрунт pH [площа]\n'
+         'Наприклад: /calc пшениця бобові Київська 6 чорнозем 6.2 100')
+
+
+class CalcError(ValueError):
+    pass
+
+
+class CalcParams(NamedTuple):
+    crop: str
+    prev_crop: str
+    region: str
+    moisture: str
+    soil_type: str
+    yield_goal: float
+    ph: float
+    area: Optional[float]
+
+
+# Назви полів для повідомлень про помилки
+_field_names = {'crop': 'культуру', 'prev_crop': 'попередник', 'region': 'регіон', 'soil_type': 'тип ґрунту'}
+# Значення -> (поле, значення у формі, яку очікує рушій)
+_values = {}
+for _field, _options in (('crop', base_requirements), ('prev_crop', prev_crop_factors),
+                         ('region', region_to_zone), ('soil_type', soil_factors)):
+    for _option in _options:
+        _values[_option] = (_field, _option)
+_index = ChoiceIndex(_values)
+# Найдовше значення у словах ("Чистий пар")
+_max_words = max(len(value.split()) for value in _values)
+
+
+def _number(word):
+    try:
+        value = float(word.replace(',', '.'))
+    except ValueError:
+        return None
+    return value if math.isfinite(value) else None
+
+
+# Розбір рядка параметрів; CalcError з поясненням, якщо чогось бракує
+def parse(text):
+    words = normalize(text).split()
+    found = {}
+    numbers = []
+    i = 0
+    while i < len(words):
+        number = _number(words[i])
+        if number is not None:
+            numbers.append(number)
+            i += 1
+            continue
+        # Спершу точні збіги (найдовші першими), потім одне слово з можливою помилкою
+        for size in range(min(_max_words, len(words) - i), 0, -1):
+            match = _index.get(' '.join(words[i:i + size]), fuzzy=False)
+            if match is not None:
+                break
+        else:
+            size = 1
+            match = _index.get(words[i])
+            if match is None:
+                raise CalcError(f'Невідоме значення: {words[i]}')
+        field, value = match
+        if field in found:
+            raise CalcError(f'Двічі вказано {_field_names[field]}: {found[field]} і {value}')
+        found[field] = value
+        i += size
+    missing = [name for field, name in _field_names.items() if field not in found]
+    if missing:
+        raise CalcError('Не вказано: ' + ', '.join(missing))
+    if len(numbers) < 2:
+        raise CalcError('Вкажіть врожайність і pH')
+    if len(numbers) > 3:
+        raise CalcError('Забагато чисел: очікуються врожайність, pH і площа')
+    yield_goal, ph = numbers[0], numbers[1]
+    area = numbers[2] if len(numbers) == 3 else None
+    if yield_goal <= 0:
+        raise CalcError('Врожайність повинна бути більше 0')
+    if area is not None and area <= 0:
+        raise CalcError('Площа повинна бути більше 0')
+    region = found['region']
+    return CalcParams(found['crop'], found['prev_crop'], region, region_to_zone[region], found['soil_type'],
+                      yield_goal, ph, area)
+
@@ -0,0 +1,372 @@
+# Нагадування про внесення добрив за фазами росту (за бажанням користувача після розрахунку).
+# Для кожної фази з phase_distribution плану рахується дата (дата сівби + phase_days)
+# і текст з нормою; нагадування зберігаються в SQLite або Redis і переживають перезапуск.
+#   - у пам'яті розклад - купа цілих чисел due * 2^40 + id (одне число на нагадування,
+#     ~45 байт), тексти читаються зі сховища лише в момент відправки;
+#   - при запуску завантажуються лише (id, час) за покривним індексом і купа будується
+#     heapify за O(n); прострочені довше max_late нагадування видаляються;
+#   - нагадування, час яких настав одночасно, відправляються пачками до batch_size
+#     з обмеженням частоти (rate за секунду) і з пріоритетом BULK у черзі відправки,
+#     тож відповіді користувачам не чекають на розсилку;
+#   - доставлені і недоставні (бот заблоковано) видаляються, при інших помилках -
+#     повтор через RETRY_DELAY, не більше MAX_ATTEMPTS разів.
+# Скасовані нагадування з купи не видаляються: їх просто немає у сховищі в момент відправки.
+import asyncio
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from datetime import time as day_time
+
+import results
+from fertilizer_engine import phase_days
+from send_queue import BULK, TokenBucket, send_priority
+
+# Ключ у купі: due * _ID_SPACE + id
+_ID_SPACE = 1 << 40
+# Скільки id в одному запиті IN (...) до SQLite
+_CHUNK = 500
+RETRY_DELAY = 300
+MAX_ATTEMPTS = 3
+
+
+def _zone(name):
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo(name)
+    except (ImportError, KeyError):
+        # Немає бази часових поясів (tzdata): київський зимовий час
+        return timezone(timedelta(hours=2))
+
+
+# Година і часовий пояс нагадувань (REMINDER_HOUR, REMINDER_TZ)
+REMINDER_HOUR = int(os.getenv('REMINDER_HOUR', 8))
+REMINDER_TZ = _zone(os.getenv('REMINDER_TZ', 'Europe/Kyiv'))
+
+
+# Дата сівби з тексту: ДД.ММ, ДД.ММ.РРРР або "сьогодні"; None, якщо дату не розпізнано
+def parse_date(text, today):
+    text = text.strip().lower()
+    if text in ('сьогодні', 'today'):
+        return today
+    parts = text.replace('/', '.').replace('-', '.').split('.')
+    try:
+        if len(parts) == 2:
+            day, month = map(int, parts)
+            year = today.year
+        elif len(parts) == 3:
+            day, month, year = map(int, parts)
+            if year < 100:
+                year += 2000
+        else:
+            return None
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+
+# Нагадування для плану: [(unix-час, фаза, текст), ...]; фази, що вже минули, пропускаються
+def plan_reminders(plan, sowing, now=None, hour=REMINDER_HOUR, tz=REMINDER_TZ):
+    now = time.time() if now is None else now
+    reminders = []
+    for phase, text in results.phase_reminders(plan):
+        day = sowing + timedelta(days=phase_days.get(phase, 0))
+        due = int(datetime.combine(day, day_time(hour), tz).timestamp())
+        if due > now:
+            reminders.append((due, phase, text))
+    return reminders
+
+
+class SQLiteReminderStore:
+    def __init__(self, path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reminders-sqlite')
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS reminders (id INTEGER PRIMARY KEY, '
+                               'user_id INTEGER NOT NULL, due INTEGER NOT NULL, text TEXT NOT NULL)')
+            # Покривний індекс для завантаження розкладу (id, час і шард без читання текстів)
+            self._conn.execute('CREATE INDEX IF NOT EXISTS reminders_due ON reminders (due, user_id)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS reminders_user ON reminders (user_id)')
+        return self._conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _add_sync(self, user_id, items):
+        with self._connection() as conn:
+            return [conn.execute('INSERT INTO reminders (user_id, due, text) VALUES (?, ?, ?)',
+                                 (user_id, due, text)).lastrowid for due, text in items]
+
+    # Повне завантаження розкладу: без умови на id SQLite читає лише покривний індекс
+    def _all_sync(self, shard):
+        if shard is None:
+            return self._connection().execute('SELECT id, due FROM reminders').fetchall()
+        return self._connection().execute('SELECT id, due FROM reminders WHERE user_id % ? = ?',
+                                          (shard[1], shard[0])).fetchall()
+
+    def _fetch_sync(self, ids):
+        rows = {}
+        for start in range(0, len(ids), _CHUNK):
+            chunk = ids[start:start + _CHUNK]
+            rows.update((id_, (user_id, text)) for id_, user_id, text in self._connection().execute(
+                f'SELECT id, user_id, text FROM reminders WHERE id IN ({",".join("?" * len(chunk))})', chunk))
+        return rows
+
+    def _delete_sync(self, ids):
+        with self._connection() as conn:
+            for start in range(0, len(ids), _CHUNK):
+                chunk = ids[start:start + _CHUNK]
+                conn.execute(f'DELETE FROM reminders WHERE id IN ({",".join("?" * len(chunk))})', chunk)
+
+    def _for_user_sync(self, user_id):
+        return self._connection().execute(
+            'SELECT due, text FROM reminders WHERE user_id = ? ORDER BY due', (user_id,)).fetchall()
+
+    def _delete_user_sync(self, user_id):
+        with self._connection() as conn:
+            return conn.execute('DELETE FROM reminders WHERE user_id = ?', (user_id,)).rowcount
+
+    def _purge_sync(self, before):
+        with self._connection() as conn:
+            return conn.execute('DELETE FROM reminders WHERE due < ?', (before,)).rowcount
+
+    async def add(self, user_id, items):
+        return await self._run(self._add_sync, user_id, items)
+
+    async def pending(self, shard=None):
+        return await self._run(self._all_sync, shard)
+
+    async def fetch(self, ids):
+        return await self._run(self._fetch_sync, ids)
+
+    async def delete(self, ids):
+        if ids:
+            await self._run(self._delete_sync, ids)
+
+    async def for_user(self, user_id):
+        return await self._run(self._for_user_sync, user_id)
+
+    async def delete_user(self, user_id):
+        return await self._run(self._delete_user_sync, user_id)
+
+    async def purge(self, before):
+        return await self._run(self._purge_sync, before)
+
+    def _close_sync(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        await self._run(self._close_sync)
+
+
+# Redis: {prefix}:data - хеш id -> [user_id, час, текст], {prefix}:due - множина "id:user_id"
+# з часом як оцінкою, {prefix}:user:<id> - id нагадувань користувача, {prefix}:next - лічильник id
+class RedisReminderStore:
+    def __init__(self, url=None, client=None, prefix='reminders'):
+        if client is None:
+            import redis.asyncio as redis  # необов'язкова залежність
+            client = redis.from_url(url)
+        self._redis = client
+        self._prefix = prefix
+
+    def _user_key(self, user_id):
+        return f'{self._prefix}:user:{user_id}'
+
+    async def _rows(self, ids):
+        values = await self._redis.hmget(f'{self._prefix}:data', ids) if ids else []
+        return {id_: json.loads(value) for id_, value in zip(ids, values) if value is not None}
+
+    async def add(self, user_id, items):
+        last = await self._redis.incrby(f'{self._prefix}:next', len(items))
+        ids = list(range(last - len(items) + 1, last + 1))
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.hset(f'{self._prefix}:data', mapping={
+            id_: json.dumps([user_id, due, text], ensure_ascii=False) for id_, (due, text) in zip(ids, items)})
+        pipe.zadd(f'{self._prefix}:due', {f'{id_}:{user_id}': due for id_, (due, _) in zip(ids, items)})
+        pipe.sadd(self._user_key(user_id), *ids)
+        await pipe.execute()
+        return ids
+
+    async def pending(self, shard=None):
+        members = await self._redis.zrange(f'{self._prefix}:due', 0, -1, withscores=True)
+        pairs = []
+        for member, due in members:
+            id_, _, user_id = (member.decode() if isinstance(member, bytes) else member).partition(':')
+            pairs.append((int(id_), int(user_id), int(due)))
+        return [(id_, due) for id_, user_id, due in pairs if shard is None or user_id % shard[1] == shard[0]]
+
+    async def fetch(self, ids):
+        return {id_: (user_id, text) for id_, (user_id, _, text) in (await self._rows(list(ids))).items()}
+
+    async def delete(self, ids):
+        rows = await self._rows(list(ids))
+        if not rows:
+            return 0
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.hdel(f'{self._prefix}:data', *rows)
+        pipe.zrem(f'{self._prefix}:due', *(f'{id_}:{user_id}' for id_, (user_id, _, _) in rows.items()))
+        for id_, (user_id, _, _) in rows.items():
+            pipe.srem(self._user_key(user_id), id_)
+        await pipe.execute()
+        return len(rows)
+
+    async def for_user(self, user_id):
+        ids = [int(id_) for id_ in await self._redis.smembers(self._user_key(user_id))]
+        return sorted((due, text) for _, due, text in (await self._rows(ids)).values())
+
+    async def delete_user(self, user_id):
+        return await self.delete([int(id_) for id_ in await self._redis.smembers(self._user_key(user_id))])
+
+    async def purge(self, before):
+        members = await self._redis.zrangebyscore(f'{self._prefix}:due', '-inf', f'({before}')
+        return await self.delete([int((m.decode() if isinstance(m, bytes) else m).partition(':')[0]) for m in members])
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+# Вибір сховища за адресою (так само, як для storage.create_storage)
+def create_reminder_store(url):
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisReminderStore(url)
+    if url.startswith('sqlite:///'):
+        url = url[len('sqlite:///'):]
+    return SQLiteReminderStore(url)
+
+
+class ReminderScheduler:
+    # shard - (номер, кількість): розсилати лише нагадування користувачів свого шарда
+    def __init__(self, store, rate=10.0, batch_size=100, max_late=3 * 86400, shard=None):
+        self.store = store
+        self.rate = rate
+        self.batch_size = batch_size
+        self.max_late = max_late
+        self.shard = shard
+        self._send = None
+        self._heap = []
+        self._attempts = {}        # id -> кількість невдалих спроб
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._bucket = TokenBucket(rate, max(1.0, rate))
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0           # прострочені під час простою бота
+
+    # Налаштування з оточення: REMINDER_RATE, REMINDER_BATCH, REMINDER_MAX_LATE
+    @classmethod
+    def from_env(cls, store, shard=None):
+        return cls(
+            store,
+            rate=float(os.getenv('REMINDER_RATE', 10)),
+            batch_size=int(os.getenv('REMINDER_BATCH', 100)),
+            max_late=float(os.getenv('REMINDER_MAX_LATE', 3 * 86400)),
+            shard=shard,
+        )
+
+    @property
+    def pending(self):
+        return len(self._heap)
+
+    def _push(self, rows):
+        for id_, due in rows:
+            heapq.heappush(self._heap, int(due) * _ID_SPACE + id_)
+
+    # send(user_id, text) -> True, якщо доставлено, False - недоставне (не повторювати)
+    async def start(self, send):
+        self._send = send
+        started = time.perf_counter()
+        self.dropped += await self.store.purge(int(time.time() - self.max_late))
+        rows = await self.store.pending(shard=self.shard)
+        self._heap = [int(due) * _ID_SPACE + id_ for id_, due in rows]
+        heapq.heapify(self._heap)
+        logging.info('Нагадувань у розкладі: %d (завантажено за %.0f мс)', len(self._heap),
+                     (time.perf_counter() - started) * 1000)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # Запис нагадувань користувача [(unix-час, текст), ...]; повертає кількість
+    async def schedule(self, user_id, items):
+        ids = await self.store.add(user_id, items)
+        self._push((id_, due) for id_, (due, _) in zip(ids, items))
+        self._wakeup.set()
+        return len(ids)
+
+    async def cancel_user(self, user_id):
+        return await self.store.delete_user(user_id)
+
+    async def _run(self):
+        # Розсилка йде з нижчим пріоритетом за відповіді користувачам
+        send_priority.set(BULK)
+        while True:
+            try:
+                await self._tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception('Помилка розсилки нагадувань')
+                await asyncio.sleep(RETRY_DELAY)
+
+    async def _tick(self):
+        now = time.time()
+        if not self._heap or self._heap[0] // _ID_SPACE > now:
+            timeout = self._heap[0] // _ID_SPACE - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return
+        batch = []
+        while self._heap and self._heap[0] // _ID_SPACE <= now and len(batch) < self.batch_size:
+            batch.append(heapq.heappop(self._heap) % _ID_SPACE)
+        await self._deliver(batch, now)
+
+    async def _send_paced(self, loop, user_id, text):
+        delay = self._bucket.reserve(loop.time())
+        if delay:
+            await asyncio.sleep(delay)
+        return await self._send(user_id, text)
+
+    # Одна пачка: тексти одним запитом, відправка з обмеженням частоти, видалення одним запитом
+    async def _deliver(self, ids, now):
+        rows = await self.store.fetch(sorted(set(ids)))
+        loop = asyncio.get_running_loop()
+        outcomes = await asyncio.gather(*(self._send_paced(loop, user_id, text) for user_id, text in rows.values()),
+                                        return_exceptions=True)
+        done = []
+        for id_, outcome in zip(rows, outcomes):
+            if isinstance(outcome, Exception):
+                attempts = self._attempts.get(id_, 0) + 1
+                if attempts < MAX_ATTEMPTS:
+                    self._attempts[id_] = attempts
+                    self._push(((id_, now + RETRY_DELAY),))
+                    continue
+                logging.warning('Нагадування %d не доставлено: %s', id_, outcome)
+                outcome = False
+            self._attempts.pop(id_, None)
+            done.append(id_)
+            if outcome:
+                self.sent += 1
+            else:
+                self.failed += 1
+        await self.store.delete(done)
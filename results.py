@@ -0,0 +1,197 @@
+# Результат розрахунку добрив і всі його подання: повідомлення в чаті, текст PDF і CSV.
+# FertilizerPlan рахується один раз за діалог і зберігається (у даних FSM і в сховищі)
+# компактним списком чисел; зміна форми добрива перераховує лише свій елемент.
+# Тексти збираються з шаблонів, підготовлених один раз при імпорті модуля.
+import csv
+import io
+import json
+
+from fertilizer_engine import phase_distribution
+
+NUTRIENTS = ('Азот', 'Фосфор', 'Калій')
+ELEMENTS = ('Азот (N)', 'Фосфор (P)', 'Калій (K)')
+
+# Шаблони повідомлень у чаті
+_rates_head = '🔹 Для культури {} при врожайності {:.1f} т/га:\n'.format
+_rate_line = '   - {}: {:.1f} кг/га\n'.format
+_avg_yield_line = '   (Середня врожайність {} в {} у 2024 р. ~ {:.1f} т/га)\n'.format
+_lime_line = '⚠️ Ґрунт кислий (pH {}). Рекомендовано вапнування (~{:.0f} т/га вапна).\n'.format
+_NO_LIME = '✅ pH ґрунту в нормі, вапнування не потрібне.\n'
+_PHASES_HEAD = '📈 Розподіл добрив по фазах росту:\n'
+_phase_line = '   - {}: {}\n'.format
+_portion = '{:.1f} кг - {}'.format
+_fert_line = '   - {}: {:.1f} кг — {}\n'.format
+_totals_head = '🔸 Загальна потреба на площу {:.1f} га:\n'.format
+_total_line = '   - {}: {:.1f} кг\n'.format
+_MASS_HEAD = '💰 У фізичній масі добрив це приблизно:\n'
+_mass_line = '   - {}: {:.1f} кг'.format
+_MIX_HEAD = '💰 Найдешевший набір добрив (на 1 га):\n'
+_mix_line = '   - {}: {:.1f} кг\n'.format
+_mix_cost = 'Вартість: ~{:.0f} грн/га (азот у діамофосфаті враховано).'.format
+_reminder_head = '🔔 Нагадування: {} - час внесення {}\n'.format
+_reminder_area = ' ({:.1f} га)'.format
+_reminder_line = '   - {}: {:.1f} кг/га - {} ~{:.1f} кг/га'.format
+_reminder_total = ' (на площу ~{:.1f} кг)'.format
+
+# Шаблони тексту PDF
+_pdf_title = 'Рекомендації для {}\n'.format
+_pdf_rates = 'Азот: {:.1f} кг/га; Фосфор: {:.1f} кг/га; Калій: {:.1f} кг/га\n'.format
+_PDF_FORMS_HEAD = 'Рекомендовані форми добрив на 1 га:\n'
+_pdf_form_line = ' - {}: {:.1f} кг/га\n'.format
+_pdf_area_title = 'Рекомендації для {} (на {:.1f} га):\n'.format
+_pdf_area_rates = 'Вміст елементів на 1 га: N {:.1f} кг, P {:.1f} кг, K {:.1f} кг.\n'.format
+_pdf_area_ferts = 'Рекомендовані добрива на 1 га: {} {:.1f} кг, {} {:.1f} кг, {} {:.1f} кг.\n'.format
+_pdf_area_totals = 'Загальна потреба на {:.1f} га: {} {:.1f} кг, {} {:.1f} кг, {} {:.1f} кг.'.format
+
+# Колонки CSV - ті самі назви, що й у результаті пакетного розрахунку (batch.py)
+CSV_COLUMNS = ('crop', 'region', 'yield_goal', 'ph', 'area', 'N_per_ha', 'P_per_ha', 'K_per_ha', 'lime_t_per_ha',
+               'N_form', 'P_form', 'K_form', 'N_fert_per_ha', 'P_fert_per_ha', 'K_fert_per_ha',
+               'N_fert_total', 'P_fert_total', 'K_fert_total')
+
+
+class FertilizerPlan:
+    __slots__ = ('crop', 'per_ha', 'forms', 'area', 'yield_goal', 'ph', 'lime', 'region', 'avg_yield', 'fert_per_ha')
+
+    # per_ha - потреба (N, P, K) на 1 га, forms - [(назва, вміст діючої речовини), ...] для N, P, K
+    def __init__(self, crop, per_ha, forms, area=None, yield_goal=None, ph=None, lime=0.0, region='', avg_yield=None):
+        self.crop = crop
+        self.per_ha = tuple(per_ha)
+        self.forms = [tuple(form) for form in forms]
+        self.area = area
+        self.yield_goal = yield_goal
+        self.ph = ph
+        self.lime = lime
+        self.region = region
+        self.avg_yield = avg_yield
+        # Фізична маса добрив на 1 га
+        self.fert_per_ha = [amount / content for amount, (_, content) in zip(self.per_ha, self.forms)]
+
+    @classmethod
+    def from_recommendation(cls, rec, region='', area=None):
+        return cls(rec.crop, (rec.N_per_ha, rec.P_per_ha, rec.K_per_ha), rec.forms, area,
+                   rec.yield_goal, rec.ph, rec.lime_t_per_ha, region, rec.avg_yield)
+
+    # Зміна форми одного елемента (0 - N, 1 - P, 2 - K): перераховується лише його маса
+    def set_form(self, index, form, content):
+        self.forms[index] = (form, content)
+        self.fert_per_ha[index] = self.per_ha[index] / content
+
+    # Компактний список для даних FSM і сховища: культура, потреба, форми, площа, далі -
+    # дані для повідомлень (у записі без плану після культури стоїть None, див. pack)
+    def dump(self):
+        return [self.crop, self.per_ha, self.forms, self.area, self.yield_goal, self.ph, self.lime,
+                self.region, self.avg_yield]
+
+    @classmethod
+    def load(cls, values):
+        return cls(*values)
+
+
+# План зі збережених у FSM даних діалогу; None, якщо розрахунку ще не було
+def plan_from_state(data):
+    return FertilizerPlan.load(data['plan']) if 'plan' in data else None
+
+
+# Запис рекомендації для сховища; без плану зберігається лише культура
+def pack(plan, crop=''):
+    values = plan.dump() if plan is not None else [crop, None, None, None]
+    return json.dumps(values, ensure_ascii=False, separators=(',', ':'))
+
+
+# План зі сховища; None, якщо запису немає або в ньому лише культура
+def unpack(stored):
+    if not stored:
+        return None
+    values = json.loads(stored)
+    return FertilizerPlan.load(values) if values[1] is not None else None
+
+
+# Норми на 1 га, довідкова врожайність у регіоні, вапнування і розподіл по фазах росту
+def chat_rates(plan):
+    crop_name = plan.crop.capitalize()
+    parts = [_rates_head(crop_name, plan.yield_goal)]
+    parts += [_rate_line(name, amount) for name, amount in zip(ELEMENTS, plan.per_ha)]
+    if plan.region and plan.avg_yield:
+        parts.append(_avg_yield_line(crop_name, plan.region, plan.avg_yield))
+    parts.append(_lime_line(plan.ph, plan.lime) if plan.lime else _NO_LIME)
+    parts.append(_PHASES_HEAD)
+    for name, amount, phases in zip(NUTRIENTS, plan.per_ha, phase_distribution.get(plan.crop, ())):
+        parts.append(_phase_line(name, '; '.join(_portion(amount * fraction, phase) for phase, fraction in phases)))
+    return ''.join(parts)
+
+
+# Фізична маса добрив на 1 га за обраними формами
+def chat_fertilizers(plan, title):
+    return title + ''.join(_fert_line(name, amount, form)
+                           for name, amount, (form, _) in zip(NUTRIENTS, plan.fert_per_ha, plan.forms))
+
+
+# Найдешевший набір добрив на 1 га (optimizer.MixOptimizer.solve_one)
+def chat_mix(products, cost):
+    return _MIX_HEAD + ''.join(_mix_line(name, amount) for name, amount in products) + _mix_cost(cost)
+
+
+# Тексти нагадувань для фаз внесення: [(фаза, текст), ...] у порядку фаз
+def phase_reminders(plan):
+    field = plan.crop.capitalize() + (_reminder_area(plan.area) if plan.area else '')
+    lines = {}
+    for name, amount, (form, content), phases in zip(NUTRIENTS, plan.per_ha, plan.forms,
+                                                     phase_distribution.get(plan.crop, ())):
+        for phase, fraction in phases:
+            mass = amount * fraction / content
+            line = _reminder_line(name, amount * fraction, form, mass)
+            if plan.area:
+                line += _reminder_total(mass * plan.area)
+            lines.setdefault(phase, []).append(line)
+    return [(phase, _reminder_head(field, phase) + '\n'.join(phase_lines)) for phase, phase_lines in lines.items()]
+
+
+# Загальна потреба на площу: елементи і фізична маса добрив
+def chat_totals(plan):
+    totals = [amount * plan.area for amount in plan.per_ha]
+    return (_totals_head(plan.area) + ''.join(_total_line(name, total) for name, total in zip(ELEMENTS, totals))
+            + _MASS_HEAD + '\n'.join(_mass_line(form, total / content)
+                                     for total, (form, content) in zip(totals, plan.forms)))
+
+
+# Текст для PDF звіту: на вказану площу або, без площі, на 1 га
+def pdf_text(plan):
+    crop_name = plan.crop.capitalize() if plan.crop else ''
+    fert = plan.fert_per_ha
+    (N_form, _), (P_form, _), (K_form, _) = plan.forms
+    if plan.area is None:
+        text = _pdf_title(crop_name) if plan.crop else ''
+        text += _pdf_rates(*plan.per_ha) + _PDF_FORMS_HEAD
+        return text + ''.join(_pdf_form_line(form, amount) for (form, _), amount in zip(plan.forms, fert))
+    area = plan.area
+    totals = [amount * area / content for amount, (_, content) in zip(plan.per_ha, plan.forms)]
+    return (_pdf_area_title(crop_name, area) + _pdf_area_rates(*plan.per_ha)
+            + _pdf_area_ferts(N_form, fert[0], P_form, fert[1], K_form, fert[2])
+            + _pdf_area_totals(area, N_form, totals[0], P_form, totals[1], K_form, totals[2]))
+
+
+# Текст для PDF зі збереженого запису; без плану - лише заголовок з культурою
+def stored_pdf_text(stored):
+    if not stored:
+        return ''
+    values = json.loads(stored)
+    if values[1] is not None:
+        return pdf_text(FertilizerPlan.load(values))
+    return _pdf_title(values[0].capitalize()) if values[0] else ''
+
+
+# Рядок CSV (значення колонок CSV_COLUMNS); без площі загальна потреба порожня
+def csv_row(plan):
+    totals = [amount * plan.area for amount in plan.fert_per_ha] if plan.area is not None else [None] * 3
+    values = [plan.crop, plan.region, plan.yield_goal, plan.ph, plan.area, *plan.per_ha, plan.lime,
+              *(form for form, _ in plan.forms), *plan.fert_per_ha, *totals]
+    return [f'{value:.1f}' if isinstance(value, float) else '' if value is None else value for value in values]
+
+
+# Файл CSV з планами (UTF-8 з BOM, як і результат пакетного розрахунку - для Excel)
+def csv_bytes(plans):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    writer.writerows(csv_row(plan) for plan in plans)
+    return buffer.getvalue().encode('utf-8-sig')
@@ -0,0 +1,164 @@
+# Черга вихідних повідомлень з урахуванням обмежень Telegram (flood limits).
+# Усі запити бота проходять через сесію, тому обмеження реалізоване як
+# middleware сесії: жоден хендлер не може відправити повідомлення в обхід нього.
+#   - на кожен чат - маркерний кошик (за замовчуванням 1 повідомлення/с, запас 3);
+#   - на весь бот - спільний кошик (30 повідомлень/с) з чергою за пріоритетом:
+#     інтерактивні відповіді проходять раніше за масові (документи PDF);
+#   - відповідь 429 (RetryAfter) призупиняє відправку на вказаний час, після
+#     чого запит повторюється автоматично.
+# Фонові розсилки (нагадування) задають для своєї задачі пріоритет BULK через
+# send_priority, щоб їхні sendMessage не випереджали відповіді користувачам.
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+INTERACTIVE = 0
+BULK = 1
+
+# Методи, що надсилають повідомлення в чат і підпадають під обмеження.
+# Відповіді на callback і передперевірку оплати не обмежуються: їх треба дати одразу.
+LIMITED_METHODS = {
+    'sendMessage': INTERACTIVE, 'sendInvoice': INTERACTIVE, 'editMessageText': INTERACTIVE,
+    'editMessageReplyMarkup': INTERACTIVE, 'sendChatAction': INTERACTIVE,
+    'sendDocument': BULK, 'sendPhoto': BULK, 'sendMediaGroup': BULK, 'copyMessage': BULK,
+    'forwardMessage': BULK,
+}
+
+# Найнижчий пріоритет для запитів поточної задачі (BULK - для фонових розсилок)
+send_priority = ContextVar('send_priority', default=INTERACTIVE)
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now=0.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    # Скільки чекати до появи маркера (0 - є вже зараз)
+    def delay(self, now):
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    # Резервування маркера наперед: маркери можуть піти в мінус, і кожен наступний
+    # запит отримує свій момент відправки після попередніх (порядок FIFO без черги)
+    def reserve(self, now):
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    # Кошик простоює (повний) і його можна видалити
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SendQueue(BaseRequestMiddleware):
+    def __init__(self, rate=30.0, chat_rate=1.0, chat_burst=3, max_retries=3):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate, rate)
+        self._chats = {}             # chat_id -> TokenBucket
+        self._prune_at = 1024
+        self._waiting = []           # купа (пріоритет, порядковий номер, future)
+        self._seq = itertools.count()
+        self._scheduler = None
+        self._paused_until = 0.0
+        self.retries = 0             # скільки разів отримано 429
+
+    # Налаштування з оточення (SEND_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_MAX_RETRIES).
+    # share - на скільки процесів ділиться загальний ліміт бота; None, якщо SEND_RATE=0
+    @classmethod
+    def from_env(cls, share=1):
+        rate = float(os.getenv('SEND_RATE', 30))
+        if rate <= 0:
+            return None
+        return cls(
+            rate=rate / max(share, 1),
+            chat_rate=float(os.getenv('SEND_CHAT_RATE', 1)),
+            chat_burst=int(os.getenv('SEND_CHAT_BURST', 3)),
+            max_retries=int(os.getenv('SEND_MAX_RETRIES', 3)),
+        )
+
+    @property
+    def waiting(self):
+        return len(self._waiting)
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self._prune_at:
+                # Прибираємо кошики чатів, що давно нічого не отримували
+                self._chats = {c: b for c, b in self._chats.items() if not b.idle(now)}
+                self._prune_at = max(1024, 2 * len(self._chats))
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    # Дозвіл спільного кошика з урахуванням пріоритету
+    async def _acquire(self, priority, loop):
+        now = loop.time()
+        if not self._waiting and now >= self._paused_until and not self._bucket.delay(now):
+            self._bucket.take()
+            return
+        future = loop.create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), future))
+        if self._scheduler is None:
+            self._scheduler = asyncio.create_task(self._schedule())
+        await future
+
+    async def _schedule(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._waiting:
+                now = loop.time()
+                wait = max(self._paused_until - now, self._bucket.delay(now))
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                _, _, future = heapq.heappop(self._waiting)
+                if not future.done():
+                    self._bucket.take()
+                    future.set_result(None)
+        finally:
+            self._scheduler = None
+
+    async def __call__(self, make_request, bot, method):
+        priority = LIMITED_METHODS.get(method.__api_method__)
+        chat_id = getattr(method, 'chat_id', None)
+        if priority is None or chat_id is None:
+            return await make_request(bot, method)
+        priority = max(priority, send_priority.get())
+        loop = asyncio.get_running_loop()
+        delay = self._chat_bucket(chat_id, loop.time()).reserve(loop.time())
+        if delay:
+            await asyncio.sleep(delay)
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(priority, loop)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retries += 1
+                if attempt == self.max_retries:
+                    raise
+                # Telegram просить зачекати - призупиняємо всю відправку, а не лише цей чат
+                self._paused_until = max(self._paused_until, loop.time() + e.retry_after)
+                logging.warning('Flood control: пауза %s с (%s, чат %s)', e.retry_after,
+                                method.__api_method__, chat_id)
@@ -0,0 +1,104 @@
+# Профіль запуску бота (python telegram_fertilizer_bot.py --profile-startup).
+# Вимірює час імпорту кожного модуля (власний і разом із вкладеними імпортами),
+# етапи ініціалізації до готовності приймати оновлення і вартість відкладених
+# (лінивих) імпортів, що сплачується при першому PDF чи пакетному розрахунку.
+# Мережа не використовується: бот створюється, запускає хуки старту і зупиняється.
+import importlib.abc
+import sys
+import time
+
+_started = _last = time.perf_counter()
+_imports = []    # (модуль, власний час, загальний час, глибина вкладеності)
+_stack = []      # накопичений час вкладених імпортів для модулів, що імпортуються зараз
+_phases = []     # (етап, тривалість, чи відкладений)
+_ready = None
+_ready_imports = None  # скільки модулів імпортовано до готовності
+
+
+class _TimedLoader(importlib.abc.Loader):
+    def __init__(self, loader):
+        self.loader = loader
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        _stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            total = time.perf_counter() - started
+            nested = _stack.pop()
+            if _stack:
+                _stack[-1] += total
+            _imports.append((module.__name__, total - nested, total, len(_stack)))
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+# Обгортка над іншими шукачами модулів: кожен знайдений модуль виконується через _TimedLoader
+class _TimedFinder(importlib.abc.MetaPathFinder):
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader)
+                return spec
+        return None
+
+
+def install():
+    global _started, _last
+    _started = _last = time.perf_counter()
+    sys.meta_path.insert(0, _TimedFinder())
+
+
+class phase:
+    def __init__(self, name, deferred=False):
+        self.name = name
+        self.deferred = deferred
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        _phases.append((self.name, time.perf_counter() - self.started, self.deferred))
+
+
+# Етап від запуску профілювання (або попередньої позначки) до цього моменту
+def checkpoint(name):
+    global _last
+    now = time.perf_counter()
+    _phases.append((name, now - _last, False))
+    _last = now
+
+
+# Момент готовності приймати оновлення
+def mark_ready():
+    global _ready, _ready_imports
+    _ready = time.perf_counter() - _started
+    _ready_imports = len(_imports)
+
+
+# Друк звіту; код виходу 1, якщо час до готовності перевищує target секунд (0 - без перевірки)
+def report(target=0.0, top=25):
+    print(f'Імпорт модулів (найдовші {top}; власний / разом із вкладеними, мс):')
+    eager = _imports[:_ready_imports]
+    for name, own, total, _ in sorted(eager, key=lambda item: -item[2])[:top]:
+        print(f'  {own * 1000:9.1f} {total * 1000:9.1f}  {name}')
+    imported = sum(total for _, _, total, depth in eager if depth == 0)
+    print(f'Імпорт до готовності: {imported * 1000:.0f} мс, модулів: {len(eager)}')
+    print('Етапи ініціалізації, мс:')
+    for name, seconds, deferred in _phases:
+        print(f'  {seconds * 1000:9.1f}  {name}{" (відкладено до першого використання)" if deferred else ""}')
+    ready = _ready if _ready is not None else time.perf_counter() - _started
+    print(f'Готовність до першого оновлення: {ready * 1000:.0f} мс')
+    if target and ready > target:
+        print(f'❗ Перевищено ціль {target * 1000:.0f} мс')
+        return 1
+    return 0
@@ -0,0 +1,313 @@
+# Постійне сховище лічильників розрахунків, оплат і останніх рекомендацій.
+# Два бекенди з однаковим асинхронним інтерфейсом:
+#   - SQLite (WAL, пакетний запис у фоні з буфером відкладеного запису);
+#   - Redis (або сумісний сервер; для перевірок можна передати fakeredis клієнт).
+# Лічильники для перевірки ліміту читаються з обмеженого кешу в пам'яті (LRU + TTL),
+# тож перевірка квоти активного користувача не звертається до диска, а пам'ять
+# не зростає з кількістю всіх користувачів, що будь-коли користувалися ботом.
+# Оплати - журнал лише для додавання з ключем telegram_payment_charge_id:
+# повторне оновлення про той самий платіж не зараховується вдруге, а запис
+# потрапляє на диск до відповіді користувачу. Журнал - єдине джерело оплачених
+# розрахунків: їх кількість для кожного користувача рахується з журналу при старті
+# (SQLite, далі - у пам'яті) або оновлюється разом із записом у журнал (Redis).
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import BoundedCache
+
+
+class Storage:
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    # (кількість розрахунків, кількість оплат) користувача
+    async def get_counts(self, user_id):
+        raise NotImplementedError
+
+    async def add_usage(self, user_id, count=1):
+        raise NotImplementedError
+
+    # Зарахування оплати за записом у журналі; False, якщо платіж з таким charge_id уже зараховано
+    async def credit_payment(self, user_id, charge_id, amount=0, currency='', payload='', provider_charge_id=None):
+        raise NotImplementedError
+
+    # Атомарна перевірка ліміту і списання одного розрахунку (free безкоштовних + оплачені);
+    # False, якщо доступних розрахунків немає
+    async def consume_quota(self, user_id, free=1):
+        raise NotImplementedError
+
+    async def get_recommendation(self, user_id):
+        raise NotImplementedError
+
+    async def set_recommendation(self, user_id, text):
+        raise NotImplementedError
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS counters (
+    user_id INTEGER PRIMARY KEY,
+    usage_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS recommendations (
+    user_id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS payments (
+    charge_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL DEFAULT 0,
+    currency TEXT NOT NULL DEFAULT '',
+    payload TEXT NOT NULL DEFAULT '',
+    provider_charge_id TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS payments_user ON payments (user_id);
+'''
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path, flush_interval=0.5, batch_size=500, cache=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # Усі звернення до з'єднання виконуються в одному окремому потоці (по черзі, тож
+        # читання, поставлене після запису, завжди бачить записане)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self._conn = None
+        self.usage_cache = cache if cache is not None else BoundedCache(100_000)  # user_id -> usage_count
+        self._credits = {}           # user_id -> кількість оплат у журналі (усі платники)
+        self._dirty = {}             # user_id -> usage_count, ще не записаний на диск
+        self._pending_recs = {}      # рекомендації, що ще не записані на диск
+        self._wakeup = asyncio.Event()
+        self._flusher = None
+        self._flush_lock = asyncio.Lock()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def _load_credits(self):
+        return dict(self._conn.execute('SELECT user_id, COUNT(*) FROM payments GROUP BY user_id'))
+
+    async def start(self):
+        self._conn = await self._run(self._open)
+        self._credits = await self._run(self._load_credits)
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+    def _load_usage(self, user_id):
+        row = self._conn.execute('SELECT usage_count FROM counters WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    # Незаписане значення або значення з кешу; None, якщо треба читати з диска
+    def _cached_usage(self, user_id):
+        usage = self._dirty.get(user_id)
+        return usage if usage is not None else self.usage_cache.get(user_id)
+
+    # Повернене значення актуальне до наступного await у викликачі
+    async def _get_usage(self, user_id):
+        usage = self._cached_usage(user_id)
+        if usage is None:
+            loaded = await self._run(self._load_usage, user_id)
+            # За час завантаження значення могло з'явитися від іншого запиту
+            usage = self._cached_usage(user_id)
+            if usage is None:
+                usage = loaded
+                self.usage_cache.put(user_id, usage)
+        return usage
+
+    async def get_counts(self, user_id):
+        usage = await self._get_usage(user_id)
+        return usage, self._credits.get(user_id, 0)
+
+    def _set_usage(self, user_id, usage):
+        self.usage_cache.put(user_id, usage)
+        self._dirty[user_id] = usage
+        if len(self._dirty) + len(self._pending_recs) >= self.batch_size:
+            self._wakeup.set()
+
+    async def add_usage(self, user_id, count=1):
+        usage = await self._get_usage(user_id)
+        self._set_usage(user_id, usage + count)
+
+    # Перевірка і списання виконуються без await між ними, тож паралельні запити того
+    # самого користувача в межах процесу не можуть обидва використати останній розрахунок.
+    # Списання потрапляє на диск з фоновим скиданням: збій може втратити лише його (на користь
+    # користувача), а не оплату
+    async def consume_quota(self, user_id, free=1):
+        usage = await self._get_usage(user_id)
+        if usage >= free + self._credits.get(user_id, 0):
+            return False
+        self._set_usage(user_id, usage + 1)
+        return True
+
+    def _insert_payment(self, row):
+        # Оплата не повинна загубитися навіть при збої живлення: повна синхронізація для цього запису
+        self._conn.execute('PRAGMA synchronous=FULL')
+        try:
+            with self._conn:
+                cursor = self._conn.execute(
+                    'INSERT OR IGNORE INTO payments (charge_id, user_id, amount, currency, payload, '
+                    'provider_charge_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+            return cursor.rowcount == 1
+        finally:
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+
+    # Журнал записується на диск одразу, не чекаючи фонового скидання буфера
+    async def credit_payment(self, user_id, charge_id, amount=0, currency='', payload='', provider_charge_id=None):
+        added = await self._run(self._insert_payment,
+                                (charge_id, user_id, amount, currency, payload, provider_charge_id, time.time()))
+        if added:
+            self._credits[user_id] = self._credits.get(user_id, 0) + 1
+        return added
+
+    def _load_recommendation(self, user_id):
+        row = self._conn.execute('SELECT text FROM recommendations WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row else None
+
+    async def get_recommendation(self, user_id):
+        if user_id in self._pending_recs:
+            return self._pending_recs[user_id]
+        return await self._run(self._load_recommendation, user_id)
+
+    async def set_recommendation(self, user_id, text):
+        self._pending_recs[user_id] = text
+        if len(self._dirty) + len(self._pending_recs) >= self.batch_size:
+            self._wakeup.set()
+
+    def _write(self, counters, recommendations):
+        with self._conn:
+            self._conn.executemany(
+                'INSERT INTO counters (user_id, usage_count) VALUES (?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET usage_count = excluded.usage_count', counters)
+            self._conn.executemany(
+                'INSERT INTO recommendations (user_id, text) VALUES (?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET text = excluded.text', recommendations)
+
+    # Запис усіх накопичених змін однією транзакцією
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty and not self._pending_recs or self._conn is None:
+                return
+            dirty, self._dirty = self._dirty, {}
+            counters = list(dirty.items())
+            recommendations = list(self._pending_recs.items())
+            pending, self._pending_recs = self._pending_recs, {}
+            try:
+                await self._run(self._write, counters, recommendations)
+            except Exception:
+                # Повертаємо незаписані зміни в буфер, щоб повторити спробу пізніше
+                # (новіші значення, змінені під час запису, не перезаписуються)
+                for user_id, usage in counters:
+                    self._dirty.setdefault(user_id, usage)
+                for user_id, text in pending.items():
+                    self._pending_recs.setdefault(user_id, text)
+                raise
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception('Помилка запису в SQLite')
+
+
+# Запис у журнал і зарахування оплати - одна атомарна операція на сервері
+_CREDIT_SCRIPT = '''
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[3]) == 0 then
+    return 0
+end
+redis.call('HINCRBY', KEYS[2], ARGV[2], 1)
+return 1
+'''
+
+# Перевірка ліміту і списання розрахунку без гонки між процесами
+_CONSUME_SCRIPT = '''
+local usage = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+local paid = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')
+if usage >= tonumber(ARGV[2]) + paid then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+return 1
+'''
+
+
+class RedisStorage(Storage):
+    def __init__(self, url=None, client=None, prefix='fert'):
+        if client is None:
+            import redis.asyncio as redis  # необов'язкова залежність
+            client = redis.from_url(url)
+        self._redis = client
+        self._usage_key = f'{prefix}:usage'
+        self._payment_key = f'{prefix}:payments'
+        self._ledger_key = f'{prefix}:ledger'
+        self._rec_key = f'{prefix}:rec'
+        self._credit = client.register_script(_CREDIT_SCRIPT)
+        self._consume = client.register_script(_CONSUME_SCRIPT)
+
+    async def close(self):
+        await self._redis.aclose()
+
+    async def get_counts(self, user_id):
+        # Обидва лічильники - за один запит до сервера
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.hget(self._usage_key, user_id)
+            pipe.hget(self._payment_key, user_id)
+            usage, payments = await pipe.execute()
+        return int(usage or 0), int(payments or 0)
+
+    async def add_usage(self, user_id, count=1):
+        await self._redis.hincrby(self._usage_key, user_id, count)
+
+    async def consume_quota(self, user_id, free=1):
+        return bool(await self._consume(keys=[self._usage_key, self._payment_key], args=[user_id, free]))
+
+    async def credit_payment(self, user_id, charge_id, amount=0, currency='', payload='', provider_charge_id=None):
+        record = json.dumps({'user_id': user_id, 'amount': amount, 'currency': currency, 'payload': payload,
+                             'provider_charge_id': provider_charge_id, 'created_at': time.time()})
+        return bool(await self._credit(keys=[self._ledger_key, self._payment_key], args=[charge_id, user_id, record]))
+
+    async def get_recommendation(self, user_id):
+        text = await self._redis.hget(self._rec_key, user_id)
+        return text.decode('utf-8') if isinstance(text, bytes) else text
+
+    async def set_recommendation(self, user_id, text):
+        await self._redis.hset(self._rec_key, user_id, text)
+
+
+# Вибір бекенду за адресою: redis://..., rediss://... або sqlite:///шлях/до/файлу.db
+# (cache - кеш лічильників для SQLite; Redis тримає їх на сервері)
+def create_storage(url, cache=None):
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStorage(url)
+    if url.startswith('sqlite:///'):
+        url = url[len('sqlite:///'):]
+    return SQLiteStorage(url, cache=cache)
@@ -0,0 +1,302 @@
+# Режим супервізора: кілька процесів-шардів бота на різних ядрах.
+# Супервізор сам отримує оновлення (long polling або webhook), читає з них лише
+# id користувача і передає сире оновлення у процес user_id % N. Стан FSM,
+# ліміти частоти, черга відправки чату і кеш лічильників кожного користувача
+# живуть в одному процесі, тож узгоджувати їх між процесами не потрібно.
+#   - воркер - окремий інтерпретатор (той самий скрипт з SHARD_INDEX), оновлення
+#     надходять у його stdin кадрами "4 байти довжини + JSON";
+#   - довідкова таблиця рекомендацій записується у файл і відображається
+#     воркерами в пам'ять лише для читання (FERT_TABLE_PATH) - одна копія на всіх;
+#   - воркер, що впав, перезапускається, а оновлення для нього чекають у черзі.
+import asyncio
+import collections
+import json
+import logging
+import os
+import signal
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+import fertilizer_engine
+import metrics
+import webhook
+
+# Скільки оновлень тримати для воркера, поки він перезапускається
+PENDING_LIMIT = 10_000
+
+
+# Ключ маршрутизації оновлення: id користувача, інакше id чату, інакше update_id
+def route_key(update):
+    for event in update.values():
+        if isinstance(event, dict):
+            user = event.get('from') or event.get('user')
+            if user:
+                return user['id']
+            chat = event.get('chat')
+            if chat:
+                return chat['id']
+    return update.get('update_id', 0)
+
+
+# Таблиця рекомендацій у файлі для спільного відображення в пам'ять воркерами
+def _share_table():
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    with tempfile.NamedTemporaryFile(prefix='fert_table_', suffix='.bin', dir=directory, delete=False) as f:
+        f.write(fertilizer_engine.lookup_table.tobytes())
+    return f.name
+
+
+class Supervisor:
+    def __init__(self, workers, script=None, drain_timeout=30.0):
+        self.workers = workers
+        self.script = script or os.path.abspath(sys.argv[0])
+        self.drain_timeout = drain_timeout
+        self.processes = [None] * workers
+        self.restarts = 0
+        self._pending = [collections.deque(maxlen=PENDING_LIMIT) for _ in range(workers)]
+        self._started = [0.0] * workers
+        self._failures = [0] * workers
+        self._watchers = set()
+        self._stopping = False
+        self._table_path = None
+
+    def _env(self, index):
+        env = dict(os.environ)
+        env['SHARD_INDEX'] = str(index)
+        env['FERT_TABLE_PATH'] = self._table_path
+        # Пул PDF ділить ядра між воркерами, а не запускається повністю в кожному
+        env.setdefault('PDF_WORKERS', str(max(1, (os.cpu_count() or 1) // self.workers)))
+        # Стан FSM у SQLite - окремий файл на шард: користувачі шарда не перетинаються,
+        # а спільний файл змушував би процеси чекати блокування запису один одного
+        fsm_url = os.getenv('FSM_STORAGE_URL') or os.getenv('STORAGE_URL', 'sqlite:///bot_data.db')
+        if fsm_url.startswith('sqlite:///'):
+            root, ext = os.path.splitext(fsm_url)
+            env['FSM_STORAGE_URL'] = f'{root}.shard{index}{ext}'
+        if os.getenv('METRICS_PORT'):
+            # Кожен воркер віддає власні метрики на наступному порту
+            env['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + index)
+        return env
+
+    async def start(self):
+        self._table_path = _share_table()
+        for index in range(self.workers):
+            await self._spawn(index)
+
+    async def _spawn(self, index):
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, self.script, stdin=asyncio.subprocess.PIPE, env=self._env(index))
+        self.processes[index] = process
+        self._started[index] = time.monotonic()
+        logging.info('Воркер %d запущено (pid %d)', index, process.pid)
+        watcher = asyncio.create_task(self._watch(index, process))
+        self._watchers.add(watcher)
+        watcher.add_done_callback(self._watchers.discard)
+        pending = self._pending[index]
+        while pending and self.processes[index] is process:
+            if not await self._write(index, process, pending.popleft()):
+                break
+
+    # Перезапуск воркера, що завершився не з волі супервізора
+    async def _watch(self, index, process):
+        code = await process.wait()
+        if self._stopping or self.processes[index] is not process:
+            return
+        self.processes[index] = None
+        self.restarts += 1
+        # Воркер, що падає одразу після запуску, перезапускаємо з наростаючою паузою
+        if time.monotonic() - self._started[index] < 10:
+            self._failures[index] += 1
+        else:
+            self._failures[index] = 0
+        delay = min(30, 2 ** self._failures[index] - 1)
+        logging.error('Воркер %d (pid %d) завершився з кодом %s, перезапуск через %d с',
+                      index, process.pid, code, delay)
+        await asyncio.sleep(delay)
+        if not self._stopping:
+            await self._spawn(index)
+
+    async def _write(self, index, process, frame):
+        try:
+            process.stdin.write(frame)
+            await process.stdin.drain()
+            return True
+        except (BrokenPipeError, ConnectionResetError):
+            self._pending[index].appendleft(frame)
+            return False
+
+    # Передача сирого оновлення (bytes з JSON) воркеру його користувача
+    async def dispatch(self, body, update=None):
+        if update is None:
+            update = json.loads(body)
+        index = route_key(update) % self.workers
+        frame = len(body).to_bytes(4, 'big') + body
+        process = self.processes[index]
+        # Поки черга не спорожніла, нові оновлення стають за нею, щоб зберегти порядок
+        if process is None or process.returncode is not None or self._pending[index]:
+            self._pending[index].append(frame)
+            return
+        await self._write(index, process, frame)
+
+    def alive(self):
+        return [process is not None and process.returncode is None for process in self.processes]
+
+    # Закриття stdin - сигнал воркеру дообробити прийняте і завершитися
+    async def stop(self):
+        self._stopping = True
+        processes = [process for process in self.processes if process is not None]
+        for process in processes:
+            if process.returncode is None:
+                process.stdin.close()
+        if processes:
+            await asyncio.wait([asyncio.create_task(p.wait()) for p in processes], timeout=self.drain_timeout + 5)
+        for process in processes:
+            if process.returncode is None:
+                logging.warning('Воркер pid %d не завершився вчасно, зупиняємо примусово', process.pid)
+                process.kill()
+                await process.wait()
+        if self._table_path:
+            os.unlink(self._table_path)
+
+
+# Long polling у супервізорі: сирий JSON без розбору в моделі aiogram
+# (параметри - формою, як їх надсилає сесія aiogram)
+async def _poll(bot, supervisor, allowed_updates, stopped, timeout=30):
+    url = bot.session.api.api_url(token=bot.token, method='getUpdates')
+    offset = None
+    failures = 0
+    async with aiohttp.ClientSession() as session:
+        while not stopped.is_set():
+            params = {'timeout': str(timeout), 'allowed_updates': json.dumps(allowed_updates)}
+            if offset is not None:
+                params['offset'] = str(offset)
+            try:
+                async with session.post(url, data=params,
+                                        timeout=aiohttp.ClientTimeout(total=timeout + 10)) as response:
+                    data = await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                failures += 1
+                logging.error('Помилка getUpdates: %s', e)
+                await asyncio.sleep(min(5, failures))
+                continue
+            if not data.get('ok'):
+                failures += 1
+                logging.error('getUpdates: %s', data.get('description'))
+                await asyncio.sleep(data.get('parameters', {}).get('retry_after') or min(5, failures))
+                continue
+            failures = 0
+            for update in data['result']:
+                offset = update['update_id'] + 1
+                await supervisor.dispatch(json.dumps(update, ensure_ascii=False).encode(), update)
+
+
+# Webhook у супервізорі: перевірка секрету і передача тіла запиту воркеру як є
+def _webhook_app(supervisor, config):
+    app = web.Application()
+
+    async def receive(request):
+        if config.secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != config.secret:
+            return web.Response(status=401)
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        await supervisor.dispatch(body, update)
+        return web.Response()
+
+    async def health(request):
+        alive = supervisor.alive()
+        return web.json_response({'status': 'ok' if all(alive) else 'degraded', 'workers': alive,
+                                  'restarts': supervisor.restarts, 'pid': os.getpid()},
+                                 status=200 if any(alive) else 503)
+
+    app.router.add_post(config.path, receive)
+    app.router.add_get('/health', health)
+    return app
+
+
+async def _set_webhook(bot, config, allowed_updates):
+    url = bot.session.api.api_url(token=bot.token, method='setWebhook')
+    params = {'url': config.url.rstrip('/') + config.path, 'allowed_updates': json.dumps(allowed_updates)}
+    if config.secret:
+        params['secret_token'] = config.secret
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, data=params) as response:
+            data = await response.json()
+    if not data.get('ok'):
+        logging.error('setWebhook: %s', data.get('description'))
+
+
+async def supervise(dp, bot, workers, mode='polling'):
+    config = webhook.WebhookConfig.from_env()
+    supervisor = Supervisor(workers, drain_timeout=config.drain_timeout)
+    allowed_updates = dp.resolve_used_update_types()
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopped.set)
+    await supervisor.start()
+    logging.info('Супервізор (pid %d): %d воркерів, режим %s', os.getpid(), workers, mode)
+    runner = None
+    try:
+        if mode == 'webhook':
+            runner = web.AppRunner(_webhook_app(supervisor, config))
+            await runner.setup()
+            await web.TCPSite(runner, config.host, config.port).start()
+            if config.url:
+                await _set_webhook(bot, config, allowed_updates)
+            await stopped.wait()
+        else:
+            poller = asyncio.create_task(_poll(bot, supervisor, allowed_updates, stopped))
+            await stopped.wait()
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        await supervisor.stop()
+
+
+def run(dp, bot, workers, mode='polling'):
+    asyncio.run(supervise(dp, bot, workers, mode))
+
+
+async def _process(dp, bot, body):
+    try:
+        await dp.feed_raw_update(bot, json.loads(body))
+    except Exception:
+        logging.exception('Помилка обробки оновлення')
+
+
+# Процес-воркер: читає кадри з stdin і обробляє кожне оновлення окремою задачею.
+# Кінець stdin - команда супервізора на зупинку.
+async def run_worker(dp, bot, drain_timeout=30.0):
+    # Ctrl+C отримує вся група процесів; зупинкою воркерів керує супервізор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer)
+    metrics_runner = await metrics.start_server()
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    tasks = set()
+    try:
+        while True:
+            try:
+                header = await reader.readexactly(4)
+                body = await reader.readexactly(int.from_bytes(header, 'big'))
+            except asyncio.IncompleteReadError:
+                break
+            task = asyncio.create_task(_process(dp, bot, body))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks, timeout=drain_timeout)
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
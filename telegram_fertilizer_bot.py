@@ -1,36 +1,103 @@
+import sys
+# Профіль запуску вмикається до решти імпортів, щоб виміряти кожен з них
+if '--profile-startup' in sys.argv:
+    import startup_profile
+    startup_profile.install()
 import asyncio
 from aiogram import Bot, Dispatcher, types
 import logging
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, LabeledPrice, PreCheckoutQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import LabeledPrice, PreCheckoutQuery, InlineQueryResultArticle, InputTextMessageContent, InlineQueryResultsButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.filters import Command
-from aiogram.types.input_file import InputFile
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
+from aiogram.filters import Command, CommandObject
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+import functools
+from aiogram.types.input_file import BufferedInputFile
+from aiogram.client.telegram import TelegramAPIServer
+import hashlib
+import importlib
 import os
+import time
+from datetime import datetime
 from dotenv import load_dotenv
+from fertilizer_engine import compute, region_to_zone, n_forms, p_forms, k_forms
+from pdf_reports import PdfRenderPool, PdfQueueFull, PdfCache, render_pdf
+from storage import create_storage
+from cache import BoundedCache
+import crop_guide
+import reminders
+from matching import ChoiceIndex
+from fsm_storage import create_fsm_storage, FSMSessionIsolation
+import webhook
+import metrics
+from keyboards import KeyboardSession, reply_keyboard, inline_keyboard
+from send_queue import SendQueue
+import throttling
+import supervisor
+import quick_calc
+import results
+from results import FertilizerPlan
 
 # Завантаження токенів з .env (токен бота та LiqPay провайдера)
 load_dotenv()
 TOKEN = os.getenv('TOKEN')
 PROVIDER_TOKEN = os.getenv('PROVIDER_TOKEN')
+# Адреса сховища даних: sqlite:///шлях.db або redis://хост:порт/база
+STORAGE_URL = os.getenv('STORAGE_URL', 'sqlite:///bot_data.db')
+# Режим отримання оновлень: polling (за замовчуванням) або webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Адреса Bot API (власний сервер Bot API або локальний тестовий стенд fake_telegram.py)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+# Кількість процесів-шардів під супервізором (supervisor.py); 1 - один процес без супервізора.
+# Кілька воркерів webhook (WEBHOOK_WORKERS) - це ті самі шарди: оновлення одного користувача
+# завжди обробляє один процес, тож стан FSM, ліміти частоти і кеш лічильників не розходяться
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 1)) if BOT_MODE == 'webhook' else 1
+SHARD_WORKERS = max(int(os.getenv('SHARD_WORKERS', 1)), WEBHOOK_WORKERS)
+# Номер шарда; задається супервізором процесам-воркерам
+SHARD_INDEX = os.getenv('SHARD_INDEX')
 
-# Ініціалізація бота і диспетчера
-bot = Bot(token=TOKEN)
-dp = Dispatcher()
+# Ініціалізація диспетчера; бот (сесія, мережеві налаштування) створюється лише
+# під час запуску у create_bot(), тож імпорт модуля не має побічних ефектів.
+# Хендлери звертаються до бота через подію (message.bot, callback_query.bot).
+# Стани FSM зберігаються постійно; за оновлення - одне читання і не більше одного запису.
+# Незавершений діалог видаляється через FSM_SESSION_TTL секунд без змін (0 - не видаляти)
+fsm_storage = create_fsm_storage(os.getenv('FSM_STORAGE_URL', STORAGE_URL),
+                                 ttl=int(os.getenv('FSM_SESSION_TTL', 86400)))
+dp = Dispatcher(storage=fsm_storage, events_isolation=FSMSessionIsolation(fsm_storage))
+# Обмеження частоти оновлень і повторних натискань кнопок (до читання стану FSM)
+throttling_middleware = throttling.ThrottlingMiddleware.from_env()
+if throttling_middleware is not None:
+    throttling.setup(dp, throttling_middleware)
 
 # Логування
 logging.basicConfig(level=logging.INFO)
 
 # Дані для відстеження використання і оплат
-usage_count = {}    # лічильник розрахунків для кожного користувача
-payment_count = {}  # лічильник успішних оплат для кожного користувача
-final_recommendations = {}  # останні сформовані рекомендації для кожного користувача
+# Лічильники розрахунків і оплат та останні сформовані рекомендації для кожного
+# користувача зберігаються у постійному сховищі (SQLite або Redis, див. STORAGE_URL).
+# Лічильники SQLite кешуються в пам'яті з обмеженням STORAGE_CACHE_SIZE/_TTL/_MAX_BYTES
+usage_cache = BoundedCache.from_env('STORAGE_CACHE', max_entries=100_000, ttl=3600)
+storage = create_storage(STORAGE_URL, cache=usage_cache)
+
+# Нагадування про внесення добрив за фазами (сховище - REMINDERS_URL, за замовчуванням STORAGE_URL).
+# Шард розсилає нагадування лише своїх користувачів
+reminder_store = reminders.create_reminder_store(os.getenv('REMINDERS_URL', STORAGE_URL))
+reminder_scheduler = reminders.ReminderScheduler.from_env(
+    reminder_store, shard=(int(SHARD_INDEX), SHARD_WORKERS) if SHARD_INDEX is not None else None)
 
 # Адміністраторські налаштування (ID користувачів з необмеженим доступом)
 ADMIN_IDS = []  # заповнити список ID адміністраторів, що мають безкоштовний доступ
 
+# Безкоштовних розрахунків на користувача; кожна оплата додає ще один
+FREE_CALCULATIONS = 1
+# Рахунок за додатковий розрахунок (ціна в центах: 1000 = 10.00 USD)
+INVOICE_PAYLOAD = 'calc_payment'
+INVOICE_CURRENCY = 'USD'
+INVOICE_AMOUNT = 1000
+
+# Максимальний розмір файлу для пакетного розрахунку (обмеження Bot API на завантаження)
+BATCH_MAX_FILE_SIZE = 20 * 1024 * 1024
+
 # Визначення станів для FSM (кроки сценарію взаємодії)
 class FertilizerCalculation(StatesGroup):
     crop = State()       # вибір культури
@@ -45,6 +112,10 @@ class FertilizerCalculation(StatesGroup):
     choose_k = State()    # вибір форми калійного добрива
     area = State()        # введення площі поля для фінального розрахунку
 
+# Налаштування нагадувань після розрахунку
+class ReminderSetup(StatesGroup):
+    sowing_date = State()  # введення дати сівби
+
 # Довідкові списки та словники для варіантів вибору
 crops = ['Пшениця', 'Кукурудза', 'Соняшник', 'Ріпак', 'Ячмінь', 'Соя']
 soil_types = ['Чорнозем', 'Сірозем', 'Піщаний', 'Глинистий', 'Супіщаний']
@@ -57,104 +128,408 @@ regions = [
     'Хмельницька', 'Черкаська', 'Чернівецька', 'Чернігівська'
 ]
 
-# Класифікація регіонів за зонами зволоження (на основі історичних даних опадів)
-region_to_zone = {
-    # Низька зволоженість (південь, частково схід)
-    'Одеська': 'Низька', 'Миколаївська': 'Низька', 'Херсонська': 'Низька',
-    'Запорізька': 'Низька', 'Донецька': 'Низька', 'Луганська': 'Низька',
-    'Дніпропетровська': 'Низька', 'Кіровоградська': 'Низька',
-    # Середня зволоженість (центр, частково схід/захід)
-    'Харківська': 'Середня', 'Полтавська': 'Середня', 'Черкаська': 'Середня',
-    'Київська': 'Середня', 'Тернопільська': 'Середня', 'Хмельницька': 'Середня',
-    'Вінницька': 'Середня',
-    # Достатня зволоженість (захід, північ)
-    'Львівська': 'Достатня', 'Івано-Франківська': 'Достатня', 'Закарпатська': 'Достатня',
-    'Чернівецька': 'Достатня', 'Волинська': 'Достатня', 'Рівненська': 'Достатня',
-    'Житомирська': 'Достатня', 'Чернігівська': 'Достатня', 'Сумська': 'Достатня'
-}
-# Примітка: Регіони, не вказані у словнику, за замовчуванням вважаються середньозволоженими.
-
-# Середня врожайність по Україні (Мінагрополітики, 2024) для основних культур, т/га
-national_yield_2024 = {
-    'пшениця': 4.47,    # 44.7 ц/га
-    'кукурудза': 6.40,  # 64.0 ц/га
-    'соняшник': 2.30,   # ~23 ц/га
-    'ріпак': 2.74,      # 27.4 ц/га
-    'ячмінь': 3.81,     # 38.1 ц/га
-    'соя': 2.28         # 22.8 ц/га
-}
-
-# Функція створення клавіатури з опціональними кнопками "Назад" та "Пропустити"
-def create_keyboard(options, add_back=False, add_skip=False):
-    keyboard = [[KeyboardButton(text=option)] for option in options]
-    if add_back:
-        keyboard.append([KeyboardButton(text='⬅️ Назад')])
-    if add_skip:
-        keyboard.append([KeyboardButton(text='Пропустити')])
-    return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
-
-# Функція генерації PDF із рекомендаціями
-async def generate_pdf(recommendation_text: str):
-    filename = 'recommendation.pdf'
-    c = canvas.Canvas(filename, pagesize=letter)
-    # Розбиваємо текст рекомендацій на рядки
-    lines = recommendation_text.split('\n')
-    y = 750  # початкова висота для першого рядка
-    c.setFont('Helvetica', 12)
-    c.drawString(50, y + 20, 'Рекомендації по живленню')  # заголовок
-    for line in lines:
-        c.drawString(50, y, line)
-        y -= 20  # зміщуємося вниз для наступного рядка
-    c.save()
-    return filename
+# Варіанти форм добрив для кроків зміни форми
+n_options = ['Амміачна селітра (34% N)', 'Карбамід (46% N)', 'КАС (32% N)']
+p_options = ['Діамофосфат (DAP, 46% P2O5)', 'Суперфосфат (46% P2O5)']
+k_options = ['Калій хлористий (60% K2O)', 'Калій сульфат (50% K2O)']
+
+OPTIMIZE_BUTTON = '💰 Найдешевший набір'
+
+# Індекси для розпізнавання введеного тексту (регістр, апострофи, латиниця, одна помилка)
+crop_index = ChoiceIndex(crops)
+prev_crop_index = ChoiceIndex(previous_crops)
+region_index = ChoiceIndex(regions)
+soil_index = ChoiceIndex(soil_types)
+action_index = ChoiceIndex({
+    'Змінити азот': 'n', 'азот': 'n', 'азотне': 'n',
+    'Змінити фосфор': 'p', 'фосфор': 'p', 'фосфорне': 'p',
+    'Змінити калій': 'k', 'калій': 'k', 'калійне': 'k',
+    'Продовжити': 'continue', 'далі': 'continue',
+    OPTIMIZE_BUTTON: 'optimize', 'оптимізувати': 'optimize', 'найдешевше': 'optimize',
+})
+# Підпис до файлу пакетного розрахунку, що вмикає підбір найдешевшого набору
+optimize_index = ChoiceIndex(['оптимізувати', 'оптимізація', 'optimize'])
+# Підпис, що додає до результату пакетного розрахунку PDF звіт по полях
+report_index = ChoiceIndex(['звіт', 'pdf', 'report'])
+
+# Клавіатури створюються один раз при запуску і повторно використовуються в усіх хендлерах
+start_kb = inline_keyboard([
+    [('📊 Розрахунок добрив', 'calc_fertilizer')],
+    [('🌱 Довідник культур', crop_guide.START)],
+    [('📄 Отримати PDF', 'get_pdf')],
+])
+crop_kb = reply_keyboard(crops)
+prev_crop_kb = reply_keyboard(previous_crops, add_back=True)
+region_kb = reply_keyboard(regions, add_back=True)
+soil_kb = reply_keyboard(soil_types, add_back=True)
+back_kb = reply_keyboard([], add_back=True)  # для введення врожайності і pH
+form_kb = reply_keyboard(['Змінити азот', 'Змінити фосфор', 'Змінити калій', OPTIMIZE_BUTTON, 'Продовжити'],
+                         add_back=True)
+n_kb = reply_keyboard(n_options, add_back=True)
+p_kb = reply_keyboard(p_options, add_back=True)
+k_kb = reply_keyboard(k_options, add_back=True)
+area_kb = reply_keyboard([], add_back=True, add_skip=True)
+pdf_kb = inline_keyboard([[('📄 Отримати PDF', 'get_pdf')]])
+# Після завершеного розрахунку: PDF і нагадування про внесення за фазами
+result_kb = inline_keyboard([[('📄 Отримати PDF', 'get_pdf')], [('🔔 Нагадати про внесення', 'remind')]])
+sowing_kb = reply_keyboard(['Сьогодні'], add_back=True)
+reminders_kb = inline_keyboard([[('🔕 Скасувати всі', 'reminders_off')]])
+
+# Пул рендерингу PDF (розмір, черга і тайм-аут задаються змінними оточення)
+pdf_pool = PdfRenderPool.from_env()
+# Кеш відрендерених звітів і їх file_id у Telegram
+pdf_cache = PdfCache.from_env()
+# Кеш готових відповідей /calc та inline-режиму за параметрами розрахунку
+calc_cache = BoundedCache.from_env('CALC_CACHE', max_entries=10000, max_bytes=32 * 1024 * 1024)
+# Скільки секунд Telegram може повторно показувати inline-результат без запиту до бота
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', 300))
+
+# Метрики: час хендлерів і операцій сховищ (віддаються на /metrics); запити до Bot API - у create_bot()
+metrics.setup(dp)
+metrics.instrument(storage, metrics.storage_seconds,
+                   ['get_counts', 'add_usage', 'consume_quota', 'credit_payment', 'get_recommendation',
+                    'set_recommendation', 'flush'])
+metrics.instrument(fsm_storage, metrics.storage_seconds, ['_load', '_save', '_delete'], prefix='fsm_')
+if throttling_middleware is not None:
+    metrics.register_gauge('bot_throttled_updates_total', 'Updates dropped by the per-user rate limit',
+                           lambda: throttling_middleware.throttled, kind='counter')
+    metrics.register_gauge('bot_duplicate_callbacks_total', 'Repeated button presses dropped',
+                           lambda: throttling_middleware.duplicates, kind='counter')
+metrics.register_gauge('bot_pdf_queue_pending', 'PDF jobs running or queued', lambda: pdf_pool.pending)
+metrics.register_gauge('bot_pdf_cache_entries', 'Cached PDF reports', lambda: pdf_cache.stats()['entries'])
+metrics.register_gauge('bot_pdf_cache_bytes', 'Cached PDF bytes', lambda: pdf_cache.size)
+metrics.register_gauge('bot_pdf_cache_hit_rate', 'PDF cache hit rate', lambda: round(pdf_cache.stats()['hit_rate'], 4))
+metrics.register_gauge('bot_calc_cache_entries', 'Cached one-shot calculation results', lambda: len(calc_cache))
+metrics.register_gauge('bot_calc_cache_hits_total', 'One-shot calculation cache hits',
+                       lambda: calc_cache.hits, kind='counter')
+metrics.register_gauge('bot_calc_cache_bytes', 'Approximate size of cached calculation results', lambda: calc_cache.size)
+metrics.register_gauge('bot_calc_cache_evictions_total', 'Calculation results evicted (LRU, memory, TTL)',
+                       lambda: sum(calc_cache.evictions.values()), kind='counter')
+metrics.register_gauge('bot_usage_cache_entries', 'Cached user counters', lambda: len(usage_cache))
+metrics.register_gauge('bot_usage_cache_bytes', 'Approximate size of cached user counters', lambda: usage_cache.size)
+metrics.register_gauge('bot_usage_cache_evictions_total', 'User counters evicted (LRU, memory, TTL)',
+                       lambda: sum(usage_cache.evictions.values()), kind='counter')
+metrics.register_gauge('bot_fsm_sessions_expired_total', 'Abandoned FSM sessions deleted',
+                       lambda: fsm_storage.expired, kind='counter')
+metrics.register_gauge('bot_reminders_pending', 'Reminders scheduled in this process', lambda: reminder_scheduler.pending)
+metrics.register_gauge('bot_reminders_sent_total', 'Reminders delivered', lambda: reminder_scheduler.sent, kind='counter')
+metrics.register_gauge('bot_reminders_failed_total', 'Reminders that could not be delivered',
+                       lambda: reminder_scheduler.failed + reminder_scheduler.dropped, kind='counter')
+
+# Створення бота: сесія підставляє заздалегідь серіалізовані клавіатури з реєстру
+# keyboards, черга відправки дотримується лімітів Telegram (загальний ліміт ділиться
+# між шардами), запити до Bot API потрапляють у метрики
+def create_bot():
+    session = KeyboardSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else KeyboardSession()
+    send_queue = SendQueue.from_env(share=SHARD_WORKERS)
+    if send_queue is not None:
+        session.middleware(send_queue)
+        metrics.register_gauge('bot_send_queue_waiting', 'Messages waiting for the global send limit',
+                               lambda: send_queue.waiting)
+        metrics.register_gauge('bot_send_retry_after_total', 'Flood control (429) responses received',
+                               lambda: send_queue.retries, kind='counter')
+    metrics.setup_session(session)
+    return Bot(token=TOKEN, session=session)
+
+# Функція генерації PDF (рендеринг у пам'яті в пулі воркерів): render - pdf_pool.render
+# (текст рекомендацій) або pdf_pool.render_lines (рядки і заголовок звіту по полях)
+async def generate_pdf(render, *args) -> bytes:
+    started = time.perf_counter()
+    result = 'error'
+    try:
+        pdf_bytes = await render(*args)
+        result = 'ok'
+        return pdf_bytes
+    except PdfQueueFull:
+        result = 'queue_full'
+        raise
+    except asyncio.TimeoutError:
+        result = 'timeout'
+        raise
+    finally:
+        metrics.pdf_render_seconds.observe(result, time.perf_counter() - started)
+
+# Результат розрахунку одним повідомленням: (текст відповіді, рекомендація для PDF, заголовок
+# і опис inline-результату). Залежить лише від параметрів, тому однакові запити беруться з кешу.
+# У кеші - лише рядки (розмір для стелі пам'яті оцінюється точно), inline-результат
+# будується з них під час запиту
+def quick_result(params):
+    cached = calc_cache.get(params)
+    if cached is not None:
+        return cached
+    rec = compute(params.crop, params.prev_crop, params.moisture, params.soil_type, params.yield_goal, params.ph)
+    plan = FertilizerPlan.from_recommendation(rec, params.region, params.area)
+    text = results.chat_rates(plan) + '\n' + results.chat_fertilizers(plan, '💊 Рекомендовані добрива (на 1 га):\n')
+    title = f'{rec.crop.capitalize()}, {params.yield_goal:g} т/га, {params.region}'
+    if params.area is not None:
+        text += '\n' + results.chat_totals(plan)
+        title += f', {params.area:g} га'
+    description = f'N {rec.N_per_ha:.0f} · P {rec.P_per_ha:.0f} · K {rec.K_per_ha:.0f} кг/га'
+    cached = (text, results.pack(plan), title, description)
+    calc_cache.put(params, cached)
+    return cached
 
 # Команда /start - стартове повідомлення з меню
 @dp.message(Command('start'))
 async def cmd_start(message: types.Message):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text='📊 Розрахунок добрив', callback_data='calc_fertilizer')],
-        [InlineKeyboardButton(text='🌱 Довідник культур', callback_data='crop_guide')],
-        [InlineKeyboardButton(text='📄 Отримати PDF', callback_data='get_pdf')]
-    ])
-    await message.answer('Вітаю! Я бот-агроном. Оберіть дію:', reply_markup=keyboard)
+    await message.answer('Вітаю! Я бот-агроном. Оберіть дію:', reply_markup=start_kb)
+
+# Розрахунок одним повідомленням: /calc пшениця бобові Київська 6 чорнозем 6.2 100
+# (працює в будь-якому стані діалогу і не змінює його)
+@dp.message(Command('calc'))
+async def cmd_calc(message: types.Message, command: CommandObject):
+    if not command.args:
+        await message.answer('🧮 Розрахунок одним повідомленням.\n' + quick_calc.USAGE)
+        return
+    try:
+        params = quick_calc.parse(command.args)
+    except quick_calc.CalcError as e:
+        await message.answer(f'❗ {e}.\n{quick_calc.USAGE}')
+        return
+    user_id = message.from_user.id
+    if not await consume_quota(user_id):
+        await send_payment_invoice(message.bot, user_id)
+        return
+    text, report, _, _ = quick_result(params)
+    await storage.set_recommendation(user_id, report)
+    await message.answer(text + '\n✅ Розрахунок завершено.', reply_markup=result_kb)
+
+# Inline-режим (@бот пшениця бобові Київська 6 чорнозем 6.2): відповідь з тієї самої
+# попередньо обчисленої моделі. Розрахунок не списується, але потребує доступного ліміту
+@dp.inline_query()
+async def inline_calc(inline_query: types.InlineQuery):
+    query = inline_query.query.strip()
+    try:
+        params = quick_calc.parse(query)
+    except quick_calc.CalcError as e:
+        hint = InlineQueryResultArticle(
+            id='usage', title='🧮 Розрахунок добрив',
+            description=str(e) if query else quick_calc.USAGE.split('\n')[0],
+            input_message_content=InputTextMessageContent(message_text=quick_calc.USAGE),
+        )
+        await inline_query.answer([hint], cache_time=INLINE_CACHE_TIME)
+        return
+    if not await has_quota(inline_query.from_user.id):
+        button = InlineQueryResultsButton(text='Ліміт вичерпано - оплатити в боті', start_parameter='pay')
+        await inline_query.answer([], cache_time=0, is_personal=True, button=button)
+        return
+    text, _, title, description = quick_result(params)
+    article = InlineQueryResultArticle(
+        id=hashlib.sha1(repr(params).encode('utf-8')).hexdigest(),
+        title=title,
+        description=description,
+        input_message_content=InputTextMessageContent(message_text=text),
+    )
+    await inline_query.answer([article], cache_time=INLINE_CACHE_TIME, is_personal=True)
+
+# Пакетний розрахунок: опис формату файлу
+@dp.message(Command('batch'))
+async def cmd_batch(message: types.Message):
+    await message.answer(
+        '📑 Пакетний розрахунок для багатьох полів.\n'
+        'Надішліть файл CSV або XLSX, де кожен рядок - одне поле, з колонками:\n'
+        'crop, prev_crop, region, yield_goal, soil_type, ph\n'
+        'Необов\'язкові: area (га), n_form, p_form, k_form.\n'
+        'У відповідь ви отримаєте файл з нормами елементів і добрив для кожного поля.\n'
+        'Додайте до файлу підпис "оптимізувати", щоб отримати ще й найдешевший набір добрив (колонки opt_*).\n'
+        'Підпис "звіт" додає PDF звіт по полях (до 5000 полів, файлами по 500 полів).'
+    )
+
+# Обробник завантаженого файлу з полями (пакетний розрахунок)
+@dp.message(lambda message: message.document is not None)
+async def process_batch_file(message: types.Message):
+    user_id = message.from_user.id
+    document = message.document
+    if document.file_size and document.file_size > BATCH_MAX_FILE_SIZE:
+        await message.answer('❗ Файл завеликий (максимум 20 МБ).')
+        return
+    # Пакетний розрахунок зараховується як один розрахунок
+    if not await has_quota(user_id):
+        await send_payment_invoice(message.bot, user_id)
+        return
+    file = await message.bot.download(document)
+    optimize = optimize_index.match(message.caption) is not None
+    report = report_index.match(message.caption) is not None
+    # NumPy і pandas імпортуються лише при першому пакетному розрахунку
+    import batch
+    try:
+        # Розбір файлу і розрахунок виконуються поза циклом подій
+        data, filename, rows, errors, result = await asyncio.to_thread(
+            batch.process_file, file.read(), document.file_name or 'fields.csv', optimize)
+    except batch.BatchError as e:
+        await message.answer(f'❗ {e}')
+        return
+    except Exception:
+        logging.exception('Помилка пакетного розрахунку')
+        await message.answer('❗ Не вдалося прочитати файл. Перевірте формат (CSV або XLSX).')
+        return
+    # Ліміт міг бути витрачений паралельно (інший розрахунок під час обробки файлу)
+    if not await consume_quota(user_id):
+        await send_payment_invoice(message.bot, user_id)
+        return
+    caption = f'✅ Розраховано полів: {rows - errors} з {rows}.'
+    if errors:
+        caption += f' Рядків з помилками: {errors} (див. колонку error).'
+    await message.answer_document(BufferedInputFile(data, filename=filename), caption=caption)
+    if report:
+        await send_batch_report(message, result, filename.rsplit('_result.', 1)[0])
+
+# PDF звіт пакетного розрахунку. Великий звіт ділиться на файли по batch.REPORT_PART_ROWS полів:
+# кожен рендериться в пулі PDF і надсилається до початку наступного, тож пам'ять рендерингу
+# не залежить від кількості полів (reportlab тримає всі сторінки документа до кінця)
+async def send_batch_report(message, result, name):
+    import batch
+    if len(result) > batch.MAX_REPORT_ROWS:
+        await message.answer(f'ℹ️ PDF звіт формується для файлів до {batch.MAX_REPORT_ROWS} полів.')
+        return
+    parts = batch.report_parts(result)
+    for index in range(parts):
+        title, lines = batch.report_part(result, index)
+        try:
+            pdf_bytes = await generate_pdf(pdf_pool.render_lines, lines, title)
+        except PdfQueueFull:
+            await message.answer('❗ Забагато запитів на звіти, спробуйте за хвилину.')
+            return
+        except asyncio.TimeoutError:
+            await message.answer('❗ Не вдалося вчасно сформувати звіт. Спробуйте ще раз.')
+            return
+        filename = f'{name}_report.pdf' if parts == 1 else f'{name}_report_{index + 1}.pdf'
+        await message.answer_document(BufferedInputFile(pdf_bytes, filename=filename))
+
+# Останній розрахунок у CSV (ті самі колонки, що й у результаті пакетного розрахунку).
+# Команди зареєстровані раніше за обробники кроків діалогу, щоб працювати й посеред діалогу
+@dp.message(Command('export'))
+async def cmd_export(message: types.Message):
+    plan = results.unpack(await storage.get_recommendation(message.from_user.id))
+    if plan is None:
+        await message.answer('Немає даних для експорту. Виконайте розрахунок спочатку.')
+        return
+    await message.answer_document(BufferedInputFile(results.csv_bytes([plan]), filename='recommendation.csv'))
+
+# Статистика кешу PDF (лише для адміністраторів)
+@dp.message(Command('pdf_stats'))
+async def cmd_pdf_stats(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    stats = pdf_cache.stats()
+    await message.answer(
+        f'📄 Кеш PDF: записів {stats["entries"]}, {stats["bytes"] / 1024:.0f} КБ\n'
+        f'Влучання (file_id): {stats["file_id_hits"]}, влучання (байти): {stats["bytes_hits"]}\n'
+        f'Промахи: {stats["misses"]}, витіснено: {stats["evictions"]}, частка влучань: {stats["hit_rate"]:.0%}'
+    )
+
+# Статистика кешів у пам'яті і сесій FSM (лише для адміністраторів)
+@dp.message(Command('cache_stats'))
+async def cmd_cache_stats(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    lines = []
+    for name, cache in (('Лічильники', usage_cache), ('Розрахунки /calc', calc_cache)):
+        stats = cache.stats()
+        evictions = stats['evictions']
+        lines.append(f'🗄 {name}: записів {stats["entries"]}, ~{stats["bytes"] / 1024:.0f} КБ, '
+                     f'частка влучань {stats["hit_rate"]:.0%}\n'
+                     f'Витіснено: LRU {evictions["lru"]}, стеля пам\'яті {evictions["memory"]}, TTL {evictions["ttl"]}')
+    lines.append(f'⌛ Видалено покинутих діалогів: {fsm_storage.expired}')
+    await message.answer('\n'.join(lines))
+
+# Заплановані нагадування користувача (команда доступна й посеред діалогу розрахунку
+# чи налаштування нагадувань, тому зареєстрована раніше за обробники станів)
+@dp.message(Command('reminders'))
+async def cmd_reminders(message: types.Message):
+    pending = await reminder_store.for_user(message.from_user.id)
+    if not pending:
+        await message.answer('🔕 Запланованих нагадувань немає. Їх можна додати після розрахунку.')
+        return
+    lines = [f'   - {datetime.fromtimestamp(due, reminders.REMINDER_TZ):%d.%m.%Y}: {text.splitlines()[0]}'
+             for due, text in pending]
+    await message.answer(f'🔔 Заплановано нагадувань: {len(pending)}\n' + '\n'.join(lines), reply_markup=reminders_kb)
+
+# Чи має користувач доступний розрахунок (1 безкоштовний + кожен оплачений додає ще 1)
+async def has_quota(user_id):
+    if user_id in ADMIN_IDS:
+        return True
+    usage, payments = await storage.get_counts(user_id)
+    return usage < FREE_CALCULATIONS + payments
+
+# Списання розрахунку разом з перевіркою ліміту; False - розрахунків не лишилося
+async def consume_quota(user_id):
+    if user_id in ADMIN_IDS:
+        await storage.add_usage(user_id)
+        return True
+    return await storage.consume_quota(user_id, FREE_CALCULATIONS)
+
+# Рахунок на оплату додаткового розрахунку через LiqPay
+async def send_payment_invoice(bot, user_id):
+    prices = [LabeledPrice(label='Додатковий розрахунок', amount=INVOICE_AMOUNT)]
+    await bot.send_invoice(
+        chat_id=user_id,
+        title='Оплата розрахунку',
+        description='Оплата за додатковий розрахунок добрив',
+        provider_token=PROVIDER_TOKEN,
+        currency=INVOICE_CURRENCY,
+        prices=prices,
+        payload=INVOICE_PAYLOAD
+    )
+
+# Обробник передперевірки оплати (LiqPay). Telegram чекає відповіді не довше 10 с,
+# тому перевірка рахунку - лише в пам'яті, без звернень до сховища
+@dp.pre_checkout_query(lambda query: True)
+async def process_pre_checkout(pre_checkout_query: PreCheckoutQuery):
+    if pre_checkout_query.invoice_payload != INVOICE_PAYLOAD:
+        reason = 'payload'
+    elif pre_checkout_query.currency != INVOICE_CURRENCY or pre_checkout_query.total_amount != INVOICE_AMOUNT:
+        reason = 'amount'
+    else:
+        await pre_checkout_query.answer(ok=True)
+        return
+    metrics.rejected_checkouts_total.inc(reason)
+    await pre_checkout_query.answer(ok=False, error_message='Рахунок застарів. Запросіть новий розрахунок у боті.')
+
+# Обробник підтвердження успішної оплати (зареєстрований раніше за обробники кроків діалогу,
+# щоб повідомлення про оплату не перехоплювалося станом FSM)
+@dp.message(lambda message: message.successful_payment is not None)
+async def payment_successful(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    payment = message.successful_payment
+    credited = await storage.credit_payment(
+        user_id, payment.telegram_payment_charge_id, payment.total_amount, payment.currency,
+        payment.invoice_payload, payment.provider_payment_charge_id)
+    if not credited:
+        # Повторна доставка того самого оновлення: оплату вже зараховано і відповідь надіслано
+        logging.warning('Оплату %s користувача %s уже зараховано', payment.telegram_payment_charge_id, user_id)
+        metrics.duplicate_payments_total.inc()
+        return
+    metrics.payments_total.inc()
+    # Після оплати автоматично переходимо до вибору культури для нового розрахунку
+    await state.set_state(FertilizerCalculation.crop)
+    await message.answer('✅ Оплату отримано! Ви отримали додатковий розрахунок.\n🌾 Оберіть культуру:', reply_markup=crop_kb)
 
 # Обробник вибору "Розрахунок добрив" з перевіркою ліміту і оплати
 @dp.callback_query(lambda c: c.data == 'calc_fertilizer')
 async def start_calculation(callback_query: types.CallbackQuery, state: FSMContext):
     user_id = callback_query.from_user.id
-    # Перевірка ліміту безкоштовних розрахунків (1 безкоштовний + кожен оплачений додає ще 1)
-    if user_id not in ADMIN_IDS:
-        if usage_count.get(user_id, 0) >= 1 + payment_count.get(user_id, 0):
-            # Вимагаємо оплату через LiqPay (ціна в копійках: 1000 = 10.00 USD)
-            prices = [LabeledPrice(label='Додатковий розрахунок', amount=1000)]
-            await callback_query.answer()  # закриваємо сповіщення вибору
-            await bot.send_invoice(
-                chat_id=user_id,
-                title='Оплата розрахунку',
-                description='Оплата за додатковий розрахунок добрив',
-                provider_token=PROVIDER_TOKEN,
-                currency='USD',
-                prices=prices,
-                payload='calc_payment'
-            )
-            return
+    # Перевірка ліміту безкоштовних розрахунків; списується розрахунок лише після
+    # введення площі (атомарно з повторною перевіркою), а не на початку діалогу
+    if not await has_quota(user_id):
+        await callback_query.answer()  # закриваємо сповіщення вибору
+        await send_payment_invoice(callback_query.bot, user_id)
+        return
     # Якщо оплата не потрібна – починаємо сценарій розрахунку
     await state.set_state(FertilizerCalculation.crop)
-    crop_keyboard = create_keyboard(crops)
-    await callback_query.message.answer('🌾 Оберіть культуру:', reply_markup=crop_keyboard)
+    await callback_query.message.answer('🌾 Оберіть культуру:', reply_markup=crop_kb)
 
 # Обробник вибору культури
 @dp.message(FertilizerCalculation.crop)
 async def select_crop(message: types.Message, state: FSMContext):
-    text = message.text
-    if text not in crops:
+    crop = crop_index.match(message.text)
+    if crop is None:
         await message.answer('❗ Будь ласка, оберіть культуру з наведених варіантів.')
         return
     # Зберігаємо вибір культури (у нижньому регістрі для використання в словниках)
-    await state.update_data(crop=text.lower())
+    await state.update_data(crop=crop.lower())
     # Переходимо до вибору попередньої культури
     await state.set_state(FertilizerCalculation.prev_crop)
-    prev_crop_kb = create_keyboard(previous_crops, add_back=True)
     await message.answer('♻️ Оберіть тип попередньої культури:', reply_markup=prev_crop_kb)
 
 # Обробник вибору попередньої культури
@@ -164,17 +539,16 @@ async def select_prev_crop(message: types.Message, state: FSMContext):
     if text.endswith('Назад'):
         # Повернення до вибору культури
         await state.set_state(FertilizerCalculation.crop)
-        crop_kb = create_keyboard(crops)
         await message.answer('🌾 Оберіть культуру:', reply_markup=crop_kb)
         return
-    if text not in previous_crops:
+    prev_crop = prev_crop_index.match(text)
+    if prev_crop is None:
         await message.answer('❗ Виберіть попередник з наведених варіантів.')
         return
     # Зберігаємо попередню культуру
-    await state.update_data(prev_crop=text)
+    await state.update_data(prev_crop=prev_crop)
     # Перехід до вибору регіону
     await state.set_state(FertilizerCalculation.region)
-    region_kb = create_keyboard(regions, add_back=True)
     await message.answer('📍 Оберіть регіон вирощування:', reply_markup=region_kb)
 
 # Обробник вибору регіону
@@ -184,21 +558,18 @@ async def select_region(message: types.Message, state: FSMContext):
     if text.endswith('Назад'):
         # Повернення до вибору попередньої культури
         await state.set_state(FertilizerCalculation.prev_crop)
-        prev_crop_kb = create_keyboard(previous_crops, add_back=True)
         await message.answer('♻️ Оберіть тип попередньої культури:', reply_markup=prev_crop_kb)
         return
-    if text not in regions:
+    region = region_index.match(text)
+    if region is None:
         await message.answer('❗ Будь ласка, оберіть регіон з наведених варіантів.')
         return
-    # Зберігаємо регіон
-    await state.update_data(region=text)
-    # Визначаємо зону зволоження для цього регіону
-    zone = region_to_zone.get(text, 'Середня')
-    await state.update_data(moisture=zone)
+    # Зберігаємо регіон і зону зволоження для цього регіону
+    zone = region_to_zone.get(region, 'Середня')
+    await state.update_data(region=region, moisture=zone)
     # Запитуємо очікувану врожайність
     await state.set_state(FertilizerCalculation.yield_goal)
-    yield_kb = create_keyboard([], add_back=True)
-    await message.answer('📊 Вкажіть очікувану врожайність (т/га):', reply_markup=yield_kb)
+    await message.answer('📊 Вкажіть очікувану врожайність (т/га):', reply_markup=back_kb)
 
 # Обробник введення запланованої врожайності
 @dp.message(FertilizerCalculation.yield_goal)
@@ -207,7 +578,6 @@ async def input_yield(message: types.Message, state: FSMContext):
     if text.endswith('Назад'):
         # Повернення до вибору регіону
         await state.set_state(FertilizerCalculation.region)
-        region_kb = create_keyboard(regions, add_back=True)
         await message.answer('📍 Оберіть регіон вирощування:', reply_markup=region_kb)
         return
     # Обробляємо введення числового значення врожайності
@@ -223,7 +593,6 @@ async def input_yield(message: types.Message, state: FSMContext):
     await state.update_data(yield_goal=yield_goal)
     # Перехід до вибору типу ґрунту
     await state.set_state(FertilizerCalculation.soil_type)
-    soil_kb = create_keyboard(soil_types, add_back=True)
     await message.answer('🟤 Оберіть тип ґрунту:', reply_markup=soil_kb)
 
 # Обробник вибору типу ґрунту
@@ -233,18 +602,17 @@ async def select_soil(message: types.Message, state: FSMContext):
     if text.endswith('Назад'):
         # Повернення до введення врожайності
         await state.set_state(FertilizerCalculation.yield_goal)
-        yield_kb = create_keyboard([], add_back=True)
-        await message.answer('📊 Вкажіть очікувану врожайність (т/га):', reply_markup=yield_kb)
+        await message.answer('📊 Вкажіть очікувану врожайність (т/га):', reply_markup=back_kb)
         return
-    if text not in soil_types:
+    soil_type = soil_index.match(text)
+    if soil_type is None:
         await message.answer('❗ Будь ласка, оберіть тип ґрунту з клавіатури.')
         return
     # Зберігаємо тип ґрунту (у нижньому регістрі для використання в словниках)
-    await state.update_data(soil_type=text.lower())
+    await state.update_data(soil_type=soil_type.lower())
     # Перехід до введення pH ґрунту
     await state.set_state(FertilizerCalculation.ph)
-    ph_kb = create_keyboard([], add_back=True)
-    await message.answer('🧪 Введіть pH ґрунту:', reply_markup=ph_kb)
+    await message.answer('🧪 Введіть pH ґрунту:', reply_markup=back_kb)
 
 # Обробник введення pH ґрунту та обчислення рекомендацій
 @dp.message(FertilizerCalculation.ph)
@@ -253,7 +621,6 @@ async def compute_recommendations(message: types.Message, state: FSMContext):
     if text.endswith('Назад'):
         # Повернення до вибору типу ґрунту
         await state.set_state(FertilizerCalculation.soil_type)
-        soil_kb = create_keyboard(soil_types, add_back=True)
         await message.answer('🟤 Оберіть тип ґрунту:', reply_markup=soil_kb)
         return
     # Обробка введення pH як числа
@@ -264,179 +631,24 @@ async def compute_recommendations(message: types.Message, state: FSMContext):
         return
     # Отримуємо всі зібрані раніше дані із FSM
     data = await state.get_data()
-    crop = data['crop']
-    yield_goal = data['yield_goal']
-    prev_crop = data['prev_crop']
     moisture = data['moisture']
-    soil_type = data['soil_type']
     region = data.get('region', '')
-    # Базові вимоги до елементів (кг елемента на 1 т урожаю) для різних культур
-    base_requirements = {
-        'пшениця': {'N': 30, 'P': 10, 'K': 20},
-        'кукурудза': {'N': 25, 'P': 12, 'K': 25},
-        'соняшник': {'N': 42, 'P': 18, 'K': 85},
-        'соя': {'N': 15, 'P': 20, 'K': 30},
-        'ріпак': {'N': 50, 'P': 15, 'K': 40},
-        'ячмінь': {'N': 25, 'P': 10, 'K': 20}
-    }
-    result_text = ''
-    if crop not in base_requirements:
-        result_text = 'Помилка: невідома культура.'
-    else:
-        # Коефіцієнти коригування залежно від попередника, зони зволоження і типу ґрунту
-        N_factor = P_factor = K_factor = 1.0
-        # Попередня культура
-        if prev_crop == 'Бобові':
-            N_factor *= 0.8  # після бобових залишається більше азоту в ґрунті
-        if prev_crop == 'Чистий пар':
-            N_factor *= 0.9  # після пару потрібне трохи менше азоту
-        if prev_crop in ['Технічні', 'Овочі']:
-            # після технічних та овочевих культур можливе виснаження ґрунту
-            N_factor *= 1.1
-            P_factor *= 1.1
-            K_factor *= 1.1
-        # Зона зволоження
-        if moisture == 'Низька':
-            # У посушливих умовах зменшуємо норми (~ -10%)
-            N_factor *= 0.9
-            P_factor *= 0.9
-            K_factor *= 0.9
-        elif moisture == 'Достатня':
-            # У вологих умовах збільшуємо норми (~ +10%)
-            N_factor *= 1.1
-            P_factor *= 1.1
-            K_factor *= 1.1
-        # Тип ґрунту
-        if soil_type in ['піщаний', 'супіщаний']:
-            # Легкі ґрунти (піски) гірше утримують елементи – збільшуємо норму
-            N_factor *= 1.1
-            P_factor *= 1.1
-            K_factor *= 1.1
-        elif soil_type == 'чорнозем':
-            # Родючі чорноземи – трохи зменшуємо норму, частина потреби забезпечиться ґрунтом
-            N_factor *= 0.9
-            P_factor *= 0.9
-            K_factor *= 0.9
-        elif soil_type in ['глинистий', 'сірозем']:
-            # Глинисті та сіроземи – незначне зменшення норм
-            N_factor *= 0.95
-            P_factor *= 0.95
-            K_factor *= 0.95
-        # Розрахунок потреби елементів на 1 га для планової врожайності
-        base = base_requirements[crop]
-        N_rate = base['N'] * N_factor   # кг N на 1 т урожаю з урахуванням поправок
-        P_rate = base['P'] * P_factor   # кг P2O5 на 1 т урожаю
-        K_rate = base['K'] * K_factor   # кг K2O на 1 т урожаю
-        N_per_ha = N_rate * yield_goal  # кг N на 1 га
-        P_per_ha = P_rate * yield_goal  # кг P2O5 на 1 га
-        K_per_ha = K_rate * yield_goal  # кг K2O на 1 га
-        crop_name = crop.capitalize()
-        result_text += f'🔹 Для культури {crop_name} при врожайності {yield_goal:.1f} т/га:\n'
-        result_text += f'   - Азот (N): {N_per_ha:.1f} кг/га\n'
-        result_text += f'   - Фосфор (P): {P_per_ha:.1f} кг/га\n'
-        result_text += f'   - Калій (K): {K_per_ha:.1f} кг/га\n'
-        # Додаємо інформацію про середню врожайність у регіоні (2024) для довідки
-        if region:
-            avg_yield = None
-            if crop in national_yield_2024:
-                base_avg = national_yield_2024[crop]
-                zone_factor = 1.0
-                if moisture == 'Достатня':
-                    zone_factor = 1.3  # вологий регіон ~30% вище середнього
-                elif moisture == 'Низька':
-                    zone_factor = 0.7  # посушливий регіон ~30% нижче середнього
-                avg_yield = base_avg * zone_factor
-            if avg_yield:
-                result_text += f'   (Середня врожайність {crop_name} в {region} у 2024 р. ~ {avg_yield:.1f} т/га)\n'
-        # Рекомендації щодо вапнування при низькому pH
-        if ph_value < 5.0:
-            result_text += f'⚠️ Ґрунт кислий (pH {ph_value}). Рекомендовано вапнування (~2 т/га вапна).\n'
-        elif ph_value < 5.5:
-            result_text += f'⚠️ Ґрунт кислий (pH {ph_value}). Рекомендовано вапнування (~1 т/га вапна).\n'
-        else:
-            result_text += '✅ pH ґрунту в нормі, вапнування не потрібне.\n'
-        # Розподіл добрив по фазах росту (частка від загальної норми по кожному елементу)
-        phase_distribution = {
-            'пшениця': {
-                'N': [('перед сівбою', 0.5), ('у фазі кущіння', 0.5)],
-                'P': [('перед сівбою', 1.0)],
-                'K': [('перед сівбою', 1.0)]
-            },
-            'кукурудза': {
-                'N': [('перед сівбою', 0.5), ('у фазі 6-8 листків', 0.5)],
-                'P': [('перед сівбою', 1.0)],
-                'K': [('перед сівбою', 1.0)]
-            },
-            'соняшник': {
-                'N': [('перед сівбою', 0.7), ('на початку бутонізації', 0.3)],
-                'P': [('перед сівбою', 1.0)],
-                'K': [('перед сівбою', 1.0)]
-            },
-            'соя': {
-                'N': [('перед сівбою', 0.5), ('на початку цвітіння', 0.5)],
-                'P': [('перед сівбою', 1.0)],
-                'K': [('перед сівбою', 1.0)]
-            },
-            'ріпак': {
-                'N': [('перед сівбою', 0.5), ('на початку весняної вегетації', 0.5)],
-                'P': [('перед сівбою', 1.0)],
-                'K': [('перед сівбою', 1.0)]
-            },
-            'ячмінь': {
-                'N': [('перед сівбою', 0.5), ('у фазі кущіння', 0.5)],
-                'P': [('перед сівбою', 1.0)],
-                'K': [('перед сівбою', 1.0)]
-            }
-        }
-        result_text += '📈 Розподіл добрив по фазах росту:\n'
-        if crop in phase_distribution:
-            phases = phase_distribution[crop]
-            for nutrient, phases_list in phases.items():
-                if phases_list:
-                    name_ukr = 'Азот' if nutrient == 'N' else 'Фосфор' if nutrient == 'P' else 'Калій'
-                    portions = []
-                    total_per_ha = N_per_ha if nutrient == 'N' else P_per_ha if nutrient == 'P' else K_per_ha
-                    for phase, fraction in phases_list:
-                        amount = total_per_ha * fraction
-                        portions.append(f'{amount:.1f} кг - {phase}')
-                    result_text += f'   - {name_ukr}: ' + '; '.join(portions) + '\n'
-        # Зберігаємо розраховані потреби (для подальших кроків)
-        await state.update_data(N_per_ha=N_per_ha, P_per_ha=P_per_ha, K_per_ha=K_per_ha)
-    # Надсилаємо користувачу сформований текст рекомендацій (норми і фази)
-    await message.answer(result_text)
-    data = await state.get_data()
-    # Вибір форми азотного добрива за замовчуванням залежно від зони зволоження
-    if moisture == 'Низька':
-        N_form = 'Амміачна селітра (34% N)'
-        N_content = 0.34
-    else:
-        N_form = 'Карбамід (46% N)'
-        N_content = 0.46
-    # Форма фосфорного добрива (DAP за замовчуванням)
-    P_form = 'Діамофосфат (DAP, 46% P2O5)'
-    P_content = 0.46
-    # Форма калійного добрива (хлористий калій за замовчуванням)
-    K_form = 'Калій хлористий (KCl, 60% K2O)'
-    K_content = 0.60
-    # Зберігаємо вибір форм і вміст діючої речовини (%) для кожного добрива
-    await state.update_data(N_form=N_form, P_form=P_form, K_form=K_form,
-                             N_content=N_content, P_content=P_content, K_content=K_content)
-    # Обчислюємо рекомендовану кількість кожного добрива на 1 га
-    N_per_ha = data['N_per_ha']
-    P_per_ha = data['P_per_ha']
-    K_per_ha = data['K_per_ha']
-    N_fert_per_ha = N_per_ha / N_content
-    P_fert_per_ha = P_per_ha / P_content
-    K_fert_per_ha = K_per_ha / K_content
-    fert_text = '💊 Рекомендовані добрива (на 1 га):\n'
-    fert_text += f'   - Азот: {N_fert_per_ha:.1f} кг — {N_form}\n'
-    fert_text += f'   - Фосфор: {P_fert_per_ha:.1f} кг — {P_form}\n'
-    fert_text += f'   - Калій: {K_fert_per_ha:.1f} кг — {K_form}\n'
+    rec = compute(data['crop'], data['prev_crop'], moisture, data['soil_type'], data['yield_goal'], ph_value)
+    if rec is None:
+        await message.answer('Помилка: невідома культура.')
+        return
+    # План з потребою і формами за замовчуванням (азотна залежить від зони зволоження)
+    # рахується один раз і далі лише оновлюється при зміні форм
+    plan = FertilizerPlan.from_recommendation(rec, region)
+    await state.update_data(plan=plan.dump())
+    result_text = results.chat_rates(plan)
+    # Рекомендована кількість кожного добрива на 1 га
+    fert_text = results.chat_fertilizers(plan, '💊 Рекомендовані добрива (на 1 га):\n')
     fert_text += '💡 Ви можете змінити тип добрив перед фінальним розрахунком.'
     # Переходимо до стану вибору дії (змінити форму або продовжити)
     await state.set_state(FertilizerCalculation.form_choice)
-    form_kb = create_keyboard(['Змінити азот', 'Змінити фосфор', 'Змінити калій', 'Продовжити'], add_back=True)
-    await message.answer(fert_text, reply_markup=form_kb)
+    # Норми, фази і добрива надсилаємо одним повідомленням (менше повідомлень у чат)
+    await message.answer(result_text + '\n' + fert_text, reply_markup=form_kb)
 
 # Обробник вибору дії на етапі вибору форм добрив
 @dp.message(FertilizerCalculation.form_choice)
@@ -445,166 +657,97 @@ async def change_or_continue(message: types.Message, state: FSMContext):
     if text.endswith('Назад'):
         # Повернення до повторного введення pH
         await state.set_state(FertilizerCalculation.ph)
-        ph_kb = create_keyboard([], add_back=True)
-        await message.answer('🧪 Введіть pH ґрунту:', reply_markup=ph_kb)
+        await message.answer('🧪 Введіть pH ґрунту:', reply_markup=back_kb)
         return
-    text_lower = text.lower()
-    if 'азот' in text_lower:
+    action = action_index.match(text)
+    if action == 'n':
         # Користувач хоче змінити азотне добриво
         await state.set_state(FertilizerCalculation.choose_n)
-        n_options = ['Амміачна селітра (34% N)', 'Карбамід (46% N)', 'КАС (32% N)']
-        n_kb = create_keyboard(n_options, add_back=True)
         await message.answer('🔄 Оберіть форму азотного добрива:', reply_markup=n_kb)
-    elif 'фосфор' in text_lower:
+    elif action == 'p':
         # Змінити фосфорне добриво
         await state.set_state(FertilizerCalculation.choose_p)
-        p_options = ['Діамофосфат (DAP, 46% P2O5)', 'Суперфосфат (46% P2O5)']
-        p_kb = create_keyboard(p_options, add_back=True)
         await message.answer('🔄 Оберіть форму фосфорного добрива:', reply_markup=p_kb)
-    elif 'калій' in text_lower:
+    elif action == 'k':
         # Змінити калійне добриво
         await state.set_state(FertilizerCalculation.choose_k)
-        k_options = ['Калій хлористий (60% K2O)', 'Калій сульфат (50% K2O)']
-        k_kb = create_keyboard(k_options, add_back=True)
         await message.answer('🔄 Оберіть форму калійного добрива:', reply_markup=k_kb)
-    elif 'продовжити' in text_lower:
+    elif action == 'optimize':
+        # Найдешевший набір добрив за цінами з FERTILIZER_PRICES (залишаємось у меню форм).
+        # NumPy імпортується лише при першому запиті оптимізації
+        import optimizer
+        try:
+            mix = optimizer.default_optimizer()
+        except optimizer.PriceError:
+            logging.exception('Некоректні ціни добрив (FERTILIZER_PRICES)')
+            await message.answer('❗ Підбір набору зараз недоступний.', reply_markup=form_kb)
+            return
+        plan = results.plan_from_state(await state.get_data())
+        await message.answer(results.chat_mix(*mix.solve_one(plan.per_ha)), reply_markup=form_kb)
+    elif action == 'continue':
         # Продовжуємо до введення площі поля (фінальний етап)
         await state.set_state(FertilizerCalculation.area)
-        area_kb = create_keyboard([], add_back=True, add_skip=True)
         await message.answer('📏 Введіть площу поля (га) для розрахунку загальної потреби або натисніть "Пропустити":', reply_markup=area_kb)
     else:
         await message.answer('❗ Оберіть дію із клавіатури: змінити форму добрива або продовжити.')
         return
 
-# Обробник вибору нової форми азотного добрива
-@dp.message(FertilizerCalculation.choose_n)
-async def choose_n_form(message: types.Message, state: FSMContext):
+# Варіанти форм для кроків зміни (N, P, K): слово з кнопки -> назва форми у рушії
+form_choices = (
+    {'Амміачна селітра': 'Амміачна селітра (34% N)', 'Карбамід': 'Карбамід (46% N)', 'КАС': 'КАС (32% N)'},
+    {'Діамофосфат': 'Діамофосфат (DAP, 46% P2O5)', 'Суперфосфат': 'Суперфосфат (46% P2O5)'},
+    {'хлористий': 'Калій хлористий (KCl, 60% K2O)', 'сульфат': 'Калій сульфат (50% K2O)'},
+)
+form_contents = (n_forms, p_forms, k_forms)
+
+
+# Індекс форм: слово з кнопки, текст кнопки, повна назва у рушії і назва без дужок
+def _form_index(choices, options):
+    aliases = dict(choices)
+    for name in choices.values():
+        aliases[name] = name
+        aliases[name.split(' (')[0]] = name
+    for option in options:
+        aliases[option] = next(name for key, name in choices.items() if key in option)
+    return ChoiceIndex(aliases)
+
+
+form_indices = tuple(_form_index(choices, options)
+                     for choices, options in zip(form_choices, (n_options, p_options, k_options)))
+
+# Спільний крок зміни форми добрива: перераховується лише маса обраного елемента
+async def change_form(message, state, index, error_text):
     text = message.text
     if text.endswith('Назад'):
         # Повернення до меню форм добрив
         await state.set_state(FertilizerCalculation.form_choice)
-        form_kb = create_keyboard(['Змінити азот', 'Змінити фосфор', 'Змінити калій', 'Продовжити'], add_back=True)
         await message.answer('↩️ Повернення. Виберіть подальшу дію:', reply_markup=form_kb)
         return
-    # Можливі варіанти азотних добрив і їх N-вміст
-    options = {'Амміачна селітра': (0.34, 'Амміачна селітра (34% N)'),
-               'Карбамід': (0.46, 'Карбамід (46% N)'),
-               'КАС': (0.32, 'КАС (32% N)')}
-    chosen = None
-    for key in options:
-        if key in text:
-            chosen = options[key]
-            break
-    if not chosen:
-        await message.answer('❗ Оберіть варіант азотного добрива з наведених.')
-        return
-    N_content, N_form = chosen
-    # Оновлюємо вибір форми азотного добрива
-    await state.update_data(N_content=N_content, N_form=N_form)
-    # Перераховуємо кількість добрив з урахуванням нової форми
-    data = await state.get_data()
-    N_per_ha = data['N_per_ha']
-    P_per_ha = data['P_per_ha']
-    K_per_ha = data['K_per_ha']
-    P_content = data['P_content']
-    K_content = data['K_content']
-    P_form = data['P_form']
-    K_form = data['K_form']
-    N_fert_per_ha = N_per_ha / N_content
-    P_fert_per_ha = P_per_ha / P_content
-    K_fert_per_ha = K_per_ha / K_content
-    fert_text = '✅ Оновлені добрива (на 1 га):\n'
-    fert_text += f'   - Азот: {N_fert_per_ha:.1f} кг — {N_form}\n'
-    fert_text += f'   - Фосфор: {P_fert_per_ha:.1f} кг — {P_form}\n'
-    fert_text += f'   - Калій: {K_fert_per_ha:.1f} кг — {K_form}\n'
+    form = form_indices[index].match(text)
+    if form is None:
+        await message.answer(error_text)
+        return
+    plan = results.plan_from_state(await state.get_data())
+    plan.set_form(index, form, form_contents[index][form])
+    await state.update_data(plan=plan.dump())
     # Повертаємося до меню вибору дії (можливість змінити інші добрива або продовжити)
     await state.set_state(FertilizerCalculation.form_choice)
-    form_kb = create_keyboard(['Змінити азот', 'Змінити фосфор', 'Змінити калій', 'Продовжити'], add_back=True)
-    await message.answer(fert_text, reply_markup=form_kb)
+    await message.answer(results.chat_fertilizers(plan, '✅ Оновлені добрива (на 1 га):\n'), reply_markup=form_kb)
+
+# Обробник вибору нової форми азотного добрива
+@dp.message(FertilizerCalculation.choose_n)
+async def choose_n_form(message: types.Message, state: FSMContext):
+    await change_form(message, state, 0, '❗ Оберіть варіант азотного добрива з наведених.')
 
 # Обробник вибору нової форми фосфорного добрива
 @dp.message(FertilizerCalculation.choose_p)
 async def choose_p_form(message: types.Message, state: FSMContext):
-    text = message.text
-    if text.endswith('Назад'):
-        # Повернення до меню форм добрив
-        await state.set_state(FertilizerCalculation.form_choice)
-        form_kb = create_keyboard(['Змінити азот', 'Змінити фосфор', 'Змінити калій', 'Продовжити'], add_back=True)
-        await message.answer('↩️ Повернення. Виберіть подальшу дію:', reply_markup=form_kb)
-        return
-    options = {'Діамофосфат': (0.46, 'Діамофосфат (DAP, 46% P2O5)'),
-               'Суперфосфат': (0.46, 'Суперфосфат (46% P2O5)')}
-    chosen = None
-    for key in options:
-        if key in text:
-            chosen = options[key]
-            break
-    if not chosen:
-        await message.answer('❗ Оберіть варіант фосфорного добрива з наведених.')
-        return
-    P_content, P_form = chosen
-    await state.update_data(P_content=P_content, P_form=P_form)
-    # Перерахунок кількості добрив з новою формою фосфору
-    data = await state.get_data()
-    N_per_ha = data['N_per_ha']
-    P_per_ha = data['P_per_ha']
-    K_per_ha = data['K_per_ha']
-    N_content = data['N_content']
-    K_content = data['K_content']
-    N_form = data['N_form']
-    K_form = data['K_form']
-    N_fert_per_ha = N_per_ha / N_content
-    P_fert_per_ha = P_per_ha / P_content
-    K_fert_per_ha = K_per_ha / K_content
-    fert_text = '✅ Оновлені добрива (на 1 га):\n'
-    fert_text += f'   - Азот: {N_fert_per_ha:.1f} кг — {N_form}\n'
-    fert_text += f'   - Фосфор: {P_fert_per_ha:.1f} кг — {P_form}\n'
-    fert_text += f'   - Калій: {K_fert_per_ha:.1f} кг — {K_form}\n'
-    await state.set_state(FertilizerCalculation.form_choice)
-    form_kb = create_keyboard(['Змінити азот', 'Змінити фосфор', 'Змінити калій', 'Продовжити'], add_back=True)
-    await message.answer(fert_text, reply_markup=form_kb)
+    await change_form(message, state, 1, '❗ Оберіть варіант фосфорного добрива з наведених.')
 
 # Обробник вибору нової форми калійного добрива
 @dp.message(FertilizerCalculation.choose_k)
 async def choose_k_form(message: types.Message, state: FSMContext):
-    text = message.text
-    if text.endswith('Назад'):
-        # Повернення до меню форм добрив
-        await state.set_state(FertilizerCalculation.form_choice)
-        form_kb = create_keyboard(['Змінити азот', 'Змінити фосфор', 'Змінити калій', 'Продовжити'], add_back=True)
-        await message.answer('↩️ Повернення. Виберіть подальшу дію:', reply_markup=form_kb)
-        return
-    options = {'хлористий': (0.60, 'Калій хлористий (KCl, 60% K2O)'),
-               'сульфат': (0.50, 'Калій сульфат (50% K2O)')}
-    chosen = None
-    for key in options:
-        if key in text:
-            chosen = options[key]
-            break
-    if not chosen:
-        await message.answer('❗ Оберіть варіант калійного добрива з наведених.')
-        return
-    K_content, K_form = chosen
-    await state.update_data(K_content=K_content, K_form=K_form)
-    # Перерахунок кількості добрив з новою формою калію
-    data = await state.get_data()
-    N_per_ha = data['N_per_ha']
-    P_per_ha = data['P_per_ha']
-    K_per_ha = data['K_per_ha']
-    N_content = data['N_content']
-    P_content = data['P_content']
-    N_form = data['N_form']
-    P_form = data['P_form']
-    N_fert_per_ha = N_per_ha / N_content
-    P_fert_per_ha = P_per_ha / P_content
-    K_fert_per_ha = K_per_ha / K_content
-    fert_text = '✅ Оновлені добрива (на 1 га):\n'
-    fert_text += f'   - Азот: {N_fert_per_ha:.1f} кг — {N_form}\n'
-    fert_text += f'   - Фосфор: {P_fert_per_ha:.1f} кг — {P_form}\n'
-    fert_text += f'   - Калій: {K_fert_per_ha:.1f} кг — {K_form}\n'
-    await state.set_state(FertilizerCalculation.form_choice)
-    form_kb = create_keyboard(['Змінити азот', 'Змінити фосфор', 'Змінити калій', 'Продовжити'], add_back=True)
-    await message.answer(fert_text, reply_markup=form_kb)
+    await change_form(message, state, 2, '❗ Оберіть варіант калійного добрива з наведених.')
 
 # Обробник введення площі та розрахунку загальної потреби
 @dp.message(FertilizerCalculation.area)
@@ -614,32 +757,17 @@ async def calculate_total_need(message: types.Message, state: FSMContext):
     if text.endswith('Назад'):
         # Повернення до меню зміни форм добрив
         await state.set_state(FertilizerCalculation.form_choice)
-        form_kb = create_keyboard(['Змінити азот', 'Змінити фосфор', 'Змінити калій', 'Продовжити'], add_back=True)
         await message.answer('↩️ Повернення до вибору дії перед розрахунком площі:', reply_markup=form_kb)
         return
     if text == 'Пропустити':
+        if not await consume_quota(user_id):
+            await quota_spent(message, state)
+            return
         # Завершуємо без вказання площі (залишаємо дані на 1 га)
-        await message.answer('✅ Розрахунок завершено. Ви можете почати новий розрахунок або отримати PDF звіт.')
-        usage_count[user_id] = usage_count.get(user_id, 0) + 1
+        await message.answer('✅ Розрахунок завершено. Ви можете почати новий розрахунок або отримати PDF звіт.',
+                             reply_markup=result_kb)
         data = await state.get_data()
-        final_recommendation = ''
-        crop = data.get('crop', '')
-        if crop:
-            crop_name = crop.capitalize()
-            final_recommendation += f'Рекомендації для {crop_name}\n'
-        if 'N_per_ha' in data:
-            N_per_ha = data['N_per_ha']; P_per_ha = data['P_per_ha']; K_per_ha = data['K_per_ha']
-            final_recommendation += f'Азот: {N_per_ha:.1f} кг/га; Фосфор: {P_per_ha:.1f} кг/га; Калій: {K_per_ha:.1f} кг/га\n'
-        if 'N_form' in data:
-            N_content = data['N_content']; P_content = data['P_content']; K_content = data['K_content']
-            N_fert = data['N_per_ha'] / N_content
-            P_fert = data['P_per_ha'] / P_content
-            K_fert = data['K_per_ha'] / K_content
-            final_recommendation += 'Рекомендовані форми добрив на 1 га:\n'
-            final_recommendation += ' - ' + data['N_form'] + ': ' + '{:.1f}'.format(N_fert) + ' кг/га\n'
-            final_recommendation += ' - ' + data['P_form'] + ': ' + '{:.1f}'.format(P_fert) + ' кг/га\n'
-            final_recommendation += ' - ' + data['K_form'] + ': ' + '{:.1f}'.format(K_fert) + ' кг/га\n'
-        final_recommendations[user_id] = final_recommendation
+        await storage.set_recommendation(user_id, results.pack(results.plan_from_state(data), data.get('crop', '')))
         await state.clear()
         return
     # Обробка введення площі (га) як числа
@@ -651,77 +779,203 @@ async def calculate_total_need(message: types.Message, state: FSMContext):
     if area_val <= 0:
         await message.answer('❗ Площа повинна бути більше 0.')
         return
-    data = await state.get_data()
-    crop = data.get('crop', '')
-    N_per_ha = data.get('N_per_ha'); P_per_ha = data.get('P_per_ha'); K_per_ha = data.get('K_per_ha')
-    N_content = data.get('N_content'); P_content = data.get('P_content'); K_content = data.get('K_content')
-    N_form = data.get('N_form'); P_form = data.get('P_form'); K_form = data.get('K_form')
-    if N_per_ha is None:
-        await message.answer('Помилка: дані для розрахунку не знайдено.')
+    if not await consume_quota(user_id):
+        await quota_spent(message, state)
+        return
+    plan = results.plan_from_state(await state.get_data())
+    if plan is None:
+        reply = 'Помилка: дані для розрахунку не знайдено.\n'
     else:
-        # Обчислюємо загальну потребу по елементах на вказану площу
-        total_N = N_per_ha * area_val
-        total_P = P_per_ha * area_val
-        total_K = K_per_ha * area_val
-        total_text = f'🔸 Загальна потреба на площу {area_val:.1f} га:\n'
-        total_text += f'   - Азот (N): {total_N:.1f} кг\n'
-        total_text += f'   - Фосфор (P): {total_P:.1f} кг\n'
-        total_text += f'   - Калій (K): {total_K:.1f} кг\n'
-        # Переводимо в фізичну масу добрив відповідно до обраних форм
-        total_N_fert = total_N / N_content
-        total_P_fert = total_P / P_content
-        total_K_fert = total_K / K_content
-        total_text += '💰 У фізичній масі добрив це приблизно:\n'
-        total_text += f'   - {N_form}: {total_N_fert:.1f} кг\n'
-        total_text += f'   - {P_form}: {total_P_fert:.1f} кг\n'
-        total_text += f'   - {K_form}: {total_K_fert:.1f} кг'
-        await message.answer(total_text)
-        # Формуємо текст для PDF звіту
-        crop_name = crop.capitalize() if crop else ''
-        final_recommendation = f'Рекомендації для {crop_name} (на {area_val:.1f} га):\n'
-        final_recommendation += f'Вміст елементів на 1 га: N {N_per_ha:.1f} кг, P {P_per_ha:.1f} кг, K {K_per_ha:.1f} кг.\n'
-        final_recommendation += f'Рекомендовані добрива на 1 га: {N_form} {(N_per_ha/N_content):.1f} кг, {P_form} {(P_per_ha/P_content):.1f} кг, {K_form} {(K_per_ha/K_content):.1f} кг.\n'
-        final_recommendation += f'Загальна потреба на {area_val:.1f} га: {N_form} {total_N_fert:.1f} кг, {P_form} {total_P_fert:.1f} кг, {K_form} {total_K_fert:.1f} кг.'
-        final_recommendations[user_id] = final_recommendation
-    usage_count[user_id] = usage_count.get(user_id, 0) + 1
+        plan.area = area_val
+        # Загальна потреба по елементах і у фізичній масі добрив на вказану площу
+        reply = results.chat_totals(plan) + '\n\n'
+        # Рекомендація для PDF звіту (текст формується під час запиту звіту)
+        await storage.set_recommendation(user_id, results.pack(plan))
     await state.clear()
-    await message.answer('✅ Розрахунок завершено. Ви можете почати новий розрахунок або отримати PDF звіт командою /start.')
+    # Підсумок і повідомлення про завершення - одним повідомленням
+    await message.answer(reply + '✅ Розрахунок завершено. Ви можете почати новий розрахунок або отримати PDF звіт командою /start.',
+                         reply_markup=result_kb)
+
+# Ліміт вичерпано вже під час діалогу (наприклад, паралельним /calc): пропонуємо оплату,
+# а після неї діалог почнеться спочатку
+async def quota_spent(message, state):
+    await state.clear()
+    await message.answer('❗ Доступні розрахунки вже використано.')
+    await send_payment_invoice(message.bot, message.from_user.id)
 
 # Обробник генерації PDF звіту
 @dp.callback_query(lambda c: c.data == 'get_pdf')
 async def send_pdf(callback_query: types.CallbackQuery, state: FSMContext):
     user_id = callback_query.from_user.id
-    pdf_content = final_recommendations.get(user_id, '')
+    pdf_content = results.stored_pdf_text(await storage.get_recommendation(user_id))
     if not pdf_content:
         pdf_content = 'Немає даних для формування рекомендацій. Виконайте розрахунок спочатку.'
-    pdf_file = await generate_pdf(pdf_content)
-    await bot.send_document(chat_id=user_id, document=InputFile(pdf_file))
+    key = pdf_cache.key(pdf_content)
+    pdf_bytes, file_id = pdf_cache.get(key)
+    if file_id is not None:
+        # Такий самий звіт уже надсилався - повторно використовуємо file_id без рендерингу і завантаження
+        await callback_query.answer()
+        try:
+            await callback_query.bot.send_document(chat_id=user_id, document=file_id)
+            return
+        except TelegramBadRequest:
+            # file_id став недійсним - формуємо звіт заново
+            pdf_cache.invalidate(key)
+    elif pdf_bytes is None and pdf_pool.full:
+        # Черга переповнена - відмовляємо одразу
+        await callback_query.answer('❗ Забагато запитів на звіти, спробуйте за хвилину.', show_alert=True)
+        return
+    elif pdf_bytes is None and pdf_pool.saturated:
+        # Всі воркери зайняті - повідомляємо, що звіт у черзі
+        await callback_query.answer('⏳ Звіт поставлено в чергу, зачекайте...')
+    else:
+        await callback_query.answer()
+    if pdf_bytes is None:
+        try:
+            pdf_bytes = await generate_pdf(pdf_pool.render, pdf_content)
+        except PdfQueueFull:
+            await callback_query.bot.send_message(user_id, '❗ Забагато запитів на звіти, спробуйте за хвилину.')
+            return
+        except asyncio.TimeoutError:
+            await callback_query.bot.send_message(user_id, '❗ Не вдалося вчасно сформувати звіт. Спробуйте ще раз.')
+            return
+        pdf_cache.put_bytes(key, pdf_bytes)
+    # Надсилаємо документ безпосередньо з пам'яті і запам'ятовуємо його file_id
+    sent = await callback_query.bot.send_document(chat_id=user_id, document=BufferedInputFile(pdf_bytes, filename='recommendation.pdf'))
+    if sent.document is not None:
+        pdf_cache.put_file_id(key, sent.document.file_id)
 
-# Обробник довідника культур (поки що заглушка)
-@dp.callback_query(lambda c: c.data == 'crop_guide')
+# Довідник культур: список культур новим повідомленням
+@dp.callback_query(lambda c: c.data == crop_guide.START)
 async def show_crop_guide(callback_query: types.CallbackQuery):
     await callback_query.answer()
-    await callback_query.message.answer('ℹ️ Довідник культур наразі недоступний.')
+    text, keyboard = crop_guide.pages[crop_guide.INDEX]
+    await callback_query.message.answer(text, reply_markup=keyboard)
 
-# Обробник передперевірки оплати (LiqPay)
-@dp.pre_checkout_query(lambda query: True)
-async def process_pre_checkout(pre_checkout_query: PreCheckoutQuery):
-    await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
+# Гортання довідника: готова сторінка замінює текст того самого повідомлення
+@dp.callback_query(lambda c: c.data is not None and c.data.startswith(crop_guide.PREFIX))
+async def crop_guide_page(callback_query: types.CallbackQuery):
+    page = crop_guide.pages.get(callback_query.data)
+    # Відповідь на натискання - одразу, до редагування повідомлення
+    await callback_query.answer()
+    if page is None:
+        return
+    text, keyboard = page
+    try:
+        await callback_query.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest:
+        # Повторне натискання тієї самої сторінки: повідомлення не змінилося
+        pass
 
-# Обробник підтвердження успішної оплати
-@dp.message(lambda message: message.successful_payment is not None)
-async def payment_successful(message: types.Message, state: FSMContext):
+# Нагадування про внесення: запит дати сівби для останнього розрахунку
+@dp.callback_query(lambda c: c.data == 'remind')
+async def start_reminders(callback_query: types.CallbackQuery, state: FSMContext):
+    plan = results.unpack(await storage.get_recommendation(callback_query.from_user.id))
+    if plan is None:
+        await callback_query.answer('Спершу виконайте розрахунок.', show_alert=True)
+        return
+    await callback_query.answer()
+    await state.set_state(ReminderSetup.sowing_date)
+    await callback_query.message.answer(
+        '📅 Введіть дату сівби (ДД.ММ або ДД.ММ.РРРР) або натисніть "Сьогодні".\n'
+        f'Нагадування надходитимуть о {reminders.REMINDER_HOUR}:00 на початку кожної фази внесення.',
+        reply_markup=sowing_kb)
+
+# Дата сівби: нагадування для кожної фази, що ще не минула
+@dp.message(ReminderSetup.sowing_date)
+async def schedule_reminders(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    payment_count[user_id] = payment_count.get(user_id, 0) + 1
-    await message.answer('✅ Оплату отримано! Ви отримали додатковий розрахунок.')
-    # Після оплати автоматично переходимо до вибору культури для нового розрахунку
-    await state.set_state(FertilizerCalculation.crop)
-    crop_kb = create_keyboard(crops)
-    await message.answer('🌾 Оберіть культуру:', reply_markup=crop_kb)
+    text = message.text or ''
+    if text.endswith('Назад'):
+        await state.clear()
+        await message.answer('↩️ Нагадування не налаштовано.', reply_markup=types.ReplyKeyboardRemove())
+        return
+    sowing = reminders.parse_date(text, datetime.now(reminders.REMINDER_TZ).date())
+    if sowing is None:
+        await message.answer('❗ Введіть дату у форматі ДД.ММ або ДД.ММ.РРРР, наприклад 15.04.')
+        return
+    plan = results.unpack(await storage.get_recommendation(user_id))
+    items = reminders.plan_reminders(plan, sowing) if plan is not None else []
+    await state.clear()
+    if not items:
+        await message.answer('ℹ️ Усі фази внесення для цієї дати вже минули.', reply_markup=types.ReplyKeyboardRemove())
+        return
+    await reminder_scheduler.schedule(user_id, [(due, reminder) for due, _, reminder in items])
+    lines = [f'   - {datetime.fromtimestamp(due, reminders.REMINDER_TZ):%d.%m.%Y} - {phase}' for due, phase, _ in items]
+    await message.answer(f'🔔 Заплановано нагадувань: {len(items)}\n' + '\n'.join(lines)
+                         + '\nПерелік і скасування - /reminders', reply_markup=types.ReplyKeyboardRemove())
 
-# Запуск бота
-async def main():
-    await dp.start_polling(bot)
+# Скасування всіх нагадувань користувача
+@dp.callback_query(lambda c: c.data == 'reminders_off')
+async def cancel_reminders(callback_query: types.CallbackQuery):
+    cancelled = await reminder_scheduler.cancel_user(callback_query.from_user.id)
+    await callback_query.answer(f'Скасовано нагадувань: {cancelled}')
 
+# Відправка одного нагадування; False - чат недоступний (бот заблоковано), не повторювати
+async def send_reminder(bot, user_id, text):
+    try:
+        await bot.send_message(user_id, text)
+    except (TelegramForbiddenError, TelegramBadRequest):
+        return False
+    return True
+
+# Підготовка і звільнення ресурсів (виконується у кожному процесі, в обох режимах)
+@dp.startup()
+async def on_startup(bot: Bot):
+    await storage.start()
+    await reminder_scheduler.start(functools.partial(send_reminder, bot))
+
+@dp.shutdown()
+async def on_shutdown():
+    pdf_pool.shutdown()
+    await reminder_scheduler.stop()
+    await storage.close()
+    await fsm_storage.close()
+    await reminder_store.close()
+
+async def main(bot):
+    # Локальний /metrics (METRICS_PORT, METRICS_HOST)
+    metrics_runner = await metrics.start_server()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+# Профіль запуску: ініціалізація і хуки старту без підключення до Telegram, потім
+# вартість відкладених імпортів (перший пакетний розрахунок, підбір набору і перший PDF).
+# Код виходу 1, якщо готовність довша за STARTUP_TARGET секунд
+async def profile_startup():
+    startup_profile.checkpoint('імпорт і ініціалізація модуля бота')
+    with startup_profile.phase('create_bot()'):
+        bot = create_bot()
+    with startup_profile.phase('хуки старту (сховища)'):
+        await dp.emit_startup(bot=bot, dispatcher=dp)
+    startup_profile.mark_ready()
+    # Вимірюється сам імпорт (NumPy, pandas), тож модулі імпортуються явно через importlib
+    with startup_profile.phase('перший пакетний розрахунок: import batch', deferred=True):
+        importlib.import_module('batch')
+    with startup_profile.phase('перший підбір набору добрив: import optimizer і базиси', deferred=True):
+        importlib.import_module('optimizer').default_optimizer()
+    with startup_profile.phase('перший PDF: рендеринг з імпортом reportlab', deferred=True):
+        render_pdf('Профіль запуску')
+    await dp.emit_shutdown(bot=bot, dispatcher=dp)
+    await bot.session.close()
+    return startup_profile.report(float(os.getenv('STARTUP_TARGET', 0)))
+
+# Вибір режиму запуску: профіль запуску (--profile-startup), воркер-шард (SHARD_INDEX задає
+# супервізор), супервізор з кількома шардами (SHARD_WORKERS або WEBHOOK_WORKERS > 1),
+# один процес з webhook-сервером (BOT_MODE=webhook) або з long polling
 if __name__ == '__main__':
-    asyncio.run(main())
+    if '--profile-startup' in sys.argv:
+        raise SystemExit(asyncio.run(profile_startup()))
+    bot = create_bot()
+    if SHARD_INDEX is not None:
+        asyncio.run(supervisor.run_worker(dp, bot))
+    elif SHARD_WORKERS > 1:
+        # Супервізор розподіляє оновлення між шардами за id користувача (SHARD_WORKERS або WEBHOOK_WORKERS)
+        supervisor.run(dp, bot, SHARD_WORKERS, BOT_MODE)
+    elif BOT_MODE == 'webhook':
+        webhook.run(dp, bot)
+    else:
+        asyncio.run(main(bot))
@@ -0,0 +1,108 @@
+# Обмеження вхідних оновлень до того, як вони дійдуть до FSM і сховища.
+#   - повторні натискання тієї самої inline-кнопки протягом короткого вікна
+#     відкидаються (лише закривається індикатор завантаження на кнопці);
+#   - кожен користувач обмежений ковзним вікном: лічильники поточного і
+#     попереднього вікна (короткий список чисел), пам'ять обмежена max_users.
+# Оплати (pre_checkout_query, successful_payment) ніколи не обмежуються.
+import logging
+import os
+import time
+
+from aiogram import BaseMiddleware
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, limit=10, window=5.0, dedup_window=1.0, max_users=100_000):
+        self.limit = limit
+        self.window = window
+        self.dedup_window = dedup_window
+        self.max_users = max_users
+        self._users = {}       # user_id -> [номер вікна, кількість у ньому, кількість у попередньому, чи попереджено]
+        self._callbacks = {}   # (user_id, message_id, data) -> час натискання
+        self.duplicates = 0    # відкинуто повторних натискань
+        self.throttled = 0     # відкинуто через перевищення ліміту
+
+    # Налаштування з оточення (THROTTLE_LIMIT, THROTTLE_WINDOW, CALLBACK_DEDUP_WINDOW,
+    # THROTTLE_MAX_USERS); None, якщо THROTTLE_LIMIT=0
+    @classmethod
+    def from_env(cls):
+        limit = int(os.getenv('THROTTLE_LIMIT', 10))
+        if limit <= 0:
+            return None
+        return cls(
+            limit=limit,
+            window=float(os.getenv('THROTTLE_WINDOW', 5)),
+            dedup_window=float(os.getenv('CALLBACK_DEDUP_WINDOW', 1)),
+            max_users=int(os.getenv('THROTTLE_MAX_USERS', 100_000)),
+        )
+
+    # Чи є натискання повтором того самого протягом dedup_window
+    def _duplicate(self, callback, now):
+        message_id = callback.message.message_id if callback.message else None
+        key = (callback.from_user.id, message_id, callback.data)
+        last = self._callbacks.get(key)
+        self._callbacks[key] = now
+        if len(self._callbacks) > self.max_users:
+            self._callbacks = {k: t for k, t in self._callbacks.items() if now - t < self.dedup_window}
+        return last is not None and now - last < self.dedup_window
+
+    # Ковзне вікно: оцінка кількості оновлень за останні window секунд.
+    # Повертає None, якщо оновлення дозволене, інакше - чи вже попереджали користувача
+    def _limited(self, user_id, now):
+        index = int(now // self.window)
+        entry = self._users.get(user_id)
+        if entry is None:
+            if len(self._users) >= self.max_users:
+                self._prune(index)
+            entry = self._users[user_id] = [index, 0, 0, False]
+        elif entry[0] != index:
+            # Поточне вікно стає попереднім (або обидва обнуляються після паузи)
+            entry[2] = entry[1] if entry[0] == index - 1 else 0
+            entry[0], entry[1], entry[3] = index, 0, False
+        elapsed = now / self.window - index
+        if entry[2] * (1 - elapsed) + entry[1] >= self.limit:
+            warned = entry[3]
+            entry[3] = True
+            return warned
+        entry[1] += 1
+        return None
+
+    # Видалення неактивних користувачів; якщо всі активні - найстаріших за вставкою
+    def _prune(self, index):
+        self._users = {u: e for u, e in self._users.items() if e[0] >= index - 1}
+        if len(self._users) >= self.max_users:
+            drop = len(self._users) - self.max_users // 2
+            for user_id in list(self._users)[:drop]:
+                del self._users[user_id]
+
+    async def __call__(self, handler, event, data):
+        callback = event.callback_query
+        message = event.message
+        if callback is None and (message is None or message.successful_payment is not None):
+            return await handler(event, data)
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+        now = time.monotonic()
+        if callback is not None and self._duplicate(callback, now):
+            self.duplicates += 1
+            await callback.answer()
+            return None
+        warned = self._limited(user.id, now)
+        if warned is None:
+            return await handler(event, data)
+        self.throttled += 1
+        if callback is not None:
+            await callback.answer('⏳ Забагато запитів, зачекайте кілька секунд.')
+        elif not warned:
+            # Попереджаємо один раз за вікно, решту відкидаємо мовчки
+            await message.answer('⏳ Забагато повідомлень, зачекайте кілька секунд.')
+        logging.debug('Оновлення користувача %s відкинуто обмеженням частоти', user.id)
+        return None
+
+
+# Реєстрація перед FSM-middleware, щоб відкинуті оновлення не читали стан зі сховища
+def setup(dp, middleware):
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(middleware)
+    dp.update.outer_middleware(dp.fsm)
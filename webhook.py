@@ -0,0 +1,128 @@
+# Режим webhook: aiohttp-сервер замість довгого опитування (long polling).
+# Оновлення приймаються на WEBHOOK_PATH з перевіркою секретного токена,
+# /health показує стан процесу, а під час зупинки сервер спершу перестає
+# приймати нові оновлення і дочікується обробки вже прийнятих. Метрики сюди
+# не входять: їх віддає окремий локальний сервер (metrics.start_server).
+# Тут - один процес; кілька воркерів (WEBHOOK_WORKERS > 1) запускаються під
+# супервізором (supervisor.py), що розподіляє оновлення між ними за id користувача.
+import asyncio
+import logging
+import os
+import signal
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+import metrics
+
+
+class WebhookConfig:
+    def __init__(self, url='', path='/webhook', secret=None, host='0.0.0.0', port=8080,
+                 drain_timeout=30.0):
+        self.url = url
+        self.path = path
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.drain_timeout = drain_timeout
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            url=os.getenv('WEBHOOK_URL', ''),
+            path=os.getenv('WEBHOOK_PATH', '/webhook'),
+            secret=os.getenv('WEBHOOK_SECRET') or None,
+            host=os.getenv('WEBHOOK_HOST', '0.0.0.0'),
+            port=int(os.getenv('WEBHOOK_PORT', 8080)),
+            drain_timeout=float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', 30)),
+        )
+
+
+# Зовнішній middleware оновлень: скільки оновлень зараз обробляється
+# (для /health і дочікування обробки під час зупинки)
+class InFlightMiddleware(BaseMiddleware):
+    def __init__(self):
+        self.count = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(self, handler, event, data):
+        self.count += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.count -= 1
+            if not self.count:
+                self._idle.set()
+
+    # Очікування, доки не завершиться обробка всіх оновлень; False - вийшов тайм-аут
+    async def wait_idle(self, timeout):
+        # Оновлення, прийняті перед зупинкою, спершу мають дійти до middleware
+        await asyncio.sleep(0)
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+# Побудова aiohttp-застосунку з обробником оновлень і /health
+def build_app(dp, bot, config):
+    app = web.Application()
+    handler = SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=config.secret)
+    in_flight = InFlightMiddleware()
+    dp.update.outer_middleware(in_flight)
+    state = {'draining': False}
+
+    async def health(request):
+        body = {'status': 'draining' if state['draining'] else 'ok',
+                'in_flight': in_flight.count,
+                'pid': os.getpid()}
+        # Під час зупинки балансувальник має перестати надсилати сюди запити
+        return web.json_response(body, status=503 if state['draining'] else 200)
+
+    # Дочікуємося обробки прийнятих оновлень до закриття сесії бота і сховищ
+    async def drain(app):
+        state['draining'] = True
+        if in_flight.count:
+            logging.info('Очікування обробки %d оновлень перед зупинкою', in_flight.count)
+        if not await in_flight.wait_idle(config.drain_timeout):
+            logging.warning('Не дочекалися обробки %d оновлень за %.0f с', in_flight.count, config.drain_timeout)
+
+    app.on_shutdown.append(drain)
+    handler.register(app, path=config.path)
+    app.router.add_get('/health', health)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+# Один процес сервера: працює до SIGTERM/SIGINT, потім коректно зупиняється
+async def serve(dp, bot, config):
+    app = build_app(dp, bot, config)
+    runner = web.AppRunner(app, shutdown_timeout=config.drain_timeout)
+    await runner.setup()
+    site = web.TCPSite(runner, config.host, config.port)
+    await site.start()
+    logging.info('Webhook-сервер слухає %s:%d%s (pid %d)', config.host, config.port, config.path, os.getpid())
+    # /metrics - на окремому локальному порту (METRICS_HOST), а не на публічному webhook
+    metrics_runner = await metrics.start_server()
+    if config.url:
+        await bot.set_webhook(config.url.rstrip('/') + config.path, secret_token=config.secret,
+                              allowed_updates=dp.resolve_used_update_types())
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+
+# Запуск сервера webhook в одному процесі
+def run(dp, bot, config=None):
+    asyncio.run(serve(dp, bot, config or WebhookConfig.from_env()))